@@ -0,0 +1,249 @@
+from pymongo import ASCENDING, DESCENDING, GEO2D, IndexModel
+from typing import Any, Dict, List, Mapping, Tuple
+import asyncio
+import logging
+
+from game.world_map import WorldMap
+
+logger = logging.getLogger(__name__)
+
+# Declarative index manifest: collection -> indexes derived from the query shapes
+# the routes, repository and background tasks actually run.
+INDEX_MANIFEST: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("username", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)], unique=True, sparse=True),
+    ],
+    "players": [
+        IndexModel([("userId", ASCENDING)], unique=True),
+        IndexModel([("username", ASCENDING)], unique=True),
+        IndexModel([("power", DESCENDING)]),
+        IndexModel([("empire", ASCENDING), ("power", DESCENDING)]),
+        IndexModel([("lastActive", ASCENDING)]),
+        # Denormalized alliance membership; members of one alliance
+        IndexModel([("allianceId", ASCENDING)]),
+        # Castle positions {x, y}; bounds cover the whole map (the default is -180..180)
+        IndexModel([("coordinates", GEO2D)], min=0, max=max(WorldMap.WORLD_WIDTH, WorldMap.WORLD_HEIGHT)),
+    ],
+    "chat_messages": [
+        IndexModel([("timestamp", ASCENDING)]),
+        IndexModel([("username", ASCENDING)]),
+    ],
+    "alliance_messages": [
+        # One channel's history, newest first
+        IndexModel([("allianceId", ASCENDING), ("timestamp", DESCENDING)]),
+    ],
+    "private_messages": [
+        # Inbox query is {$or: [{sender}, {receiver}]} sorted by timestamp,
+        # so each branch needs its own (field, timestamp) index to merge-sort
+        IndexModel([("sender", ASCENDING), ("timestamp", ASCENDING)]),
+        IndexModel([("receiver", ASCENDING), ("timestamp", ASCENDING)]),
+        IndexModel([("timestamp", ASCENDING)]),
+    ],
+    "construction_queue": [
+        # {playerId, completed: false} sorted by startTime
+        IndexModel([("playerId", ASCENDING), ("completed", ASCENDING), ("startTime", ASCENDING)]),
+        # {completed, completionTime: {$lte|$lt}} - due items and cleanup
+        IndexModel([("completed", ASCENDING), ("completionTime", ASCENDING)]),
+    ],
+    "raids": [
+        IndexModel([("attackerUsername", ASCENDING), ("timestamp", DESCENDING)]),
+        IndexModel([("defenderUsername", ASCENDING), ("timestamp", DESCENDING)]),
+        IndexModel([("timestamp", ASCENDING)]),
+    ],
+    "trade_offers": [
+        # Open offers: {active: true, expiresAt: {$gt}, creatorUsername: {$ne}}
+        # sorted by createdAt. Only active offers are ever browsed, so the
+        # index is partial and stays small as completed trades pile up.
+        IndexModel(
+            [("createdAt", DESCENDING), ("expiresAt", ASCENDING)],
+            name="open_offers",
+            partialFilterExpression={"active": True}
+        ),
+        IndexModel([("creatorUsername", ASCENDING), ("createdAt", DESCENDING)]),
+        # Expiry sweep {active: true, expiresAt: {$lte}} and the offers it claimed
+        IndexModel(
+            [("expiresAt", ASCENDING)],
+            name="open_offers_expiry",
+            partialFilterExpression={"active": True}
+        ),
+        # Closed offers whose escrow has not been given back yet
+        IndexModel([("refunded", ASCENDING)], name="pending_refunds", partialFilterExpression={"refunded": False}),
+        # Accepted offers whose creator has not been paid yet {settled: false, completedAt: {$lte}}
+        IndexModel([("completedAt", ASCENDING)], name="unsettled_trades", partialFilterExpression={"settled": False}),
+    ],
+    "market_orders": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        # Open orders loaded oldest first when the order books are rebuilt
+        IndexModel([("status", ASCENDING), ("createdAt", ASCENDING)]),
+    ],
+    "market_prices": [
+        # One document per (pair, window, bucket); the last price has window "last"
+        IndexModel([("pair", ASCENDING), ("window", ASCENDING), ("bucketStart", ASCENDING)], unique=True),
+        # Reload of the retained buckets and cleanup of older ones
+        IndexModel([("bucketStart", ASCENDING)]),
+    ],
+    "alliances": [
+        IndexModel([("name", ASCENDING)], unique=True),
+        IndexModel([("leaderUsername", ASCENDING)]),
+        # Multikey index for {"members": username} membership lookups
+        IndexModel([("members", ASCENDING)]),
+        # Materialized member count: alliance map range query and size rankings
+        IndexModel([("memberCount", DESCENDING)]),
+        IndexModel([("createdAt", DESCENDING)]),
+    ],
+    "alliance_invites": [
+        # Inbox {toUsername, status: pending} newest first, and bulk decline
+        IndexModel([("toUsername", ASCENDING), ("status", ASCENDING), ("createdAt", DESCENDING)]),
+        # Invites, answered or not, are removed once they expire
+        IndexModel([("expiresAt", ASCENDING)], expireAfterSeconds=0),
+        # At most one pending invite per (alliance, player); the dedupe_pending_invites
+        # migration clears older duplicates that would block building it
+        IndexModel([("allianceId", ASCENDING), ("toUsername", ASCENDING)], unique=True,
+                   partialFilterExpression={"status": "pending"}, name="one_pending_invite"),
+    ],
+    "marches": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        # Active marches of a player
+        IndexModel([("attackerUsername", ASCENDING), ("status", ASCENDING)]),
+    ],
+    "scheduled_events": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        # Due events {status: pending, dueAt: {$lte}} sorted by dueAt, and stale claims
+        IndexModel([("status", ASCENDING), ("dueAt", ASCENDING)]),
+        IndexModel([("claimToken", ASCENDING), ("dueAt", ASCENDING)], sparse=True),
+    ],
+    "shop_purchases": [
+        IndexModel([("playerId", ASCENDING), ("purchaseDate", DESCENDING)]),
+    ],
+    "shop_orders": [
+        # One order per idempotency key and player; keys are forgotten once they expire
+        IndexModel([("playerId", ASCENDING), ("idempotencyKey", ASCENDING)], unique=True),
+        IndexModel([("expiresAt", ASCENDING)], expireAfterSeconds=0),
+    ],
+    "inventory": [
+        # One counter document per (player, item), updated with $inc
+        IndexModel([("playerId", ASCENDING), ("itemId", ASCENDING)], unique=True),
+    ],
+}
+
+# Options that change index semantics; anything else (v, ns, background) is ignored
+SIGNIFICANT_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+def plain_value(value: Any) -> Any:
+    """An option value with SON and other mappings as dicts and whole floats as ints
+
+    list_indexes() hands back SON documents and may widen numbers, while the
+    manifest holds plain dicts; both must compare equal.
+    """
+    if isinstance(value, Mapping):
+        return {key: plain_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [plain_value(item) for item in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def index_signature(index_doc: dict) -> Tuple:
+    """Comparable identity of an index: its key pattern plus semantic options"""
+    keys = tuple((field, int(direction) if isinstance(direction, (int, float)) else direction)
+                 for field, direction in index_doc["key"].items())
+    options = tuple(
+        (option, repr(plain_value(index_doc[option]))) for option in SIGNIFICANT_OPTIONS
+        # `is`, not ==: expireAfterSeconds=0 is a TTL index, not a disabled option
+        if index_doc.get(option) is not None and index_doc.get(option) is not False
+    )
+    return keys, options
+
+async def diff_collection_indexes(database, collection: str, wanted: List[IndexModel]) -> Dict:
+    """Compare one collection's manifest entries with what list_indexes() reports"""
+    existing = {}
+    async for index_doc in database[collection].list_indexes():
+        if index_doc["name"] == "_id_":
+            continue
+        existing[index_signature(index_doc)] = index_doc["name"]
+
+    wanted_by_signature = {index_signature(model.document): model for model in wanted}
+
+    return {
+        "missing": [model for signature, model in wanted_by_signature.items() if signature not in existing],
+        "obsolete": [name for signature, name in existing.items() if signature not in wanted_by_signature]
+    }
+
+async def diff_indexes(database) -> Dict[str, Dict]:
+    """Diff the whole manifest against the database, one list_indexes() per collection"""
+    collections = list(INDEX_MANIFEST)
+    diffs = await asyncio.gather(*[
+        diff_collection_indexes(database, collection, INDEX_MANIFEST[collection])
+        for collection in collections
+    ])
+    return dict(zip(collections, diffs))
+
+async def apply_index_diff(database, diff: Dict[str, Dict], drop_obsolete: bool = False) -> Dict[str, int]:
+    """Create missing indexes (and optionally drop obsolete ones) concurrently per collection"""
+    async def apply_collection(collection: str, collection_diff: Dict):
+        if drop_obsolete:
+            for name in collection_diff["obsolete"]:
+                await database[collection].drop_index(name)
+                logger.info(f"Dropped obsolete index {collection}.{name}")
+        if collection_diff["missing"]:
+            names = await database[collection].create_indexes(collection_diff["missing"])
+            logger.info(f"Created indexes on {collection}: {', '.join(names)}")
+
+    await asyncio.gather(*[
+        apply_collection(collection, collection_diff)
+        for collection, collection_diff in diff.items()
+    ])
+
+    return {
+        "created": sum(len(d["missing"]) for d in diff.values()),
+        "dropped": sum(len(d["obsolete"]) for d in diff.values()) if drop_obsolete else 0
+    }
+
+async def ensure_indexes(database, drop_obsolete: bool = False) -> Dict[str, int]:
+    """Bring the database in line with INDEX_MANIFEST; a no-op when nothing changed"""
+    diff = await diff_indexes(database)
+
+    for collection, collection_diff in diff.items():
+        for name in collection_diff["obsolete"]:
+            logger.warning(f"Index {collection}.{name} is not in the manifest (obsolete)")
+
+    if not any(d["missing"] or (drop_obsolete and d["obsolete"]) for d in diff.values()):
+        logger.info("Database indexes up to date")
+        return {"created": 0, "dropped": 0}
+
+    return await apply_index_diff(database, diff, drop_obsolete)
+
+async def main(argv=None):
+    """Out-of-band index management: report the diff, optionally apply it"""
+    import argparse
+    import os
+    from pathlib import Path
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Diff and apply the Medieval Empires index manifest")
+    parser.add_argument("--apply", action="store_true", help="create missing indexes")
+    parser.add_argument("--drop-obsolete", action="store_true", help="also drop indexes not in the manifest")
+    args = parser.parse_args(argv)
+
+    load_dotenv(Path(__file__).parent.parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    database = client[os.environ.get('DB_NAME', 'medieval_empires')]
+
+    try:
+        diff = await diff_indexes(database)
+        for collection, collection_diff in diff.items():
+            for model in collection_diff["missing"]:
+                print(f"+ {collection}.{model.document['name']}")
+            for name in collection_diff["obsolete"]:
+                print(f"- {collection}.{name}")
+
+        if args.apply:
+            result = await apply_index_diff(database, diff, args.drop_obsolete)
+            print(f"Created {result['created']} indexes, dropped {result['dropped']}")
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,807 @@
+from bson import ObjectId
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+import bson
+import copy
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# In-memory stand-in for the subset of the Motor API the backend uses.
+# Selected with DB_BACKEND=memory; documents live in dicts keyed by _id and
+# every index declared through create_index(es) is kept as a hash index on
+# its leading field, so point lookups stay O(1) like they would on Mongo.
+
+_MISSING = object()
+
+# Seconds between automatic TTL passes, as mongod's ttlMonitorSleepSecs
+TTL_MONITOR_INTERVAL = 60
+
+class UnsupportedOperation(OperationFailure):
+    """A query, update or pipeline feature the in-memory backend does not implement"""
+
+    def __init__(self, what: str):
+        super().__init__(f"{what} is not supported by the in-memory backend")
+
+def check_encodable(document: dict):
+    """Raise as the driver would for a document MongoDB cannot store
+
+    Integers outside int64 raise OverflowError and unsupported value types
+    (e.g. NumPy scalars) raise InvalidDocument.
+    """
+    bson.encode(document)
+
+def duplicate_key(collection: str, index: str) -> DuplicateKeyError:
+    message = f"E11000 duplicate key error collection: {collection} index: {index}"
+    return DuplicateKeyError(message, code=11000, details={"code": 11000, "errmsg": message})
+
+def bulk_write_error(write_errors: List[dict], **counts) -> BulkWriteError:
+    """BulkWriteError with the details layout pymongo reports"""
+    details = {"writeErrors": write_errors, "writeConcernErrors": [], "nInserted": 0, "nUpserted": 0,
+               "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []}
+    details.update(counts)
+    return BulkWriteError(details)
+
+def get_path(document: dict, path: str) -> Any:
+    """Resolve a dotted path, returning _MISSING when any segment is absent"""
+    value = document
+    for part in path.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+    return value
+
+def set_path(document: dict, path: str, value: Any):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+def unset_path(document: dict, path: str):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+def _type_rank(value: Any) -> int:
+    """BSON comparison order for the types we store"""
+    if value is _MISSING or value is None:
+        return 0
+    if isinstance(value, bool):
+        return 5
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, list):
+        return 4
+    if isinstance(value, ObjectId):
+        return 6
+    return 7
+
+def sort_key(value: Any):
+    rank = _type_rank(value)
+    if rank == 0:
+        return (0, 0)
+    if rank in (3, 4):
+        return (rank, repr(value))
+    return (rank, value)
+
+def _compare(value: Any, operand: Any, op) -> bool:
+    if value is _MISSING or value is None or _type_rank(value) != _type_rank(operand):
+        return False
+    return op(value, operand)
+
+def _candidates(value: Any) -> List[Any]:
+    """Values a query matches against: the field itself plus array elements"""
+    if value is _MISSING:
+        return [_MISSING]
+    if isinstance(value, list):
+        return value + [value]
+    return [value]
+
+def _equals(value: Any, operand: Any) -> bool:
+    if operand is None:
+        return value is _MISSING or value is None or (isinstance(value, list) and None in value)
+    return any(candidate == operand for candidate in _candidates(value) if candidate is not _MISSING)
+
+def _match_operator(value: Any, operator: str, operand: Any) -> bool:
+    if operator == "$eq":
+        return _equals(value, operand)
+    if operator == "$ne":
+        return not _equals(value, operand)
+    if operator == "$in":
+        return any(_equals(value, item) for item in operand)
+    if operator == "$nin":
+        return not any(_equals(value, item) for item in operand)
+    if operator == "$exists":
+        return (value is not _MISSING) == bool(operand)
+    if operator in ("$gt", "$gte", "$lt", "$lte"):
+        op = {
+            "$gt": lambda a, b: a > b,
+            "$gte": lambda a, b: a >= b,
+            "$lt": lambda a, b: a < b,
+            "$lte": lambda a, b: a <= b,
+        }[operator]
+        return any(_compare(candidate, operand, op) for candidate in _candidates(value))
+    if operator == "$type":
+        type_checks = {
+            "array": lambda v: isinstance(v, list),
+            "object": lambda v: isinstance(v, dict),
+            "string": lambda v: isinstance(v, str),
+            "bool": lambda v: isinstance(v, bool),
+            "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+            "date": lambda v: isinstance(v, datetime),
+            "objectId": lambda v: isinstance(v, ObjectId),
+            "null": lambda v: v is None,
+        }
+        return value is not _MISSING and type_checks[operand](value)
+    if operator == "$size":
+        return isinstance(value, list) and len(value) == operand
+    if operator == "$regex":
+        return isinstance(value, str) and re.search(operand, value) is not None
+    if operator == "$geoWithin":
+        # Legacy coordinate pairs only: [x, y] or an embedded {x, y} document
+        if "$box" not in operand:
+            raise UnsupportedOperation(f"$geoWithin shape {list(operand)}")
+        if isinstance(value, dict):
+            value = list(value.values())[:2]
+        if not isinstance(value, list) or len(value) < 2:
+            return False
+        (x_min, y_min), (x_max, y_max) = operand["$box"]
+        return x_min <= value[0] <= x_max and y_min <= value[1] <= y_max
+    raise UnsupportedOperation(f"Query operator {operator}")
+
+def matches(document: dict, query: Optional[dict]) -> bool:
+    """Evaluate a Mongo query filter against one document"""
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(document, clause) for clause in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(document, clause) for clause in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(document, clause) for clause in condition):
+                return False
+        else:
+            value = get_path(document, key)
+            if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+                if not all(_match_operator(value, op, operand) for op, operand in condition.items()):
+                    return False
+            elif not _equals(value, condition):
+                return False
+    return True
+
+def apply_update(document: dict, update: dict, inserting: bool = False):
+    """Apply update operators to a document in place"""
+    for operator, fields in update.items():
+        if operator == "$setOnInsert" and not inserting:
+            continue
+        for path, value in fields.items():
+            current = get_path(document, path)
+            if operator in ("$set", "$setOnInsert"):
+                set_path(document, path, copy.deepcopy(value))
+            elif operator == "$unset":
+                unset_path(document, path)
+            elif operator == "$inc":
+                set_path(document, path, (0 if current is _MISSING else current) + value)
+            elif operator == "$min":
+                if current is _MISSING or value < current:
+                    set_path(document, path, value)
+            elif operator == "$max":
+                if current is _MISSING or value > current:
+                    set_path(document, path, value)
+            elif operator == "$push":
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                pushed = ([] if current is _MISSING else current) + copy.deepcopy(items)
+                if isinstance(value, dict) and "$slice" in value:
+                    limit = value["$slice"]
+                    pushed = pushed[limit:] if limit < 0 else pushed[:limit]
+                set_path(document, path, pushed)
+            elif operator == "$addToSet":
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                target = [] if current is _MISSING else current
+                target = target + [item for item in items if item not in target]
+                set_path(document, path, target)
+            elif operator == "$pull":
+                if current is not _MISSING:
+                    if isinstance(value, dict):
+                        kept = [item for item in current if not matches({"v": item}, {"v": value})]
+                    else:
+                        kept = [item for item in current if item != value]
+                    set_path(document, path, kept)
+            else:
+                raise UnsupportedOperation(f"Update operator {operator}")
+
+def project(document: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return document
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        result = {}
+        for path in include:
+            value = get_path(document, path)
+            if value is not _MISSING:
+                set_path(result, path, value)
+        if projection.get("_id", 1) and "_id" in document:
+            result["_id"] = document["_id"]
+        return result
+    result = copy.deepcopy(document)
+    for path, flag in projection.items():
+        if not flag:
+            unset_path(result, path)
+    return result
+
+class InMemoryIndex:
+    """Hash index on the leading key of an index spec"""
+
+    def __init__(self, name: str, keys: List, unique: bool = False, sparse: bool = False,
+                 partial_filter: Optional[dict] = None, options: Optional[dict] = None):
+        self.name = name
+        self.keys = keys
+        self.field = keys[0][0]
+        self.unique = unique
+        self.sparse = sparse
+        self.partial_filter = partial_filter
+        self.options = options or {}
+        self.buckets: Dict[Any, set] = {}
+
+    def covers(self, document: dict) -> bool:
+        if self.partial_filter is not None and not matches(document, self.partial_filter):
+            return False
+        if self.sparse and get_path(document, self.field) is _MISSING:
+            return False
+        return True
+
+    def _bucket_keys(self, document: dict) -> List[Any]:
+        value = get_path(document, self.field)
+        if value is _MISSING:
+            return [None]
+        if isinstance(value, list):
+            return [self._hashable(item) for item in value] or [None]
+        return [self._hashable(value)]
+
+    @staticmethod
+    def _hashable(value: Any) -> Any:
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            return repr(value)
+
+    def full_key(self, document: dict):
+        return tuple(self._hashable(get_path(document, field)) for field, _ in self.keys)
+
+    def add(self, document: dict):
+        if not self.covers(document):
+            return
+        for key in self._bucket_keys(document):
+            self.buckets.setdefault(key, set()).add(document["_id"])
+
+    def remove(self, document: dict):
+        for key in self._bucket_keys(document):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(document["_id"])
+                if not bucket:
+                    del self.buckets[key]
+
+    def lookup(self, condition: Any) -> Optional[set]:
+        """Candidate ids for a query condition on the leading field, or None if unusable"""
+        if isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+            if set(condition) == {"$eq"}:
+                condition = condition["$eq"]
+            elif set(condition) == {"$in"}:
+                ids = set()
+                for value in condition["$in"]:
+                    ids |= self.buckets.get(self._hashable(value), set())
+                return ids
+            else:
+                return None
+        if condition is None or isinstance(condition, list):
+            return None
+        return set(self.buckets.get(self._hashable(condition), set()))
+
+    def describe(self) -> dict:
+        document = {"v": 2, "key": dict(self.keys), "name": self.name}
+        if self.unique:
+            document["unique"] = True
+        if self.sparse:
+            document["sparse"] = True
+        if self.partial_filter is not None:
+            document["partialFilterExpression"] = self.partial_filter
+        document.update(self.options)
+        return document
+
+class InMemoryCursor:
+    def __init__(self, collection: "InMemoryCollection", query: Optional[dict], projection: Optional[dict] = None):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction: int = 1):
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def skip(self, count: int):
+        self._skip = count
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def _results(self) -> List[dict]:
+        documents = self.collection._find(self.query)
+        for field, direction in reversed(self._sort):
+            documents.sort(key=lambda doc: sort_key(get_path(doc, field)), reverse=direction < 0)
+        documents = documents[self._skip:]
+        if self._limit:
+            documents = documents[:self._limit]
+        return [project(copy.deepcopy(doc), self.projection) for doc in documents]
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        results = self._results()
+        return results if length is None else results[:length]
+
+    def __aiter__(self):
+        self._iter = iter(self._results())
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class InMemoryCommandCursor:
+    def __init__(self, documents: List[dict]):
+        self.documents = documents
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        return self.documents if length is None else self.documents[:length]
+
+    def __aiter__(self):
+        self._iter = iter(self.documents)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class InMemoryCollection:
+    def __init__(self, name: str):
+        self.name = name
+        self.documents: Dict[Any, dict] = {}
+        self.indexes: Dict[str, InMemoryIndex] = {}
+        # Insertion sequence, so index lookups return documents in natural order
+        self.sequence: Dict[Any, int] = {}
+        self.next_sequence = 0
+        self.last_ttl_pass = time.monotonic()
+
+    def __getattr__(self, name: str) -> "InMemoryCollection":
+        # Mirror Motor: attribute access on a collection names a sub-collection
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return InMemoryCollection(f"{self.name}.{name}")
+
+    # TTL
+    def expire_documents(self, now: Optional[datetime] = None) -> int:
+        """Delete documents whose TTL index date has passed, as mongod's TTL monitor does
+
+        A document expires expireAfterSeconds after the date in the indexed
+        field (the earliest one for arrays); documents without a date there
+        never expire.
+        """
+        now = now or datetime.utcnow()
+        self.last_ttl_pass = time.monotonic()
+        expired = {}
+        for index in self.indexes.values():
+            seconds = index.options.get("expireAfterSeconds")
+            if seconds is None:
+                continue
+            for document in self.documents.values():
+                if not index.covers(document):
+                    continue
+                value = get_path(document, index.field)
+                dates = [v for v in (value if isinstance(value, list) else [value]) if isinstance(v, datetime)]
+                if dates and min(dates) + timedelta(seconds=seconds) <= now:
+                    expired[document["_id"]] = document
+        for document in expired.values():
+            self._unstore(document)
+        return len(expired)
+
+    def _ttl_monitor(self):
+        if time.monotonic() - self.last_ttl_pass >= TTL_MONITOR_INTERVAL and any(
+            "expireAfterSeconds" in index.options for index in self.indexes.values()
+        ):
+            self.expire_documents()
+
+    # Query planning
+    def _find(self, query: dict) -> List[dict]:
+        self._ttl_monitor()
+        candidate_ids = None
+        for field, condition in query.items():
+            for index in self.indexes.values():
+                if index.field == field and index.partial_filter is None and not index.sparse:
+                    ids = index.lookup(condition)
+                    if ids is not None:
+                        candidate_ids = ids if candidate_ids is None else candidate_ids & ids
+                    break
+        if candidate_ids is None:
+            pool = self.documents.values()
+        else:
+            pool = (self.documents[i] for i in candidate_ids if i in self.documents)
+        results = [doc for doc in pool if matches(doc, query)]
+        if candidate_ids is not None:
+            # Preserve natural order like a collection scan would
+            results.sort(key=lambda doc: self.sequence[doc["_id"]])
+        return results
+
+    def _check_unique(self, document: dict, ignore_id: Any = _MISSING):
+        for index in self.indexes.values():
+            if not index.unique or not index.covers(document):
+                continue
+            key = index.full_key(document)
+            for key_part in index._bucket_keys(document):
+                for other_id in index.buckets.get(key_part, ()):
+                    if other_id != ignore_id and index.full_key(self.documents[other_id]) == key:
+                        raise duplicate_key(self.name, index.name)
+
+    def _store(self, document: dict):
+        check_encodable(document)
+        self.documents[document["_id"]] = document
+        self.sequence[document["_id"]] = self.next_sequence
+        self.next_sequence += 1
+        for index in self.indexes.values():
+            index.add(document)
+
+    def _unstore(self, document: dict):
+        for index in self.indexes.values():
+            index.remove(document)
+        del self.documents[document["_id"]]
+        del self.sequence[document["_id"]]
+
+    def _replace(self, old: dict, new: dict):
+        check_encodable(new)
+        self._check_unique(new, ignore_id=old["_id"])
+        for index in self.indexes.values():
+            index.remove(old)
+        self.documents[new["_id"]] = new
+        for index in self.indexes.values():
+            index.add(new)
+
+    # Reads
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None) -> InMemoryCursor:
+        return InMemoryCursor(self, query, projection)
+
+    async def find_one(self, query: Optional[dict] = None, projection: Optional[dict] = None, sort=None) -> Optional[dict]:
+        cursor = self.find(query, projection)
+        if sort:
+            cursor.sort(sort)
+        results = await cursor.limit(1).to_list(length=1)
+        return results[0] if results else None
+
+    async def count_documents(self, query: Optional[dict] = None) -> int:
+        return len(self._find(query or {}))
+
+    def aggregate(self, pipeline: List[dict]) -> InMemoryCommandCursor:
+        documents = [copy.deepcopy(doc) for doc in self._find({})]
+        for stage in pipeline:
+            (operator, spec), = stage.items()
+            if operator == "$match":
+                documents = [doc for doc in documents if matches(doc, spec)]
+            elif operator == "$group":
+                documents = self._group(documents, spec)
+            elif operator == "$sort":
+                for field, direction in reversed(list(spec.items())):
+                    documents.sort(key=lambda doc: sort_key(get_path(doc, field)), reverse=direction < 0)
+            elif operator == "$limit":
+                documents = documents[:spec]
+            elif operator == "$skip":
+                documents = documents[spec:]
+            elif operator == "$project":
+                documents = [project(doc, spec) for doc in documents]
+            else:
+                raise UnsupportedOperation(f"Aggregation stage {operator}")
+        return InMemoryCommandCursor(documents)
+
+    @staticmethod
+    def _expression(document: dict, expression: Any) -> Any:
+        if isinstance(expression, str) and expression.startswith("$"):
+            value = get_path(document, expression[1:])
+            return None if value is _MISSING else value
+        if isinstance(expression, dict):
+            return {k: InMemoryCollection._expression(document, v) for k, v in expression.items()}
+        return expression
+
+    def _group(self, documents: List[dict], spec: dict) -> List[dict]:
+        groups: Dict[Any, dict] = {}
+        for doc in documents:
+            group_id = self._expression(doc, spec["_id"])
+            key = repr(group_id)
+            group = groups.setdefault(key, {"_id": group_id, "_values": {}})
+            for field, accumulator in spec.items():
+                if field == "_id":
+                    continue
+                (operator, expression), = accumulator.items()
+                group["_values"].setdefault(field, (operator, []))[1].append(self._expression(doc, expression))
+
+        results = []
+        for group in groups.values():
+            result = {"_id": group["_id"]}
+            for field, (operator, values) in group["_values"].items():
+                numbers = [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+                if operator == "$sum":
+                    result[field] = sum(numbers)
+                elif operator == "$avg":
+                    result[field] = sum(numbers) / len(numbers) if numbers else None
+                elif operator == "$min":
+                    result[field] = min(numbers) if numbers else None
+                elif operator == "$max":
+                    result[field] = max(numbers) if numbers else None
+                elif operator == "$first":
+                    result[field] = values[0] if values else None
+                elif operator == "$last":
+                    result[field] = values[-1] if values else None
+                elif operator == "$push":
+                    result[field] = values
+                elif operator == "$addToSet":
+                    result[field] = [v for i, v in enumerate(values) if v not in values[:i]]
+                else:
+                    raise UnsupportedOperation(f"Accumulator {operator}")
+            results.append(result)
+        return results
+
+    # Writes
+    async def insert_one(self, document: dict):
+        document.setdefault("_id", ObjectId())
+        stored = copy.deepcopy(document)
+        if stored["_id"] in self.documents:
+            raise duplicate_key(self.name, "_id_")
+        self._check_unique(stored)
+        self._store(stored)
+        return SimpleNamespace(inserted_id=document["_id"], acknowledged=True)
+
+    async def insert_many(self, documents: List[dict], ordered: bool = True):
+        # The driver encodes the batch before sending it, so one bad document fails it whole
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+            check_encodable(document)
+        inserted_ids, write_errors = [], []
+        for position, document in enumerate(documents):
+            try:
+                result = await self.insert_one(document)
+                inserted_ids.append(result.inserted_id)
+            except DuplicateKeyError as e:
+                write_errors.append({"index": position, "code": e.code, "errmsg": str(e), "op": document})
+                if ordered:
+                    break
+        if write_errors:
+            raise bulk_write_error(write_errors, nInserted=len(inserted_ids))
+        return SimpleNamespace(inserted_ids=inserted_ids, acknowledged=True)
+
+    def _upsert_document(self, query: dict, update: dict) -> dict:
+        document = {
+            key: copy.deepcopy(value) for key, value in query.items()
+            if not key.startswith("$") and not (isinstance(value, dict) and any(k.startswith("$") for k in value))
+        }
+        apply_update(document, update, inserting=True)
+        document.setdefault("_id", ObjectId())
+        return document
+
+    async def _update(self, query: dict, update: dict, many: bool, upsert: bool):
+        targets = self._find(query)
+        if not many:
+            targets = targets[:1]
+        modified = 0
+        for old in targets:
+            new = copy.deepcopy(old)
+            apply_update(new, update)
+            if new != old:
+                self._replace(old, new)
+                modified += 1
+        upserted_id = None
+        if not targets and upsert:
+            document = self._upsert_document(query, update)
+            self._check_unique(document)
+            self._store(document)
+            upserted_id = document["_id"]
+        return SimpleNamespace(matched_count=len(targets), modified_count=modified,
+                               upserted_id=upserted_id, acknowledged=True)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        return await self._update(query, update, many=False, upsert=upsert)
+
+    async def update_many(self, query: dict, update: dict, upsert: bool = False):
+        return await self._update(query, update, many=True, upsert=upsert)
+
+    async def replace_one(self, query: dict, replacement: dict, upsert: bool = False):
+        targets = self._find(query)[:1]
+        if targets:
+            new = copy.deepcopy(replacement)
+            new["_id"] = targets[0]["_id"]
+            self._replace(targets[0], new)
+            return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None, acknowledged=True)
+        if upsert:
+            result = await self.insert_one(copy.deepcopy(replacement))
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=result.inserted_id, acknowledged=True)
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None, acknowledged=True)
+
+    async def find_one_and_update(self, query: dict, update: dict, projection: Optional[dict] = None,
+                                  sort=None, upsert: bool = False,
+                                  return_document: bool = ReturnDocument.BEFORE) -> Optional[dict]:
+        targets = self._find(query)
+        for field, direction in reversed(list(sort or [])):
+            targets.sort(key=lambda doc: sort_key(get_path(doc, field)), reverse=direction < 0)
+        if not targets:
+            if not upsert:
+                return None
+            document = self._upsert_document(query, update)
+            self._check_unique(document)
+            self._store(document)
+            return project(copy.deepcopy(document), projection) if return_document == ReturnDocument.AFTER else None
+        old = targets[0]
+        new = copy.deepcopy(old)
+        apply_update(new, update)
+        self._replace(old, new)
+        chosen = new if return_document == ReturnDocument.AFTER else old
+        return project(copy.deepcopy(chosen), projection)
+
+    async def find_one_and_delete(self, query: dict, projection: Optional[dict] = None, sort=None) -> Optional[dict]:
+        targets = self._find(query)
+        for field, direction in reversed(list(sort or [])):
+            targets.sort(key=lambda doc: sort_key(get_path(doc, field)), reverse=direction < 0)
+        if not targets:
+            return None
+        self._unstore(targets[0])
+        return project(targets[0], projection)
+
+    async def delete_one(self, query: dict):
+        targets = self._find(query)[:1]
+        for document in targets:
+            self._unstore(document)
+        return SimpleNamespace(deleted_count=len(targets), acknowledged=True)
+
+    async def delete_many(self, query: dict):
+        targets = self._find(query)
+        for document in targets:
+            self._unstore(document)
+        return SimpleNamespace(deleted_count=len(targets), acknowledged=True)
+
+    async def bulk_write(self, requests: List, ordered: bool = True):
+        inserted = matched = modified = deleted = 0
+        upserted, write_errors = [], []
+        for position, request in enumerate(requests):
+            kind = type(request).__name__
+            document = getattr(request, "_doc", None)
+            query = getattr(request, "_filter", None)
+            try:
+                if kind == "InsertOne":
+                    await self.insert_one(document)
+                    inserted += 1
+                elif kind in ("UpdateOne", "UpdateMany"):
+                    result = await self._update(query, document, many=kind == "UpdateMany",
+                                                upsert=bool(getattr(request, "_upsert", False)))
+                    matched += result.matched_count
+                    modified += result.modified_count
+                    if result.upserted_id is not None:
+                        upserted.append({"index": position, "_id": result.upserted_id})
+                elif kind == "ReplaceOne":
+                    result = await self.replace_one(query, document, upsert=bool(getattr(request, "_upsert", False)))
+                    matched += result.matched_count
+                    modified += result.modified_count
+                elif kind in ("DeleteOne", "DeleteMany"):
+                    result = await (self.delete_one(query) if kind == "DeleteOne" else self.delete_many(query))
+                    deleted += result.deleted_count
+                else:
+                    raise UnsupportedOperation(f"Bulk operation {kind}")
+            except DuplicateKeyError as e:
+                write_errors.append({"index": position, "code": e.code, "errmsg": str(e), "op": document})
+                if ordered:
+                    break
+        if write_errors:
+            raise bulk_write_error(write_errors, nInserted=inserted, nUpserted=len(upserted), nMatched=matched,
+                                   nModified=modified, nRemoved=deleted, upserted=upserted)
+        return SimpleNamespace(inserted_count=inserted, matched_count=matched, modified_count=modified,
+                               deleted_count=deleted, upserted_count=len(upserted),
+                               upserted_ids={entry["index"]: entry["_id"] for entry in upserted}, acknowledged=True)
+
+    # Indexes
+    async def create_index(self, keys, name: Optional[str] = None, unique: bool = False, sparse: bool = False,
+                           partialFilterExpression: Optional[dict] = None, **options) -> str:
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = list(keys)
+        name = name or "_".join(f"{field}_{direction}" for field, direction in keys)
+        options.pop("background", None)
+        index = InMemoryIndex(name, keys, unique, sparse, partialFilterExpression, options)
+        for document in self.documents.values():
+            if index.unique and index.covers(document):
+                key = index.full_key(document)
+                for key_part in index._bucket_keys(document):
+                    for other_id in index.buckets.get(key_part, ()):
+                        if index.full_key(self.documents[other_id]) == key:
+                            raise duplicate_key(self.name, name)
+            index.add(document)
+        self.indexes[name] = index
+        return name
+
+    async def create_indexes(self, models: List) -> List[str]:
+        names = []
+        for model in models:
+            spec = dict(model.document)
+            keys = list(spec.pop("key").items())
+            names.append(await self.create_index(keys, **spec))
+        return names
+
+    async def drop_index(self, name: str):
+        self.indexes.pop(name, None)
+
+    def list_indexes(self) -> InMemoryCommandCursor:
+        documents = [{"v": 2, "key": {"_id": 1}, "name": "_id_"}]
+        documents += [index.describe() for index in self.indexes.values()]
+        return InMemoryCommandCursor(documents)
+
+class InMemoryDatabase:
+    def __init__(self, name: str):
+        self.name = name
+        self.collections: Dict[str, InMemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> InMemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = InMemoryCollection(name)
+        return self.collections[name]
+
+    def __getattr__(self, name: str) -> InMemoryCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def list_collection_names(self) -> List[str]:
+        return [name for name, collection in self.collections.items() if collection.documents]
+
+    async def command(self, command, *args, **kwargs) -> dict:
+        if command == "ping" or (isinstance(command, dict) and "ping" in command):
+            return {"ok": 1.0}
+        raise UnsupportedOperation(f"Command {command}")
+
+class InMemoryClient:
+    """Drop-in for AsyncIOMotorClient backed by process memory"""
+
+    def __init__(self, *args, **kwargs):
+        self.databases: Dict[str, InMemoryDatabase] = {}
+        self.admin = InMemoryDatabase("admin")
+
+    def __getitem__(self, name: str) -> InMemoryDatabase:
+        if name not in self.databases:
+            self.databases[name] = InMemoryDatabase(name)
+        return self.databases[name]
+
+    async def drop_database(self, name_or_database):
+        name = getattr(name_or_database, "name", name_or_database)
+        self.databases.pop(name, None)
+
+    def close(self):
+        pass
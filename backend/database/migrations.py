@@ -0,0 +1,381 @@
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from typing import Dict
+from datetime import datetime
+import asyncio
+import logging
+
+from game.buildings import BuildingSystem
+from game.shop_catalog import shop_catalog
+from game.world_map import WorldMap
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+async def migrate_buildings_to_map(database, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """Convert legacy building lists into the compact {type: {level, constructing}} map
+
+    Streams players whose buildings are still stored as an array and rewrites
+    them in bulk batches. Each write is conditional on the document still
+    holding an array, so the migration is idempotent and safe to re-run or to
+    run while the server is up.
+    """
+    migrated_players = 0
+    batch = []
+
+    cursor = database.players.find(
+        {"buildings": {"$type": "array"}},
+        {"buildings": 1}
+    )
+    async for player in cursor:
+        batch.append(UpdateOne(
+            {"_id": player["_id"], "buildings": {"$type": "array"}},
+            {"$set": {"buildings": BuildingSystem.normalize_buildings(player["buildings"])}}
+        ))
+        if len(batch) >= batch_size:
+            result = await database.players.bulk_write(batch, ordered=False)
+            migrated_players += result.modified_count
+            batch = []
+    if batch:
+        result = await database.players.bulk_write(batch, ordered=False)
+        migrated_players += result.modified_count
+
+    # Pending construction items referenced buildings by their old uuid;
+    # the building type is now the building id
+    migrated_queue_items = 0
+    batch = []
+    cursor = database.construction_queue.find(
+        {"completed": False},
+        {"buildingId": 1, "buildingType": 1}
+    )
+    async for item in cursor:
+        if item.get("buildingId") == item.get("buildingType"):
+            continue
+        batch.append(UpdateOne({"_id": item["_id"]}, {"$set": {"buildingId": item["buildingType"]}}))
+        if len(batch) >= batch_size:
+            result = await database.construction_queue.bulk_write(batch, ordered=False)
+            migrated_queue_items += result.modified_count
+            batch = []
+    if batch:
+        result = await database.construction_queue.bulk_write(batch, ordered=False)
+        migrated_queue_items += result.modified_count
+
+    if migrated_players or migrated_queue_items:
+        logger.info(f"Migrated buildings for {migrated_players} players and {migrated_queue_items} queue items")
+
+    return {"players": migrated_players, "queueItems": migrated_queue_items}
+
+async def migrate_assign_world_slots(database, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """Give every player a claimed castle slot on the world map
+
+    Players used to be created at {x: 0, y: 0}. A player already sitting on a
+    free slot keeps it; everyone else (all legacy players at the origin) gets
+    the next free slot from the centre. Players whose slot claim matches are
+    skipped, so re-running the migration is a no-op.
+    """
+    world_map = WorldMap()
+    claims = {}
+    async for claim in database.world_slots.find({}, {"username": 1}):
+        claims[claim["_id"]] = claim.get("username")
+        sx, sy = claim["_id"].split(":")
+        world_map.mark_occupied((int(sx), int(sy)))
+
+    async def claim(slot, username: str) -> bool:
+        try:
+            await database.world_slots.insert_one({
+                "_id": WorldMap.slot_key(slot), "username": username, "claimedAt": datetime.utcnow()
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+
+    migrated_players = 0
+    batch = []
+    async for player in database.players.find({}, {"username": 1, "coordinates": 1}):
+        coordinates = player.get("coordinates") or {"x": 0, "y": 0}
+        slot = world_map.slot_of(coordinates)
+        if slot is not None and claims.get(WorldMap.slot_key(slot)) == player["username"]:
+            continue
+        if slot is not None and slot != (0, 0) and slot not in world_map.occupied and await claim(slot, player["username"]):
+            world_map.mark_occupied(slot)
+            continue
+
+        slot = world_map.allocate()
+        while not await claim(slot, player["username"]):
+            slot = world_map.allocate()
+        batch.append(UpdateOne(
+            {"_id": player["_id"]},
+            {"$set": {"coordinates": world_map.coordinates_of(slot)}}
+        ))
+        if len(batch) >= batch_size:
+            result = await database.players.bulk_write(batch, ordered=False)
+            migrated_players += result.modified_count
+            batch = []
+    if batch:
+        result = await database.players.bulk_write(batch, ordered=False)
+        migrated_players += result.modified_count
+
+    if migrated_players:
+        logger.info(f"Placed {migrated_players} players on the world map")
+
+    return {"players": migrated_players}
+
+async def migrate_escrow_trade_offers(database, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """Escrow the offered resources of open offers created before escrow existed
+
+    Each offer is first marked escrowed with a conditional write, so a re-run
+    never debits twice; an offer whose creator can no longer cover it is
+    closed instead.
+    """
+    escrowed = closed = 0
+    cursor = database.trade_offers.find(
+        {"active": True, "escrowed": {"$exists": False}},
+        {"creatorUsername": 1, "offering": 1}
+    )
+    async for offer in cursor:
+        claim = await database.trade_offers.update_one(
+            {"_id": offer["_id"], "escrowed": {"$exists": False}}, {"$set": {"escrowed": True}}
+        )
+        if claim.modified_count == 0:
+            continue
+
+        query = {"username": offer["creatorUsername"]}
+        for resource, amount in offer["offering"].items():
+            query[f"resources.{resource}"] = {"$gte": amount}
+        result = await database.players.update_one(query, {"$inc": {
+            **{f"resources.{resource}": -amount for resource, amount in offer["offering"].items()},
+            "version": 1
+        }})
+        if result.modified_count:
+            escrowed += 1
+        else:
+            await database.trade_offers.update_one(
+                {"_id": offer["_id"]}, {"$set": {"active": False, "escrowed": False}}
+            )
+            closed += 1
+
+    if escrowed or closed:
+        logger.info(f"Escrowed {escrowed} legacy trade offers, closed {closed} that could not be covered")
+
+    return {"escrowed": escrowed, "closed": closed}
+
+async def migrate_backfill_alliance_ids(database, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """Copy alliance membership onto players as allianceId
+
+    Members of each alliance get its id with one update_many; players left
+    pointing at an alliance that no longer lists them are cleared. Both
+    writes only touch documents that disagree, so re-runs are no-ops.
+    """
+    assigned = 0
+    members_of: Dict[str, set] = {}
+    async for alliance in database.alliances.find({}, {"members": 1}):
+        alliance_id = str(alliance["_id"])
+        members = alliance.get("members", [])
+        members_of[alliance_id] = set(members)
+        for start in range(0, len(members), batch_size):
+            result = await database.players.update_many(
+                {"username": {"$in": members[start:start + batch_size]}, "allianceId": {"$ne": alliance_id}},
+                {"$set": {"allianceId": alliance_id}, "$inc": {"version": 1}}
+            )
+            assigned += result.modified_count
+
+    cleared = 0
+    batch = []
+    cursor = database.players.find({"allianceId": {"$ne": None}}, {"username": 1, "allianceId": 1})
+    async for player in cursor:
+        if player["username"] in members_of.get(player["allianceId"], ()):
+            continue
+        batch.append(UpdateOne(
+            {"_id": player["_id"], "allianceId": player["allianceId"]},
+            {"$set": {"allianceId": None}, "$inc": {"version": 1}}
+        ))
+        if len(batch) >= batch_size:
+            result = await database.players.bulk_write(batch, ordered=False)
+            cleared += result.modified_count
+            batch = []
+    if batch:
+        result = await database.players.bulk_write(batch, ordered=False)
+        cleared += result.modified_count
+
+    if assigned or cleared:
+        logger.info(f"Backfilled allianceId on {assigned} players, cleared {cleared} stale ones")
+
+    return {"assigned": assigned, "cleared": cleared}
+
+async def migrate_alliance_aggregates(database, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """Recompute every alliance's memberCount, totalPower and empires from its members
+
+    One $group over players by (allianceId, empire) gives all the numbers;
+    alliances are only rewritten where a stored aggregate differs, so this
+    doubles as a repair for drift between incremental updates.
+    """
+    aggregates: Dict[str, Dict] = {}
+    cursor = database.players.aggregate([
+        {"$match": {"allianceId": {"$ne": None}}},
+        {"$group": {
+            "_id": {"alliance": "$allianceId", "empire": "$empire"},
+            "members": {"$sum": 1},
+            "power": {"$sum": "$power"}
+        }}
+    ])
+    async for group in cursor:
+        aggregate = aggregates.setdefault(group["_id"]["alliance"], {"memberCount": 0, "totalPower": 0, "empires": {}})
+        aggregate["memberCount"] += group["members"]
+        aggregate["totalPower"] += group["power"]
+        empire = group["_id"].get("empire") or "unknown"
+        aggregate["empires"][empire] = aggregate["empires"].get(empire, 0) + group["members"]
+
+    updated = 0
+    batch = []
+    async for alliance in database.alliances.find({}, {"memberCount": 1, "totalPower": 1, "empires": 1}):
+        aggregate = aggregates.get(str(alliance["_id"]), {"memberCount": 0, "totalPower": 0, "empires": {}})
+        stored = {field: alliance.get(field) for field in aggregate}
+        stored["empires"] = {empire: count for empire, count in (stored["empires"] or {}).items() if count}
+        if stored == aggregate:
+            continue
+        batch.append(UpdateOne({"_id": alliance["_id"]}, {"$set": aggregate}))
+        if len(batch) >= batch_size:
+            result = await database.alliances.bulk_write(batch, ordered=False)
+            updated += result.modified_count
+            batch = []
+    if batch:
+        result = await database.alliances.bulk_write(batch, ordered=False)
+        updated += result.modified_count
+
+    if updated:
+        logger.info(f"Recomputed aggregates of {updated} alliances")
+
+    return {"alliances": updated}
+
+async def migrate_dedupe_pending_invites(database, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """Decline all but the newest pending invite of each (alliance, player)
+
+    Duplicates were possible before the one_pending_invite unique index;
+    once they are gone the index can be built on the next start.
+    """
+    declined = 0
+    cursor = database.alliance_invites.aggregate([
+        {"$match": {"status": "pending"}},
+        {"$sort": {"createdAt": -1}},
+        {"$group": {
+            "_id": {"alliance": "$allianceId", "player": "$toUsername"},
+            "invites": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ])
+    async for group in cursor:
+        stale = group["invites"][1:]
+        for start in range(0, len(stale), batch_size):
+            result = await database.alliance_invites.update_many(
+                {"_id": {"$in": stale[start:start + batch_size]}, "status": "pending"},
+                {"$set": {"status": "declined", "declinedAt": datetime.utcnow()}}
+            )
+            declined += result.modified_count
+
+    if declined:
+        logger.info(f"Declined {declined} duplicate pending alliance invites")
+
+    return {"declined": declined}
+
+async def migrate_canonical_inventory_ids(database, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """Fold inventory counts stored under legacy shop item ids into the catalog ids
+
+    The two old shops used different ids for the same items; only inventories
+    still holding a legacy key are read, so re-runs find nothing to do.
+    """
+    migrated = 0
+    batch = []
+    cursor = database.players.find(
+        {"$or": [{f"inventory.{alias}": {"$exists": True}} for alias in shop_catalog.aliases]},
+        {"inventory": 1}
+    )
+    async for player in cursor:
+        inventory = dict(player["inventory"])
+        for alias, item_id in shop_catalog.aliases.items():
+            if alias in inventory:
+                inventory[item_id] = inventory.get(item_id, 0) + inventory.pop(alias)
+        batch.append(UpdateOne({"_id": player["_id"]}, {"$set": {"inventory": inventory}}))
+        if len(batch) >= batch_size:
+            result = await database.players.bulk_write(batch, ordered=False)
+            migrated += result.modified_count
+            batch = []
+    if batch:
+        result = await database.players.bulk_write(batch, ordered=False)
+        migrated += result.modified_count
+
+    return {"players": migrated}
+
+async def migrate_inventory_collection(database, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """Move item counts embedded in players into the inventory collection
+
+    Counts are written with $max on the (playerId, itemId) document before
+    the embedded copy is unset, so a run interrupted in between moves them
+    again without double counting.
+    """
+    moved = 0
+    async for player in database.players.find({"inventory": {"$exists": True}}, {"inventory": 1, "userId": 1}):
+        items: Dict[str, int] = {}
+        for key, count in (player["inventory"] or {}).items():
+            item = shop_catalog.get(key)
+            item_id = item["id"] if item else key
+            items[item_id] = items.get(item_id, 0) + count
+        updates = [
+            UpdateOne({"playerId": player["userId"], "itemId": item_id},
+                      {"$max": {"quantity": count}, "$setOnInsert": {"updatedAt": datetime.utcnow()}}, upsert=True)
+            for item_id, count in items.items() if count > 0
+        ]
+        for start in range(0, len(updates), batch_size):
+            await database.inventory.bulk_write(updates[start:start + batch_size], ordered=False)
+        await database.players.update_one({"_id": player["_id"]}, {"$unset": {"inventory": ""}})
+        moved += 1
+
+    if moved:
+        logger.info(f"Moved the inventories of {moved} players to the inventory collection")
+
+    return {"players": moved}
+
+MIGRATIONS = [
+    ("buildings_to_map", migrate_buildings_to_map),
+    ("assign_world_slots", migrate_assign_world_slots),
+    ("escrow_trade_offers", migrate_escrow_trade_offers),
+    ("backfill_alliance_ids", migrate_backfill_alliance_ids),
+    ("alliance_aggregates", migrate_alliance_aggregates),
+    ("dedupe_pending_invites", migrate_dedupe_pending_invites),
+    ("canonical_inventory_ids", migrate_canonical_inventory_ids),
+    ("inventory_collection", migrate_inventory_collection),
+]
+
+async def run_migrations(database) -> Dict[str, Dict]:
+    """Run every data migration in order; each one is idempotent"""
+    results = {}
+    for name, migration in MIGRATIONS:
+        results[name] = await migration(database)
+    return results
+
+async def main(argv=None):
+    """Run data migrations out-of-band"""
+    import argparse
+    import os
+    from pathlib import Path
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Run Medieval Empires data migrations")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    load_dotenv(Path(__file__).parent.parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    database = client[os.environ.get('DB_NAME', 'medieval_empires')]
+
+    try:
+        for name, migration in MIGRATIONS:
+            result = await migration(database, batch_size=args.batch_size)
+            print(f"{name}: {result}")
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
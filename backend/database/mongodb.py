@@ -1,28 +1,106 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from contextlib import asynccontextmanager
+import bson
+from bson import ObjectId
+from bson.errors import InvalidDocument
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError, DuplicateKeyError
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict
+from typing import Callable, Optional, List, Dict, Tuple
+import asyncio
 import os
+import uuid
 import logging
 
+from database.indexes import ensure_indexes
+from database.migrations import run_migrations
+from game.alliance_chat import AllianceChat
+from game.alliance_rankings import AllianceRankings
+from game.combat import CombatSystem
+from game.market import Market
+from game.price_index import PriceIndex
+from game.world_map import WorldMap
+from game.world_tiles import WorldTiles
+
 logger = logging.getLogger(__name__)
 
+# Buffered raid records are written once this many are pending, or by the periodic flush
+RAID_FLUSH_BATCH_SIZE = 200
+
+# A worker holds the order books for at most MARKET_LOCK_TTL, and waits up to
+# MARKET_LOCK_WAIT for another worker to hand them over
+MARKET_LOCK_TTL = timedelta(seconds=10)
+MARKET_LOCK_WAIT = timedelta(seconds=5)
+
+# How long a shop idempotency key is remembered; a retry after that buys again
+SHOP_ORDER_TTL = timedelta(hours=24)
+
+# A pending shop order not completed within SHOP_ORDER_CLAIM_TIMEOUT was
+# abandoned by its worker, and a retry of the same purchase takes it over.
+# Players and inventory rows remember their last SHOP_ORDER_LEDGER_SIZE
+# orders so a taken-over purchase never charges or grants twice.
+SHOP_ORDER_CLAIM_TIMEOUT = timedelta(minutes=1)
+SHOP_ORDER_LEDGER_SIZE = 50
+
+# Players remember their last TRADE_LEDGER_SIZE trade payments ("<offer id>:paid"
+# for the acceptor, "<offer id>:sold" for the creator) so settling an accepted
+# offer again never moves resources twice
+TRADE_LEDGER_SIZE = 50
+
+class VersionConflictError(Exception):
+    """A versioned player update kept losing to concurrent writers"""
+
 class MongoDB:
     def __init__(self):
         self.client = None
         self.db = None
+        self.concurrency_stats = {"attempts": 0, "conflicts": 0, "exhausted": 0}
+        self.pending_raids: List[dict] = []
+        self._raid_flush_running = False
+        self._raid_flush_task = None
+        self.world_map = WorldMap()
+        self.world_tiles = WorldTiles()
+        self.market = Market()
+        self.market_seq = None
+        self._market_lock = asyncio.Lock()
+        self._market_state_ready = False
+        self.price_index = PriceIndex()
+        self.alliance_rankings = AllianceRankings()
+        self.alliance_chat = AllianceChat()
+        self._alliance_chat_flush_running = False
+        self.pending_shop_purchases: List[dict] = []
+        self._shop_purchase_flush_running = False
 
     async def connect_to_mongo(self):
         """Create database connection"""
         try:
-            self.client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+            if os.environ.get('DB_BACKEND', 'mongo').lower() == 'memory':
+                # Hermetic in-process backend for tests and benchmarks
+                from database.memory import InMemoryClient
+                self.client = InMemoryClient()
+            else:
+                self.client = AsyncIOMotorClient(os.environ['MONGO_URL'])
             self.db = self.client[os.environ.get('DB_NAME', 'medieval_empires')]
             
             # Test connection
             await self.client.admin.command('ping')
             logger.info("Connected to MongoDB successfully")
             
-            # Create indexes
-            await self.create_indexes()
+            # Create missing indexes, unless they are managed out-of-band
+            # with `python -m database.indexes --apply`
+            if os.environ.get('MANAGE_INDEXES_ON_STARTUP', 'true').lower() != 'false':
+                await self.create_indexes()
+            
+            # Bring legacy documents up to the current schema
+            if os.environ.get('RUN_MIGRATIONS_ON_STARTUP', 'true').lower() != 'false':
+                await run_migrations(self.db)
+            
+            await self.load_world_map()
+            await self.load_market()
+            await self.load_price_index()
+            await self.load_alliance_chat()
+            self.alliance_rankings = AllianceRankings()
+            await self.refresh_alliance_rankings()
             
         except Exception as e:
             logger.error(f"Failed to connect to MongoDB: {e}")
@@ -31,55 +109,235 @@ class MongoDB:
     async def close_mongo_connection(self):
         """Close database connection"""
         if self.client:
+            await self.flush_raid_results()
+            await self.checkpoint_price_index()
+            await self.flush_alliance_messages()
+            await self.flush_shop_purchases()
             self.client.close()
             logger.info("Disconnected from MongoDB")
 
-    async def create_indexes(self):
-        """Create database indexes for better performance"""
+    async def create_indexes(self, drop_obsolete: bool = False):
+        """Create any indexes from the manifest that the database is missing"""
         try:
-            # Users collection indexes
-            await self.db.users.create_index("username", unique=True)
-            await self.db.users.create_index("email", unique=True, sparse=True)
-            
-            # Players collection indexes
-            await self.db.players.create_index("userId", unique=True)
-            await self.db.players.create_index("username", unique=True)
-            await self.db.players.create_index("power", background=True)
-            await self.db.players.create_index("empire", background=True)
-            await self.db.players.create_index("lastActive", background=True)
-            
-            # Chat messages indexes
-            await self.db.chat_messages.create_index("timestamp", background=True)
-            await self.db.chat_messages.create_index("username", background=True)
-            await self.db.private_messages.create_index([("sender", 1), ("receiver", 1)], background=True)
-            await self.db.private_messages.create_index("timestamp", background=True)
-            
-            # Construction queue indexes
-            await self.db.construction_queue.create_index("playerId", background=True)
-            await self.db.construction_queue.create_index("completionTime", background=True)
-            await self.db.construction_queue.create_index("completed", background=True)
-            
-            # Raids indexes
-            await self.db.raids.create_index("attackerId", background=True)
-            await self.db.raids.create_index("defenderId", background=True)
-            await self.db.raids.create_index("timestamp", background=True)
-            
-            # Trade offers indexes
-            await self.db.trade_offers.create_index("creatorId", background=True)
-            await self.db.trade_offers.create_index("active", background=True)
-            await self.db.trade_offers.create_index("expiresAt", background=True)
-            
-            # Alliances indexes
-            await self.db.alliances.create_index("leaderId", background=True)
-            await self.db.alliances.create_index("name", unique=True)
-            await self.db.alliance_invites.create_index("toUserId", background=True)
-            await self.db.alliance_invites.create_index("status", background=True)
-            
-            logger.info("Database indexes created successfully")
+            result = await ensure_indexes(self.db, drop_obsolete=drop_obsolete)
+            if result["created"] or result["dropped"]:
+                logger.info(f"Database indexes updated: {result['created']} created, {result['dropped']} dropped")
             
         except Exception as e:
             logger.error(f"Failed to create indexes: {e}")
 
+    # World Map
+    async def load_world_map(self):
+        """Load slot claims, player positions and alliances into the in-memory world map"""
+        self.world_map = WorldMap()
+        self.world_tiles = WorldTiles()
+        async for claim in self.db.world_slots.find({}, {"_id": 1}):
+            sx, sy = claim["_id"].split(":")
+            self.world_map.mark_occupied((int(sx), int(sy)))
+        cursor = self.db.players.find({}, {"username": 1, "kingdomName": 1, "empire": 1,
+                                           "coordinates": 1, "power": 1, "lastRaidTime": 1})
+        players = await cursor.to_list(length=None)
+        self.world_map.sync(players)
+        for player in players:
+            self.world_tiles.place(player)
+        async for alliance in self.db.alliances.find({}, {"name": 1, "members": 1}):
+            self.world_tiles.add_alliance(str(alliance["_id"]), alliance["name"], alliance.get("members", []))
+
+    async def claim_world_slot(self, username: str) -> Dict[str, int]:
+        """Reserve the free castle slot closest to the map centre and return its coordinates
+
+        The world_slots claim is the source of truth across server processes:
+        a slot another process took first fails on its _id and the next one is tried.
+        """
+        while True:
+            slot = self.world_map.allocate()
+            try:
+                await self.db.world_slots.insert_one({
+                    "_id": WorldMap.slot_key(slot),
+                    "username": username,
+                    "claimedAt": datetime.utcnow()
+                })
+                return self.world_map.coordinates_of(slot)
+            except DuplicateKeyError:
+                continue
+
+    async def release_world_slot(self, player: dict):
+        """Free a deleted player's castle slot"""
+        self.world_map.remove(player["username"])
+        self.world_tiles.remove(player["username"])
+        slot = self.world_map.slot_of(player.get("coordinates") or {})
+        if slot is None:
+            return
+        await self.db.world_slots.delete_one({"_id": WorldMap.slot_key(slot), "username": player["username"]})
+        self.world_map.release(slot)
+
+    # Market
+    async def load_market(self):
+        """Rebuild the in-memory order books from the open orders"""
+        async with self.market_transaction(changes=False, reload=True):
+            pass
+
+    async def sync_market(self):
+        """Reload the books if another worker changed them, or died holding them"""
+        state = await self.db.market_state.find_one({"_id": "books"})
+        if state is None or state["seq"] != self.market_seq or \
+                (state["lock"] is not None and state["lockedUntil"] <= datetime.utcnow()):
+            await self.load_market()
+
+    async def _reload_market(self, seq: int):
+        market = Market()
+        await self.apply_market_settlements()
+        cursor = self.db.market_orders.find({"status": "open"}).sort("createdAt", 1)
+        market.load(await cursor.to_list(length=None))
+        self.market, self.market_seq = market, seq
+
+    @asynccontextmanager
+    async def market_transaction(self, changes: bool = True, reload: bool = False):
+        """Hold the order books exclusively, across workers
+        
+        Every worker keeps its own copy of the books, so changes go through a
+        lease on the market_state document. Its sequence number moves with
+        each change; a worker whose copy is behind, or that takes over from a
+        holder who never released the lease, reloads the books first. If the
+        body fails the books are reloaded too, as they may no longer match
+        the collection.
+        """
+        async with self._market_lock:
+            if not self._market_state_ready:
+                await self.db.market_state.update_one(
+                    {"_id": "books"},
+                    {"$setOnInsert": {"seq": 0, "lock": None, "lockedUntil": datetime.utcnow()}},
+                    upsert=True
+                )
+                self._market_state_ready = True
+            
+            token = ObjectId()
+            deadline = datetime.utcnow() + MARKET_LOCK_WAIT
+            while True:
+                now = datetime.utcnow()
+                previous = await self.db.market_state.find_one_and_update(
+                    {"_id": "books", "lockedUntil": {"$lte": now}},
+                    {"$set": {"lock": token, "lockedUntil": now + MARKET_LOCK_TTL}}
+                )
+                if previous is not None:
+                    break
+                if now >= deadline:
+                    raise TimeoutError("Timed out waiting for another worker to release the order books")
+                await asyncio.sleep(0.05)
+            
+            seq = previous["seq"]
+            try:
+                if reload or previous["lock"] is not None or seq != self.market_seq:
+                    await self._reload_market(seq)
+                yield self.market
+            except BaseException:
+                changes = True
+                try:
+                    await self._reload_market(seq)
+                except Exception as e:
+                    logger.error(f"Failed to reload the order books: {e}")
+                    self.market_seq = None
+                raise
+            finally:
+                await self.db.market_state.update_one(
+                    {"_id": "books", "lock": token},
+                    {"$set": {"lock": None, "lockedUntil": datetime.utcnow()}, "$inc": {"seq": 1 if changes else 0}}
+                )
+                if self.market_seq is not None:
+                    self.market_seq = seq + (1 if changes else 0)
+
+    async def settle_market(self, orders: List[dict], credits: Dict[str, Dict[str, int]]):
+        """Persist the order updates and player credits of a match or cancellation
+        
+        The settlement is stored as one document before it is applied, and
+        applying it is idempotent, so one interrupted halfway is finished by
+        the next reload of the books instead of losing credits.
+        """
+        settlement = {
+            "_id": ObjectId(),
+            "orders": [
+                {"id": order["id"], "remaining": order["remaining"], "escrow": order["escrow"], "status": order["status"]}
+                for order in orders
+            ],
+            "credits": [
+                {"username": username, "resources": amounts}
+                for username, amounts in credits.items() if any(amounts.values())
+            ],
+            "createdAt": datetime.utcnow()
+        }
+        await self.db.market_settlements.insert_one(settlement)
+        await self._apply_market_settlement(settlement)
+
+    async def _apply_market_settlement(self, settlement: dict):
+        settlement_id = str(settlement["_id"])
+        if settlement["orders"]:
+            await self.db.market_orders.bulk_write([
+                UpdateOne({"id": order["id"]}, {"$set": {
+                    "remaining": order["remaining"],
+                    "escrow": order["escrow"],
+                    "status": order["status"],
+                    "updatedAt": datetime.utcnow()
+                }})
+                for order in settlement["orders"]
+            ], ordered=False)
+        if settlement["credits"]:
+            # Players remember the settlement while it is applied, so a retry credits nobody twice
+            await self.db.players.bulk_write([
+                UpdateOne({"username": credit["username"], "marketSettlements": {"$ne": settlement_id}}, {
+                    "$inc": {**{f"resources.{resource}": amount for resource, amount in credit["resources"].items()},
+                             "version": 1},
+                    "$push": {"marketSettlements": settlement_id}
+                })
+                for credit in settlement["credits"]
+            ], ordered=False)
+            await self.db.players.bulk_write([
+                UpdateOne({"username": credit["username"]}, {"$pull": {"marketSettlements": settlement_id}})
+                for credit in settlement["credits"]
+            ], ordered=False)
+        await self.db.market_settlements.delete_one({"_id": settlement["_id"]})
+
+    async def apply_market_settlements(self) -> int:
+        """Finish settlements a failed request or a crashed worker left behind"""
+        cursor = self.db.market_settlements.find({}).sort("createdAt", 1)
+        settlements = await cursor.to_list(length=None)
+        for settlement in settlements:
+            await self._apply_market_settlement(settlement)
+        if settlements:
+            logger.warning(f"Finished {len(settlements)} interrupted market settlements")
+        return len(settlements)
+
+    async def load_price_index(self):
+        """Reload the rolling price statistics from their last checkpoint"""
+        self.price_index = PriceIndex()
+        cursor = self.db.market_prices.find({"pair": {"$in": list(self.market.books)}, "window": "last"})
+        self.price_index.restore(await cursor.to_list(length=None))
+        cursor = self.db.market_prices.find(
+            {"bucketStart": {"$gte": datetime.utcnow() - PriceIndex.retention()}}
+        ).sort("bucketStart", 1)
+        self.price_index.restore([
+            document for document in await cursor.to_list(length=None) if document["window"] != "last"
+        ])
+
+    def record_trade(self, pair: str, price: float, quantity: int):
+        """Feed a settled trade into the price index"""
+        self.price_index.record(pair, price, quantity)
+
+    async def checkpoint_price_index(self) -> int:
+        """Upsert the price buckets touched since the last checkpoint"""
+        documents = self.price_index.checkpoint_documents()
+        if not documents:
+            return 0
+        await self.db.market_prices.bulk_write([
+            UpdateOne(
+                {"pair": document["pair"], "window": document["window"]} if document["window"] == "last"
+                else {"pair": document["pair"], "window": document["window"], "bucketStart": document["bucketStart"]},
+                {"$set": document},
+                upsert=True
+            )
+            for document in documents
+        ], ordered=False)
+        return len(documents)
+
     # User Management
     async def create_user(self, user_data: dict) -> str:
         """Create a new user"""
@@ -133,6 +391,8 @@ class MongoDB:
         """Create a new player profile"""
         try:
             result = await self.db.players.insert_one(player_data)
+            self.world_map.place(player_data)
+            self.world_tiles.place(player_data)
             return str(result.inserted_id)
         except Exception as e:
             logger.error(f"Failed to create player: {e}")
@@ -168,14 +428,205 @@ class MongoDB:
         """Update player data"""
         try:
             update_data['lastActive'] = datetime.utcnow()
+            # Every write bumps the version so concurrent versioned writers notice it
             await self.db.players.update_one(
                 {"username": username},
-                {"$set": update_data}
+                {"$set": update_data, "$inc": {"version": 1}}
             )
+            self.world_map.update(username, update_data)
+            self.world_tiles.update(username, update_data)
         except Exception as e:
             logger.error(f"Failed to update player: {e}")
             raise
 
+    async def update_player_if_version(self, player: dict, update_data: dict) -> bool:
+        """Update player data only if nobody else wrote it since `player` was read"""
+        expected_version = player.get("version", 0)
+        # Documents created before versioning have no field; treat that as version 0
+        version_filter = expected_version if expected_version else {"$in": [0, None]}
+        
+        update_data['lastActive'] = datetime.utcnow()
+        result = await self.db.players.update_one(
+            {"username": player["username"], "version": version_filter},
+            {"$set": update_data, "$inc": {"version": 1}}
+        )
+        
+        self.concurrency_stats["attempts"] += 1
+        if result.matched_count == 0:
+            self.concurrency_stats["conflicts"] += 1
+            return False
+        self.world_map.update(player["username"], update_data)
+        self.world_tiles.update(player["username"], update_data)
+        return True
+
+    async def modify_player(self, player: dict, build_update: Callable[[dict], dict],
+                            max_attempts: int = 3) -> dict:
+        """Read-modify-write a player under optimistic concurrency control
+        
+        `build_update` computes the $set payload from a player snapshot and may
+        raise to abort (e.g. insufficient resources). On a version conflict the
+        player is re-read and the update recomputed, up to `max_attempts` times.
+        Returns the update that was applied.
+        """
+        for attempt in range(max_attempts):
+            update_data = build_update(player)
+            if await self.update_player_if_version(player, update_data):
+                return update_data
+            
+            player = await self.get_player_by_username(player["username"])
+            if not player:
+                raise VersionConflictError("Player no longer exists")
+        
+        self.concurrency_stats["exhausted"] += 1
+        logger.warning(f"Gave up updating player {player['username']} after {max_attempts} version conflicts")
+        raise VersionConflictError(f"Player {player['username']} was modified concurrently")
+
+    def get_concurrency_stats(self) -> dict:
+        """Optimistic concurrency counters since startup"""
+        attempts = self.concurrency_stats["attempts"]
+        return {
+            **self.concurrency_stats,
+            "conflictRate": self.concurrency_stats["conflicts"] / attempts if attempts else 0.0
+        }
+
+    async def debit_resources(self, username: str, amounts: Dict[str, int],
+                              credits: Optional[Dict[str, int]] = None, ledger: Optional[str] = None) -> bool:
+        """Atomically take resources from a player, optionally crediting others in the same write
+
+        Returns False, changing nothing, if any balance is short of `amounts`
+        or the trade `ledger` entry was already applied.
+        """
+        query = {"username": username}
+        deltas: Dict[str, int] = {}
+        for resource, amount in amounts.items():
+            query[f"resources.{resource}"] = {"$gte": amount}
+            deltas[resource] = deltas.get(resource, 0) - amount
+        for resource, amount in (credits or {}).items():
+            deltas[resource] = deltas.get(resource, 0) + amount
+        update = {"$inc": {
+            **{f"resources.{resource}": delta for resource, delta in deltas.items()},
+            "version": 1
+        }}
+        if ledger:
+            query["tradeLedger"] = {"$ne": ledger}
+            update["$push"] = {"tradeLedger": {"$each": [ledger], "$slice": -TRADE_LEDGER_SIZE}}
+        result = await self.db.players.update_one(query, update)
+        return result.modified_count == 1
+
+    async def credit_resources(self, username: str, amounts: Dict[str, int], ledger: Optional[str] = None):
+        """Atomically add resources to a player, at most once per trade `ledger` entry"""
+        await self.increment_player(username, {f"resources.{resource}": amount for resource, amount in amounts.items()},
+                                    ledger=ledger)
+
+    async def increment_player(self, username: str, increments: Dict[str, int],
+                               ledger: Optional[str] = None) -> bool:
+        """Apply dotted-field `increments` (resources, army, ...) to a player in one guarded $inc
+
+        Negative increments never take a field below zero, and a trade
+        `ledger` entry is applied at most once; returns False, changing
+        nothing, when either guard fails.
+        """
+        increments = {path: amount for path, amount in increments.items() if amount}
+        if not increments and not ledger:
+            return True
+        query = {"username": username}
+        for path, amount in increments.items():
+            if amount < 0:
+                query[path] = {"$gte": -amount}
+        update = {"$inc": {**increments, "version": 1}}
+        if ledger:
+            query["tradeLedger"] = {"$ne": ledger}
+            update["$push"] = {"tradeLedger": {"$each": [ledger], "$slice": -TRADE_LEDGER_SIZE}}
+        result = await self.db.players.update_one(query, update)
+        return result.modified_count == 1
+
+    async def settle_trade_offer(self, offer: dict):
+        """Pay the creator of an accepted offer once, then mark the offer settled"""
+        await self.credit_resources(offer["creatorUsername"], offer["requesting"], ledger=f"{offer['_id']}:sold")
+        await self.db.trade_offers.update_one({"_id": offer["_id"], "settled": False}, {"$set": {"settled": True}})
+
+    async def charge_player(self, username: str, cost: Dict[str, int],
+                            increments: Optional[Dict[str, int]] = None,
+                            order: Optional[str] = None) -> Optional[dict]:
+        """Take `cost` from a player and apply dotted-field `increments` in one guarded $inc
+
+        Returns the updated player, or None, changing nothing, if any balance
+        is short of `cost` or the shop `order` was already charged.
+        """
+        query = {"username": username}
+        deltas = dict(increments or {})
+        for resource, amount in cost.items():
+            query[f"resources.{resource}"] = {"$gte": amount}
+            deltas[f"resources.{resource}"] = deltas.get(f"resources.{resource}", 0) - amount
+        update = {"$inc": {**deltas, "version": 1}}
+        if order:
+            query["shopOrders"] = {"$ne": order}
+            update["$push"] = {"shopOrders": {"$each": [order], "$slice": -SHOP_ORDER_LEDGER_SIZE}}
+        player = await self.db.players.find_one_and_update(
+            query, update, return_document=ReturnDocument.AFTER
+        )
+        if player:
+            player['id'] = str(player.pop('_id'))
+        return player
+
+    async def set_player_alliance(self, username: str, alliance_id: Optional[str],
+                                  expected: Optional[str] = None) -> bool:
+        """Move a player's allianceId from `expected` to `alliance_id` in one conditional write
+
+        Joining passes expected=None, so a player can never end up in two
+        alliances; returns False when the player's current alliance differs.
+        """
+        result = await self.db.players.update_one(
+            {"username": username, "allianceId": expected},
+            {"$set": {"allianceId": alliance_id}, "$inc": {"version": 1}}
+        )
+        return result.modified_count == 1
+
+    @staticmethod
+    def alliance_member_inc(player: dict, sign: int = 1) -> Dict[str, int]:
+        """$inc moving an alliance's aggregates by one member joining (sign=1) or leaving (sign=-1)"""
+        return {
+            "memberCount": sign,
+            "totalPower": sign * player.get("power", 0),
+            f"empires.{player.get('empire') or 'unknown'}": sign
+        }
+
+    async def alliance_member_totals(self) -> List[dict]:
+        """Per-alliance {_id: alliance id, power, members} from one $group over players"""
+        cursor = self.db.players.aggregate([
+            {"$match": {"allianceId": {"$ne": None}}},
+            {"$group": {"_id": "$allianceId", "power": {"$sum": "$power"}, "members": {"$sum": 1}}}
+        ])
+        return await cursor.to_list(length=None)
+
+    async def sync_alliance_power(self) -> int:
+        """Set every alliance's totalPower to its members' summed power; returns how many changed
+
+        Recomputing from members, rather than applying deltas from a player
+        snapshot, cannot drift when members join or leave mid-pass; a total
+        changed since it was read is left for the next pass.
+        """
+        power = {total["_id"]: total["power"] for total in await self.alliance_member_totals()}
+        updates = []
+        async for alliance in self.db.alliances.find({}, {"totalPower": 1}):
+            total = power.get(str(alliance["_id"]), 0)
+            if alliance.get("totalPower") != total:
+                updates.append(UpdateOne({"_id": alliance["_id"], "totalPower": alliance.get("totalPower")},
+                                         {"$set": {"totalPower": total}}))
+        if not updates:
+            return 0
+        result = await self.db.alliances.bulk_write(updates, ordered=False)
+        return result.modified_count
+
+    async def refresh_alliance_rankings(self) -> bool:
+        """Rebuild the alliance leaderboard from one $group over members' power"""
+        totals = await self.alliance_member_totals()
+        alliances = {
+            str(alliance["_id"]): alliance
+            async for alliance in self.db.alliances.find({}, {"name": 1, "level": 1})
+        }
+        return self.alliance_rankings.rebuild(totals, alliances, at=datetime.utcnow())
+
     async def get_leaderboard(self, limit: int = 50) -> List[dict]:
         """Get top players by power"""
         try:
@@ -204,26 +655,172 @@ class MongoDB:
             return []
 
     async def get_nearby_players(self, username: str, limit: int = 10) -> List[dict]:
-        """Get nearby players for raids/diplomacy"""
+        """Closest raidable players within the caller's power band, nearest first"""
         try:
-            # For now, just get random players excluding the current user
-            cursor = self.db.players.find({"username": {"$ne": username}}).limit(limit * 2)
-            players = await cursor.to_list(length=limit * 2)
+            protected_since = datetime.utcnow() - CombatSystem.RAID_PROTECTION
+            nearest = self.world_map.nearest(username, limit, protected_since=protected_since)
+            if not nearest:
+                return []
             
-            # Randomize and return subset
-            import random
-            random.shuffle(players)
-            players = players[:limit]
+            cursor = self.db.players.find({"username": {"$in": [name for _, name in nearest]}})
+            players_by_name = {player["username"]: player for player in await cursor.to_list(length=limit)}
             
-            for player in players:
+            players = []
+            for distance, name in nearest:
+                player = players_by_name.get(name)
+                if not player:
+                    continue
                 player['id'] = str(player['_id'])
                 # Remove the _id field to avoid serialization issues
                 del player['_id']
+                player['distance'] = round(distance, 1)
+                players.append(player)
             return players
         except Exception as e:
             logger.error(f"Failed to get nearby players: {e}")
             return []
 
+    async def get_players_in_area(self, x_min: int, y_min: int, x_max: int, y_max: int,
+                                  projection: Optional[dict] = None) -> List[dict]:
+        """Players whose castle lies in a map rectangle (served by the 2d index)"""
+        cursor = self.db.players.find(
+            {"coordinates": {"$geoWithin": {"$box": [[x_min, y_min], [x_max, y_max]]}}},
+            projection
+        )
+        return await cursor.to_list(length=None)
+
+    # Shop
+    async def get_inventory(self, player_id: str) -> Dict[str, int]:
+        """Counts of the items a player holds, by item id"""
+        cursor = self.db.inventory.find({"playerId": player_id, "quantity": {"$gt": 0}}, {"itemId": 1, "quantity": 1})
+        return {entry["itemId"]: entry["quantity"] async for entry in cursor}
+
+    async def grant_inventory(self, player_id: str, items: Dict[str, int], order: Optional[str] = None):
+        """Add items to a player's inventory with one upserted $inc per item
+
+        Items already granted for the shop `order` are skipped.
+        """
+        now = datetime.utcnow()
+        updates = []
+        for item_id, quantity in items.items():
+            if not quantity:
+                continue
+            query = {"playerId": player_id, "itemId": item_id}
+            update = {"$inc": {"quantity": quantity}, "$set": {"updatedAt": now}}
+            if order:
+                query["orders"] = {"$ne": order}
+                update["$push"] = {"orders": {"$each": [order], "$slice": -SHOP_ORDER_LEDGER_SIZE}}
+            updates.append(UpdateOne(query, update, upsert=True))
+        if not updates:
+            return
+        try:
+            await self.db.inventory.bulk_write(updates, ordered=False)
+        except BulkWriteError as e:
+            # The upsert of an item already granted for `order` collides with its row
+            if not order or any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+    async def consume_inventory(self, player_id: str, item_id: str, quantity: int = 1) -> bool:
+        """Take items from a player's inventory; returns False, changing nothing, if they hold fewer"""
+        result = await self.db.inventory.update_one(
+            {"playerId": player_id, "itemId": item_id, "quantity": {"$gte": quantity}},
+            {"$inc": {"quantity": -quantity}, "$set": {"updatedAt": datetime.utcnow()}}
+        )
+        return result.modified_count == 1
+
+    async def claim_shop_order(self, player_id: str, key: str, request: dict) -> Tuple[bool, dict]:
+        """Reserve an idempotency key for a purchase
+
+        Returns (True, order) once this caller holds the key's order, or
+        (False, order) with the order already holding it: completed, or
+        pending under a live claim. A pending claim older than
+        SHOP_ORDER_CLAIM_TIMEOUT is taken over.
+        """
+        for attempt in range(2):
+            now = datetime.utcnow()
+            order = {
+                "_id": ObjectId(),
+                "playerId": player_id,
+                "idempotencyKey": key,
+                "request": request,
+                "status": "pending",
+                "claimToken": str(uuid.uuid4()),
+                "claimedAt": now,
+                "createdAt": now,
+                "expiresAt": now + SHOP_ORDER_TTL
+            }
+            try:
+                await self.db.shop_orders.insert_one(order)
+                return True, order
+            except DuplicateKeyError:
+                existing = await self.db.shop_orders.find_one({"playerId": player_id, "idempotencyKey": key})
+                # The holder may have been released in between; claim again
+                if existing is None:
+                    continue
+                if (existing["status"] != "pending" or existing["request"] != request or
+                        existing.get("claimedAt", existing["createdAt"]) >= now - SHOP_ORDER_CLAIM_TIMEOUT):
+                    return False, existing
+                taken = await self.db.shop_orders.find_one_and_update(
+                    {"_id": existing["_id"], "status": "pending", "claimToken": existing.get("claimToken")},
+                    {"$set": {"claimToken": order["claimToken"], "claimedAt": now}},
+                    return_document=ReturnDocument.AFTER
+                )
+                if taken is not None:
+                    return True, taken
+        raise DuplicateKeyError(f"Idempotency key {key!r} is contended")
+
+    async def complete_shop_order(self, order: dict, response: dict):
+        """Keep the response of a finished purchase for replays of its idempotency key"""
+        await self.db.shop_orders.update_one(
+            {"_id": order["_id"], "claimToken": order["claimToken"]},
+            {"$set": {"status": "completed", "response": response}}
+        )
+
+    async def release_shop_order(self, order: dict, charged: bool = False):
+        """Free the idempotency key of a purchase that did not go through
+
+        An order that may already be `charged` is kept, with its claim
+        expired, so the next retry takes it over and resumes it.
+        """
+        query = {"_id": order["_id"], "status": "pending", "claimToken": order["claimToken"]}
+        if charged:
+            await self.db.shop_orders.update_one(
+                query, {"$set": {"claimedAt": datetime.utcnow() - SHOP_ORDER_CLAIM_TIMEOUT}}
+            )
+        else:
+            await self.db.shop_orders.delete_one(query)
+
+    def queue_shop_purchase(self, purchase: dict) -> str:
+        """Buffer a shop purchase audit record for the next batched insert and return its id"""
+        purchase.setdefault('_id', ObjectId())
+        purchase.setdefault('purchaseDate', datetime.utcnow())
+        self.pending_shop_purchases.append(purchase)
+        return str(purchase['_id'])
+
+    async def flush_shop_purchases(self) -> int:
+        """Insert every buffered shop purchase record in one unordered batch"""
+        if not self.pending_shop_purchases or self._shop_purchase_flush_running:
+            return 0
+        self._shop_purchase_flush_running = True
+        batch, self.pending_shop_purchases = self.pending_shop_purchases, []
+        try:
+            inserted, retry = await self._insert_batch(self.db.shop_purchases, batch, "shop purchases")
+            self.pending_shop_purchases = retry + self.pending_shop_purchases
+            return inserted
+        finally:
+            self._shop_purchase_flush_running = False
+
+    async def get_shop_purchases(self, player_id: str, limit: int = 50) -> List[dict]:
+        """A player's latest shop purchases, including those not flushed yet"""
+        cursor = self.db.shop_purchases.find({"playerId": player_id}).sort("purchaseDate", -1).limit(limit)
+        purchases = await cursor.to_list(length=limit)
+        stored_ids = {purchase['_id'] for purchase in purchases}
+        purchases += [
+            purchase for purchase in self.pending_shop_purchases
+            if purchase['playerId'] == player_id and purchase['_id'] not in stored_ids
+        ]
+        return sorted(purchases, key=lambda purchase: purchase['purchaseDate'], reverse=True)[:limit]
+
     # Chat System
     async def add_chat_message(self, message_data: dict) -> str:
         """Add a chat message"""
@@ -250,6 +847,34 @@ class MongoDB:
             logger.error(f"Failed to get chat messages: {e}")
             return []
 
+    async def load_alliance_chat(self):
+        """Rebuild the alliance channel membership index; histories load on first read"""
+        self.alliance_chat = AllianceChat()
+        async for alliance in self.db.alliances.find({}, {"members": 1}):
+            self.alliance_chat.add_channel(str(alliance["_id"]), alliance.get("members", []))
+
+    async def get_alliance_messages(self, alliance_id: str, limit: int = 50,
+                                    since: Optional[datetime] = None) -> List[dict]:
+        """Recent messages of an alliance channel from its ring buffer"""
+        if alliance_id not in self.alliance_chat.loaded:
+            cursor = self.db.alliance_messages.find({"allianceId": alliance_id}) \
+                .sort("timestamp", -1).limit(AllianceChat.BUFFER_SIZE)
+            self.alliance_chat.warm(alliance_id, await cursor.to_list(length=AllianceChat.BUFFER_SIZE))
+        return self.alliance_chat.recent(alliance_id, limit, since)
+
+    async def flush_alliance_messages(self) -> int:
+        """Insert every queued alliance message in one unordered batch"""
+        if not self.alliance_chat.pending or self._alliance_chat_flush_running:
+            return 0
+        self._alliance_chat_flush_running = True
+        batch, self.alliance_chat.pending = self.alliance_chat.pending, []
+        try:
+            inserted, retry = await self._insert_batch(self.db.alliance_messages, batch, "alliance messages")
+            self.alliance_chat.pending = retry + self.alliance_chat.pending
+            return inserted
+        finally:
+            self._alliance_chat_flush_running = False
+
     async def add_private_message(self, message_data: dict) -> str:
         """Add a private message"""
         try:
@@ -294,16 +919,89 @@ class MongoDB:
             logger.error(f"Failed to add raid result: {e}")
             raise
 
+    def queue_raid_result(self, raid_data: dict) -> str:
+        """Buffer a raid record for the next batched insert and return its id
+
+        Keeps the insert off the request path; the background flush (or a
+        full buffer) writes pending raids with one insert_many.
+        """
+        from bson import ObjectId
+        raid_data.setdefault('_id', ObjectId())
+        raid_data.setdefault('timestamp', datetime.utcnow())
+        self.pending_raids.append(raid_data)
+        if len(self.pending_raids) >= RAID_FLUSH_BATCH_SIZE and not self._raid_flush_running:
+            self._raid_flush_task = asyncio.get_running_loop().create_task(self.flush_raid_results())
+        return str(raid_data['_id'])
+
+    async def flush_raid_results(self) -> int:
+        """Insert every buffered raid record in one unordered batch"""
+        if not self.pending_raids or self._raid_flush_running:
+            return 0
+        self._raid_flush_running = True
+        batch, self.pending_raids = self.pending_raids, []
+        try:
+            inserted, retry = await self._insert_batch(self.db.raids, batch, "raid results")
+            self.pending_raids = retry + self.pending_raids
+            return inserted
+        finally:
+            self._raid_flush_running = False
+
+    async def _insert_batch(self, collection, batch: List[dict], label: str) -> Tuple[int, List[dict]]:
+        """Insert a flushed buffer in one unordered batch; returns (inserted, documents to retry)
+
+        Only a lost connection hands the batch back for the next flush.
+        Documents BSON cannot encode are logged and dropped so they do not
+        block the rest of the buffer, and any other failure drops the batch.
+        """
+        try:
+            await collection.insert_many(batch, ordered=False)
+            return len(batch), []
+        except (InvalidDocument, OverflowError):
+            encodable = []
+            for document in batch:
+                try:
+                    bson.encode(document)
+                    encodable.append(document)
+                except (InvalidDocument, OverflowError) as e:
+                    logger.error(f"Dropping {label} record {document.get('_id')} that cannot be stored: {e}")
+            if not encodable or len(encodable) == len(batch):
+                return 0, []
+            return await self._insert_batch(collection, encodable, label)
+        except BulkWriteError as e:
+            # Records that did land are not retried; the rest are duplicates or invalid
+            logger.error(f"Failed to insert some {label}: {e.details.get('writeErrors', [])[:1]}")
+            return e.details.get('nInserted', 0), []
+        except AutoReconnect as e:
+            # NetworkTimeout is an AutoReconnect too
+            logger.error(f"Failed to insert {label}, will retry: {e}")
+            return 0, batch
+        except Exception as e:
+            logger.error(f"Dropping {len(batch)} {label} that could not be inserted: {e}")
+            return 0, []
+
     async def get_raid_history(self, username: str, limit: int = 20) -> List[dict]:
-        """Get raid history for a player"""
+        """Get raid history for a player, with report text rendered from the stored template"""
         try:
             cursor = self.db.raids.find({
                 "$or": [{"attackerUsername": username}, {"defenderUsername": username}]
             }).sort("timestamp", -1).limit(limit)
             raids = await cursor.to_list(length=limit)
+            
+            # Raids still waiting for the batched insert are part of the history too
+            stored_ids = {raid['_id'] for raid in raids}
+            raids += [
+                raid for raid in self.pending_raids
+                if username in (raid.get('attackerUsername'), raid.get('defenderUsername'))
+                and raid['_id'] not in stored_ids
+            ]
+            raids = sorted(raids, key=lambda raid: raid['timestamp'], reverse=True)[:limit]
+            
+            history = []
             for raid in raids:
-                raid['id'] = str(raid['_id'])
-            return raids
+                raid = {**raid, 'id': str(raid['_id'])}
+                del raid['_id']
+                history.append(CombatSystem.expand_raid_record(raid))
+            return history
         except Exception as e:
             logger.error(f"Failed to get raid history: {e}")
             return []
@@ -381,23 +1079,21 @@ class MongoDB:
                     "food": 10000
                 },
                 "buildings": {
-                    "castle": {"level": 5},
-                    "farm": {"level": 5},
-                    "lumbermill": {"level": 5},
-                    "mine": {"level": 5},
-                    "barracks": {"level": 5},
-                    "blacksmith": {"level": 5}
+                    "castle": {"level": 5, "constructing": False},
+                    "farm": {"level": 5, "constructing": False},
+                    "lumbermill": {"level": 5, "constructing": False},
+                    "mine": {"level": 5, "constructing": False},
+                    "barracks": {"level": 5, "constructing": False},
+                    "blacksmith": {"level": 5, "constructing": False}
                 },
                 "army": {
                     "soldiers": 100,
                     "archers": 50,
                     "cavalry": 25
                 },
-                "inventory": {
-                    "Race Change Scroll": 10
-                },
                 "constructionQueue": [],
                 "power": 1000,
+                "version": 0,
                 "lastActive": datetime.utcnow(),
                 "createdAt": datetime.utcnow(),
                 "isAdmin": True
@@ -407,6 +1103,7 @@ class MongoDB:
             user_result = await self.db.users.insert_one(user_doc)
             player_doc["userId"] = str(user_result.inserted_id)
             await self.db.players.insert_one(player_doc)
+            await self.grant_inventory(player_doc["userId"], {"race_change_scroll": 10})
             
             logger.info(f"Admin user '{username}' created successfully")
             return True
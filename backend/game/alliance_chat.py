@@ -0,0 +1,87 @@
+from typing import Deque, Dict, Iterable, List, Optional
+from collections import deque
+from datetime import datetime
+
+from bson import ObjectId
+
+class AllianceChat:
+    """Alliance chat channels: who may read and post where, and recent history
+
+    Each alliance is one channel. `channel_of` maps a member to their
+    alliance id and is kept in step with joins and leaves, so checking
+    access is a dictionary lookup. Every channel keeps its last BUFFER_SIZE
+    messages in a ring buffer that serves reads. New messages also wait in
+    `pending` until the next batched insert into `alliance_messages`.
+    """
+
+    BUFFER_SIZE = 100
+
+    def __init__(self):
+        self.channel_of: Dict[str, str] = {}        # username -> alliance id
+        self.members: Dict[str, set] = {}           # alliance id -> usernames
+        self.buffers: Dict[str, Deque[dict]] = {}   # alliance id -> recent messages, oldest first
+        self.loaded: set = set()                    # channels whose buffer holds the stored history
+        self.pending: List[dict] = []
+
+    # Membership
+    def add_channel(self, alliance_id: str, members: Iterable[str] = ()):
+        self.members.setdefault(alliance_id, set())
+        for username in members:
+            self.join(username, alliance_id)
+
+    def remove_channel(self, alliance_id: str):
+        for username in self.members.pop(alliance_id, set()):
+            self.channel_of.pop(username, None)
+        self.buffers.pop(alliance_id, None)
+        self.loaded.discard(alliance_id)
+        self.pending = [message for message in self.pending if message["allianceId"] != alliance_id]
+
+    def join(self, username: str, alliance_id: Optional[str]):
+        """Move a player to an alliance's channel, or out of any with None"""
+        previous = self.channel_of.pop(username, None)
+        if previous is not None and previous in self.members:
+            self.members[previous].discard(username)
+        if alliance_id is not None:
+            self.channel_of[username] = alliance_id
+            self.members.setdefault(alliance_id, set()).add(username)
+
+    def can_access(self, username: str, alliance_id: str) -> bool:
+        return self.channel_of.get(username) == alliance_id
+
+    # Messages
+    def post(self, alliance_id: str, username: str, content: str, empire: Optional[str] = None) -> dict:
+        """Append a message to a channel and queue it for persistence"""
+        message = {
+            "_id": ObjectId(),
+            "allianceId": alliance_id,
+            "username": username,
+            "empire": empire,
+            "content": content,
+            "timestamp": datetime.utcnow()
+        }
+        self._buffer(alliance_id).append(message)
+        self.pending.append(message)
+        return message
+
+    def _buffer(self, alliance_id: str) -> Deque[dict]:
+        if alliance_id not in self.buffers:
+            self.buffers[alliance_id] = deque(maxlen=self.BUFFER_SIZE)
+        return self.buffers[alliance_id]
+
+    def warm(self, alliance_id: str, stored: Iterable[dict]):
+        """Fill a channel's buffer from its stored history, keeping messages posted meanwhile"""
+        messages = {message["_id"]: message for message in stored}
+        for message in self.buffers.get(alliance_id, ()):
+            messages[message["_id"]] = message
+        self.buffers[alliance_id] = deque(
+            sorted(messages.values(), key=lambda message: message["timestamp"]), maxlen=self.BUFFER_SIZE
+        )
+        self.loaded.add(alliance_id)
+
+    def recent(self, alliance_id: str, limit: int = 50, since: Optional[datetime] = None) -> List[dict]:
+        """Latest messages of a channel, oldest first; only those after `since` if given"""
+        messages = [
+            message for message in self.buffers.get(alliance_id, ())
+            if since is None or message["timestamp"] > since
+        ]
+        return messages[-limit:] if limit > 0 else []
@@ -0,0 +1,80 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+import json
+
+class AllianceRankings:
+    """Alliance leaderboard snapshot, rebuilt on a schedule and served from memory
+
+    rebuild() takes per-alliance (power, members) totals from one $group over
+    players and orders them by total power, then member count, then name.
+    The snapshot's version only moves when the order or a listed number
+    changes, so page ETags (version + page) stay valid between quiet
+    rebuilds. Pages are serialized once per version; an alliance's rank is a
+    dictionary lookup.
+    """
+
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 200
+
+    def __init__(self):
+        self.version = 0
+        self.entries: List[dict] = []
+        self.ranks: Dict[str, int] = {}  # alliance id -> 1-based rank
+        self.updated_at = None
+        self._pages: Dict[Tuple[int, int], Tuple[bytes, str]] = {}
+
+    def rebuild(self, totals: Iterable[dict], alliances: Dict[str, dict], at=None) -> bool:
+        """Replace the snapshot; returns True if the ranking changed
+
+        `totals` are $group results {_id: alliance id, power, members};
+        `alliances` maps alliance id to its {name, level}. Totals of
+        alliances that no longer exist are dropped.
+        """
+        entries = []
+        for total in totals:
+            alliance = alliances.get(total["_id"])
+            if alliance is None or not total["members"]:
+                continue
+            entries.append({
+                "id": total["_id"],
+                "name": alliance["name"],
+                "level": alliance.get("level", 1),
+                "totalPower": total["power"],
+                "memberCount": total["members"],
+                "averagePower": round(total["power"] / total["members"])
+            })
+        entries.sort(key=lambda entry: (-entry["totalPower"], -entry["memberCount"], entry["name"]))
+        for rank, entry in enumerate(entries, start=1):
+            entry["rank"] = rank
+
+        if entries == self.entries:
+            return False
+        self.version += 1
+        self.updated_at = at
+        self.entries = entries
+        self.ranks = {entry["id"]: entry["rank"] for entry in entries}
+        self._pages = {}
+        return True
+
+    def page(self, page: int, size: int = PAGE_SIZE) -> Tuple[bytes, str]:
+        """JSON body of one ranking page and its strong ETag"""
+        size = min(max(size, 1), self.MAX_PAGE_SIZE)
+        page = max(page, 1)
+        cached = self._pages.get((page, size))
+        if cached is not None:
+            return cached
+        start = (page - 1) * size
+        body = json.dumps({
+            "version": self.version,
+            "page": page,
+            "size": size,
+            "total": len(self.entries),
+            "updatedAt": self.updated_at.isoformat() if self.updated_at else None,
+            "alliances": self.entries[start:start + size]
+        }).encode()
+        self._pages[(page, size)] = (body, f'"{self.version}-{page}-{size}"')
+        return self._pages[(page, size)]
+
+    def rank_of(self, alliance_id: str) -> Optional[dict]:
+        """Ranking entry of one alliance, or None if it is not ranked yet"""
+        rank = self.ranks.get(alliance_id)
+        return self.entries[rank - 1] if rank else None
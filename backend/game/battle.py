@@ -0,0 +1,163 @@
+from typing import Dict, List, Optional
+import numpy as np
+
+from game.empire_bonuses import EmpireBonuses
+
+class BattleEngine:
+    """Round-based battles between soldiers, archers and cavalry
+
+    Armies are count vectors over UNIT_TYPES. Each round both sides strike
+    at once: a side's attack, scaled by the COUNTERS matrix, is spread over
+    the enemy unit types in proportion to their numbers, and every full
+    `defense` worth of damage kills one unit. A round costs the same few
+    matrix operations whatever the army sizes, and resolve_batch runs many
+    battles side by side.
+    """
+
+    UNIT_TYPES = ("soldiers", "archers", "cavalry")
+
+    UNIT_STATS = {
+        "soldiers": {"attack": 10, "defense": 12},
+        "archers": {"attack": 14, "defense": 8},
+        "cavalry": {"attack": 20, "defense": 16}
+    }
+
+    # COUNTERS[i][j]: damage multiplier of unit type i striking unit type j.
+    # Soldiers hold off cavalry, archers shoot down soldiers, cavalry rides down archers.
+    COUNTERS = (
+        (1.0, 0.75, 1.5),
+        (1.5, 1.0, 0.75),
+        (0.75, 1.75, 1.0)
+    )
+
+    # Per-empire unit attack multipliers on top of the raid/defense bonuses
+    EMPIRE_UNIT_ATTACK = {
+        "frankish": {"cavalry": 1.25}
+    }
+
+    MAX_ROUNDS = 6
+
+    # Stat arrays built once at import by _build_arrays()
+    _ATTACK: np.ndarray
+    _DEFENSE: np.ndarray
+    _COUNTERS: np.ndarray
+
+    @classmethod
+    def _build_arrays(cls):
+        cls._ATTACK = np.array([cls.UNIT_STATS[u]["attack"] for u in cls.UNIT_TYPES], dtype=np.float64)
+        cls._DEFENSE = np.array([cls.UNIT_STATS[u]["defense"] for u in cls.UNIT_TYPES], dtype=np.float64)
+        cls._COUNTERS = np.array(cls.COUNTERS, dtype=np.float64)
+
+    @classmethod
+    def army_vector(cls, army) -> np.ndarray:
+        """Unit counts in UNIT_TYPES order; a bare number counts as soldiers"""
+        if isinstance(army, dict):
+            return np.array([army.get(u, 0) for u in cls.UNIT_TYPES], dtype=np.int64)
+        return np.array([army or 0, 0, 0], dtype=np.int64)
+
+    @classmethod
+    def army_strength(cls, army) -> float:
+        """Total attack of an army before counters and bonuses"""
+        return float(cls.army_vector(army) @ cls._ATTACK)
+
+    @classmethod
+    def side_modifiers(cls, empire: str, attacking: bool) -> np.ndarray:
+        """Per-unit (attack, defense) multipliers for one side, shape (2, UNIT_TYPES)"""
+        attack = np.ones(len(cls.UNIT_TYPES))
+        defense = np.ones(len(cls.UNIT_TYPES))
+        for unit, multiplier in cls.EMPIRE_UNIT_ATTACK.get(empire, {}).items():
+            attack[cls.UNIT_TYPES.index(unit)] *= multiplier
+        if attacking:
+            attack *= EmpireBonuses.get_raid_damage_multiplier(empire)
+        else:
+            defense *= EmpireBonuses.get_defense_bonus(empire)
+        return np.stack([attack, defense])
+
+    @classmethod
+    def _casualties(cls, strikers: np.ndarray, striker_attack: np.ndarray,
+                    targets: np.ndarray, target_defense: np.ndarray) -> np.ndarray:
+        # (battles, units) damage each target type takes from the whole striking army
+        damage = (strikers * striker_attack) @ cls._COUNTERS
+        total_targets = targets.sum(axis=1, keepdims=True)
+        share = np.divide(targets, total_targets, out=np.zeros(targets.shape), where=total_targets > 0)
+        kills = np.floor(damage * share / target_defense).astype(np.int64)
+        return np.minimum(kills, targets)
+
+    @classmethod
+    def resolve_batch(cls, attackers: np.ndarray, defenders: np.ndarray,
+                      attacker_modifiers: Optional[np.ndarray] = None,
+                      defender_modifiers: Optional[np.ndarray] = None,
+                      max_rounds: int = MAX_ROUNDS) -> Dict[str, np.ndarray]:
+        """Resolve many battles at once
+
+        attackers/defenders are (battles, UNIT_TYPES) counts; modifiers are
+        (battles, 2, UNIT_TYPES) attack/defense multipliers as returned by
+        side_modifiers. Losses come back as a compact (battles, rounds, 2,
+        UNIT_TYPES) array, attacker first; rounds after a side is wiped out
+        are all zeros.
+        """
+        attackers = np.array(attackers, dtype=np.int64, ndmin=2)
+        defenders = np.array(defenders, dtype=np.int64, ndmin=2)
+        battles = attackers.shape[0]
+        neutral = np.ones((battles, 2, len(cls.UNIT_TYPES)))
+        attacker_modifiers = neutral if attacker_modifiers is None else np.broadcast_to(attacker_modifiers, neutral.shape)
+        defender_modifiers = neutral if defender_modifiers is None else np.broadcast_to(defender_modifiers, neutral.shape)
+
+        attacker_attack = cls._ATTACK * attacker_modifiers[:, 0]
+        attacker_defense = cls._DEFENSE * attacker_modifiers[:, 1]
+        defender_attack = cls._ATTACK * defender_modifiers[:, 0]
+        defender_defense = cls._DEFENSE * defender_modifiers[:, 1]
+
+        losses = np.zeros((battles, max_rounds, 2, len(cls.UNIT_TYPES)), dtype=np.int64)
+        rounds = np.zeros(battles, dtype=np.int64)
+        for round_index in range(max_rounds):
+            fighting = (attackers.sum(axis=1) > 0) & (defenders.sum(axis=1) > 0)
+            if not fighting.any():
+                break
+            # Both sides strike simultaneously from the start-of-round counts
+            defender_losses = cls._casualties(attackers, attacker_attack, defenders, defender_defense)
+            attacker_losses = cls._casualties(defenders, defender_attack, attackers, attacker_defense)
+            defender_losses[~fighting] = 0
+            attacker_losses[~fighting] = 0
+            attackers = attackers - attacker_losses
+            defenders = defenders - defender_losses
+            losses[:, round_index, 0] = attacker_losses
+            losses[:, round_index, 1] = defender_losses
+            rounds += fighting
+
+        attacker_strength = (attackers * attacker_attack).sum(axis=1)
+        defender_strength = (defenders * defender_attack).sum(axis=1)
+        return {
+            "attackerWins": attacker_strength > defender_strength,
+            "rounds": rounds,
+            "attackerRemaining": attackers,
+            "defenderRemaining": defenders,
+            "losses": losses
+        }
+
+    @classmethod
+    def resolve(cls, attacker_army, defender_army, attacker_empire: str = "norman",
+                defender_empire: str = "norman", max_rounds: int = MAX_ROUNDS) -> Dict:
+        """Resolve one battle between two army dicts"""
+        result = cls.resolve_batch(
+            cls.army_vector(attacker_army)[None, :],
+            cls.army_vector(defender_army)[None, :],
+            cls.side_modifiers(attacker_empire, attacking=True)[None],
+            cls.side_modifiers(defender_empire, attacking=False)[None],
+            max_rounds=max_rounds
+        )
+        rounds = int(result["rounds"][0])
+        losses = result["losses"][0]
+        return {
+            "attackerWins": bool(result["attackerWins"][0]),
+            "attackerLosses": dict(zip(cls.UNIT_TYPES, losses[:, 0].sum(axis=0).tolist())),
+            "defenderLosses": dict(zip(cls.UNIT_TYPES, losses[:, 1].sum(axis=0).tolist())),
+            "rounds": cls.round_report(losses[:rounds])
+        }
+
+    @classmethod
+    def round_report(cls, losses: np.ndarray) -> List[List[List[int]]]:
+        """Per round [[attacker losses], [defender losses]] in UNIT_TYPES order"""
+        return losses.tolist()
+
+BattleEngine._build_arrays()
@@ -1,7 +1,9 @@
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from datetime import datetime, timedelta
 import uuid
 
+from game.empire_bonuses import EmpireBonuses
+
 class BuildingSystem:
     """Building system with costs, production, and construction times"""
     
@@ -57,35 +59,120 @@ class BuildingSystem:
     }
 
     @classmethod
-    def get_default_buildings(cls) -> List[Dict]:
-        """Get default buildings for new players"""
-        buildings = []
-        for building_type, data in cls.BUILDING_DATA.items():
-            building = {
-                "id": str(uuid.uuid4()),
-                "type": building_type,
-                "level": 1,
-                "constructing": False,
-                "description": data["description"],
-                "production": data["production"].copy()
+    def get_default_buildings(cls) -> Dict[str, Dict]:
+        """Get default buildings for new players, keyed by building type"""
+        return {
+            building_type: {"level": 1, "constructing": False}
+            for building_type in cls.BUILDING_DATA
+        }
+
+    @classmethod
+    def normalize_buildings(cls, buildings) -> Dict[str, Dict]:
+        """Get the compact {type: {level, constructing}} form of stored buildings
+
+        Accepts the legacy list of full building dicts as well, so documents
+        that have not been migrated yet still read correctly.
+        """
+        if isinstance(buildings, dict):
+            return {
+                building_type: {
+                    "level": state.get("level", 1),
+                    "constructing": state.get("constructing", False)
+                }
+                for building_type, state in buildings.items()
+            }
+        
+        compact = {}
+        for building in buildings or []:
+            compact[building["type"]] = {
+                "level": building.get("level", 1),
+                "constructing": building.get("constructing", False)
             }
-            buildings.append(building)
-        return buildings
+        return compact
+
+    @classmethod
+    def expand_buildings(cls, buildings) -> List[Dict]:
+        """Join stored building state with static catalog data for API responses"""
+        expanded = []
+        for building_type, state in cls.normalize_buildings(buildings).items():
+            data = cls.BUILDING_DATA.get(building_type, {})
+            expanded.append({
+                "id": building_type,
+                "type": building_type,
+                "level": state["level"],
+                "constructing": state["constructing"],
+                "description": data.get("description", ""),
+                "production": data.get("production", {}).copy()
+            })
+        return expanded
+
+    # Power contributed per building level; unknown types fall back to DEFAULT_BUILDING_POWER
+    BUILDING_POWER = {
+        "castle": 150,
+        "barracks": 120,
+        "blacksmith": 100,
+        "mine": 80,
+        "farm": 60,
+        "lumbermill": 60
+    }
+    DEFAULT_BUILDING_POWER = 50
+
+    # Dense lookup tables built once at import by _build_tables(), indexed by
+    # level - 1 up to each building's max_level. Levels outside the tables
+    # (and unknown empires) fall back to the _compute_* formulas.
+    _COST_TABLE: Dict[str, List[Dict[str, int]]] = {}
+    _TIME_TABLE: Dict[Tuple[str, str], List[int]] = {}
+    _PRODUCTION_TABLE: Dict[Tuple[str, str], List[Tuple[Tuple[str, int], ...]]] = {}
+    _POWER_TABLE: Dict[str, List[int]] = {}
+
+    @classmethod
+    def _compute_building_cost(cls, building_type: str, level: int) -> Dict[str, int]:
+        base_cost = cls.BUILDING_DATA[building_type]["base_cost"]
+        multiplier = 1.5 ** (level - 1)
+        return {resource: int(amount * multiplier) for resource, amount in base_cost.items()}
+
+    @classmethod
+    def _compute_building_time(cls, building_type: str, level: int, empire: str) -> int:
+        base_time = cls.BUILDING_DATA[building_type]["base_time"]
+        multiplier = 1.3 ** (level - 1)
+        time_multiplier = EmpireBonuses.get_construction_time_multiplier(empire, building_type)
+        return int(base_time * multiplier * time_multiplier)
+
+    @classmethod
+    def _compute_production(cls, building_type: str, level: int, empire: str) -> Tuple[Tuple[str, int], ...]:
+        base_production = cls.BUILDING_DATA.get(building_type, {}).get("production") or {}
+        return tuple(
+            (resource, EmpireBonuses.apply_resource_bonus(empire, resource, base_amount * level))
+            for resource, base_amount in base_production.items()
+        )
+
+    @classmethod
+    def _build_tables(cls):
+        """Precompute cost, time, production and power for every (type, level, empire)"""
+        for building_type, data in cls.BUILDING_DATA.items():
+            levels = range(1, data["max_level"] + 1)
+            cls._COST_TABLE[building_type] = [
+                cls._compute_building_cost(building_type, level) for level in levels
+            ]
+            power_per_level = cls.BUILDING_POWER.get(building_type, cls.DEFAULT_BUILDING_POWER)
+            cls._POWER_TABLE[building_type] = [power_per_level * level for level in levels]
+            for empire in EmpireBonuses.EMPIRE_DATA:
+                cls._TIME_TABLE[(building_type, empire)] = [
+                    cls._compute_building_time(building_type, level, empire) for level in levels
+                ]
+                cls._PRODUCTION_TABLE[(building_type, empire)] = [
+                    cls._compute_production(building_type, level, empire) for level in levels
+                ]
 
     @classmethod
     def get_building_cost(cls, building_type: str, level: int) -> Dict[str, int]:
         """Calculate building upgrade cost"""
-        if building_type not in cls.BUILDING_DATA:
+        table = cls._COST_TABLE.get(building_type)
+        if table is None:
             return {}
-        
-        base_cost = cls.BUILDING_DATA[building_type]["base_cost"]
-        multiplier = 1.5 ** (level - 1)
-        
-        cost = {}
-        for resource, amount in base_cost.items():
-            cost[resource] = int(amount * multiplier)
-        
-        return cost
+        if 1 <= level <= len(table):
+            return dict(table[level - 1])
+        return cls._compute_building_cost(building_type, level)
 
     @classmethod
     def get_building_time(cls, building_type: str, level: int, empire: str = "norman") -> int:
@@ -93,32 +180,25 @@ class BuildingSystem:
         if building_type not in cls.BUILDING_DATA:
             return 60
         
-        base_time = cls.BUILDING_DATA[building_type]["base_time"]
-        multiplier = 1.3 ** (level - 1)
-        
-        # Apply empire bonuses
-        from game.empire_bonuses import EmpireBonuses
-        time_multiplier = EmpireBonuses.get_construction_time_multiplier(empire, building_type)
-        
-        return int(base_time * multiplier * time_multiplier)
+        table = cls._TIME_TABLE.get((building_type, empire))
+        if table is not None and 1 <= level <= len(table):
+            return table[level - 1]
+        return cls._compute_building_time(building_type, level, empire)
 
     @classmethod
-    def calculate_resource_generation(cls, buildings: List[Dict], empire: str) -> Dict[str, float]:
+    def calculate_resource_generation(cls, buildings: Dict[str, Dict], empire: str) -> Dict[str, float]:
         """Calculate total resource generation per second"""
-        from game.empire_bonuses import EmpireBonuses
-        
         generation = {"gold": 0, "wood": 0, "stone": 0, "food": 0}
         
-        for building in buildings:
-            if "production" in building and building["production"]:
-                level = building.get("level", 1)
-                for resource, base_amount in building["production"].items():
-                    # Base production scaled by level
-                    production = base_amount * level
-                    
-                    # Apply empire bonuses
-                    final_production = EmpireBonuses.apply_resource_bonus(empire, resource, production)
-                    generation[resource] += final_production
+        for building_type, state in cls.normalize_buildings(buildings).items():
+            level = state["level"]
+            table = cls._PRODUCTION_TABLE.get((building_type, empire))
+            if table is not None and 1 <= level <= len(table):
+                production = table[level - 1]
+            else:
+                production = cls._compute_production(building_type, level, empire)
+            for resource, amount in production:
+                generation[resource] += amount
         
         return generation
 
@@ -145,25 +225,16 @@ class BuildingSystem:
         return new_resources
 
     @classmethod
-    def calculate_power_from_buildings(cls, buildings: List[Dict]) -> int:
+    def calculate_power_from_buildings(cls, buildings: Dict[str, Dict]) -> int:
         """Calculate power contribution from buildings"""
         total_power = 0
-        for building in buildings:
-            level = building.get("level", 1)
-            building_type = building.get("type", "")
-            
-            # Different building types contribute different power amounts
-            base_power = {
-                "castle": 150,
-                "barracks": 120,
-                "blacksmith": 100,
-                "mine": 80,
-                "farm": 60,
-                "lumbermill": 60
-            }
-            
-            power_per_level = base_power.get(building_type, 50)
-            total_power += power_per_level * level
+        for building_type, state in cls.normalize_buildings(buildings).items():
+            level = state["level"]
+            table = cls._POWER_TABLE.get(building_type)
+            if table is not None and 1 <= level <= len(table):
+                total_power += table[level - 1]
+            else:
+                total_power += cls.BUILDING_POWER.get(building_type, cls.DEFAULT_BUILDING_POWER) * level
         
         return total_power
 
@@ -183,4 +254,6 @@ class BuildingSystem:
             "startTime": start_time,
             "completionTime": completion_time,
             "completed": False
-        }
\ No newline at end of file
+        }
+
+BuildingSystem._build_tables()
@@ -1,14 +1,57 @@
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
 import random
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from game.battle import BattleEngine
+from game.rng import game_random
 
 class CombatSystem:
     """Combat and raid system"""
     
+    # Raid outcome constants
+    MIN_WIN_CHANCE = 0.1
+    MAX_WIN_CHANCE = 0.9
+    WIN_CHANCE_JITTER = 0.2
+    MIN_STEAL_PERCENTAGE = 0.05
+    MAX_STEAL_PERCENTAGE = 0.3
+    STEAL_POWER_FACTOR = 0.5
+    
+    # Casualty constants
+    WON_LOSS_RATE = 0.1
+    LOST_LOSS_RATE = 0.2
+    ATTACKER_EXTRA_LOSS_RATE = 0.05
+    LOSS_RATE_JITTER = (-0.05, 0.1)
+    MIN_LOSS_RATE = 0.05
+    MAX_LOSS_RATE = 0.4
+    
+    # Shield against further raids after being raided
+    RAID_PROTECTION = timedelta(hours=1)
+    
+    # Battle report templates, keyed by the template id stored with each raid
+    REPORT_TEMPLATES = {
+        "raid_success": "{attacker}'s forces successfully raided {defender}'s kingdom! "
+                        "Stolen: {loot}. Casualties - Attacker: {attacker_losses}, Defender: {defender_losses}",
+        "raid_success_no_loot": "{attacker}'s forces successfully raided {defender}'s kingdom! "
+                                "However, no significant resources were captured. "
+                                "Casualties - Attacker: {attacker_losses}, Defender: {defender_losses}",
+        "raid_repelled": "{attacker}'s raid on {defender}'s kingdom was repelled! "
+                         "Casualties - Attacker: {attacker_losses}, Defender: {defender_losses}"
+    }
+    LOOT_RESOURCES = ("gold", "wood", "stone", "food")
+    
     @classmethod
-    def calculate_raid_result(cls, attacker_data: Dict, defender_data: Dict) -> Dict:
-        """Calculate the result of a raid"""
+    def calculate_raid_result(cls, attacker_data: Dict, defender_data: Dict, seed: Optional[int] = None) -> Dict:
+        """Calculate the result of a raid
+
+        Every draw comes from a random.Random seeded with `seed` (a fresh
+        derived seed by default), which is returned in the result so the
+        raid can be replayed from the same inputs.
+        """
+        if seed is None:
+            seed = game_random.next_seed("raid")
+        rng = game_random.rng(seed)
+        
         attacker_power = cls.calculate_battle_power(attacker_data)
         defender_power = cls.calculate_battle_power(defender_data)
         
@@ -25,25 +68,25 @@ class CombatSystem:
         attacker_win_chance = attacker_power / total_power if total_power > 0 else 0.5
         
         # Add some randomness
-        attacker_win_chance = min(0.9, max(0.1, attacker_win_chance + random.uniform(-0.2, 0.2)))
+        attacker_win_chance = min(cls.MAX_WIN_CHANCE, max(cls.MIN_WIN_CHANCE, attacker_win_chance + rng.uniform(-cls.WIN_CHANCE_JITTER, cls.WIN_CHANCE_JITTER)))
         
-        success = random.random() < attacker_win_chance
+        success = rng.random() < attacker_win_chance
         
         # Calculate stolen resources
         stolen_resources = {}
         if success:
             defender_resources = defender_data.get("resources", {})
-            max_steal_percentage = min(0.3, attacker_power / (defender_power + 1) * 0.5)
+            max_steal_percentage = min(cls.MAX_STEAL_PERCENTAGE, attacker_power / (defender_power + 1) * cls.STEAL_POWER_FACTOR)
             
             for resource, amount in defender_resources.items():
-                steal_percentage = random.uniform(0.05, max_steal_percentage)
+                steal_percentage = rng.uniform(cls.MIN_STEAL_PERCENTAGE, max_steal_percentage)
                 stolen_amount = int(amount * steal_percentage)
                 if stolen_amount > 0:
                     stolen_resources[resource] = stolen_amount
         
         # Calculate casualties
-        attacker_losses = cls.calculate_casualties(attacker_data["army"], success, is_attacker=True)
-        defender_losses = cls.calculate_casualties(defender_data["army"], success, is_attacker=False)
+        attacker_losses = cls.calculate_casualties(attacker_data["army"], success, is_attacker=True, rng=rng)
+        defender_losses = cls.calculate_casualties(defender_data["army"], success, is_attacker=False, rng=rng)
         
         # Generate battle report
         battle_report = cls.generate_battle_report(
@@ -67,43 +110,76 @@ class CombatSystem:
             "attackerLosses": attacker_losses,
             "defenderLosses": defender_losses,
             "timestamp": datetime.utcnow(),
-            "battleReport": battle_report
+            "battleReport": battle_report,
+            "seed": seed
+        }
+
+    @classmethod
+    def resolve_army_raid(cls, attacker_army: Dict[str, int], defender_army: Dict[str, int],
+                          attacker_empire: str, defender_empire: str,
+                          defender_resources: Dict[str, int], seed: Optional[int] = None) -> Dict:
+        """Resolve a raid between unit armies, as the /game/combat/raid route does
+
+        The battle itself is fought by BattleEngine; the loot draw is seeded,
+        and the seed is returned with the outcome so the raid can be replayed.
+        """
+        if seed is None:
+            seed = game_random.next_seed("raid")
+        rng = game_random.rng(seed)
+        
+        battle = BattleEngine.resolve(attacker_army, defender_army, attacker_empire, defender_empire)
+        success = battle["attackerWins"]
+        
+        # Calculate stolen resources
+        stolen_resources = {}
+        if success:
+            for resource in ["gold", "wood", "stone", "food"]:
+                defender_amount = defender_resources.get(resource, 0)
+                steal_amount = int(defender_amount * rng.uniform(0.05, 0.15))
+                if steal_amount > 0:
+                    stolen_resources[resource] = steal_amount
+        
+        return {
+            "seed": seed,
+            "success": success,
+            "attackerLosses": battle["attackerLosses"],
+            "defenderLosses": battle["defenderLosses"],
+            "rounds": battle["rounds"],
+            "stolenResources": stolen_resources
         }
 
     @classmethod
     def calculate_battle_power(cls, player_data: Dict) -> float:
         """Calculate battle power of a player"""
-        army_size = player_data.get("army", 0)
-        buildings = player_data.get("buildings", [])
+        from game.buildings import BuildingSystem
+        buildings = BuildingSystem.normalize_buildings(player_data.get("buildings", {}))
         
-        # Base army power
-        army_power = army_size * 10
+        # Base army power: unit attack, so a bare count is worth 10 per soldier
+        army_power = BattleEngine.army_strength(player_data.get("army", 0))
         
         # Building bonuses
         building_power = 0
-        for building in buildings:
-            if building["type"] == "barracks":
-                building_power += building["level"] * 20
-            elif building["type"] == "blacksmith":
-                building_power += building["level"] * 15
-            elif building["type"] == "castle":
-                building_power += building["level"] * 10
+        building_power += buildings.get("barracks", {}).get("level", 0) * 20
+        building_power += buildings.get("blacksmith", {}).get("level", 0) * 15
+        building_power += buildings.get("castle", {}).get("level", 0) * 10
         
         return army_power + building_power
 
     @classmethod
-    def calculate_casualties(cls, army_size: int, battle_won: bool, is_attacker: bool) -> int:
+    def calculate_casualties(cls, army_size: int, battle_won: bool, is_attacker: bool,
+                             rng: Optional[random.Random] = None) -> int:
         """Calculate army casualties from battle"""
         if army_size == 0:
             return 0
         
-        base_loss_rate = 0.1 if battle_won else 0.2
+        base_loss_rate = cls.WON_LOSS_RATE if battle_won else cls.LOST_LOSS_RATE
         if is_attacker:
-            base_loss_rate += 0.05  # Attackers generally lose more
+            base_loss_rate += cls.ATTACKER_EXTRA_LOSS_RATE  # Attackers generally lose more
         
         # Add randomness
-        loss_rate = base_loss_rate + random.uniform(-0.05, 0.1)
-        loss_rate = max(0.05, min(0.4, loss_rate))
+        rng = rng or game_random.rng(game_random.next_seed("casualties"))
+        loss_rate = base_loss_rate + rng.uniform(*cls.LOSS_RATE_JITTER)
+        loss_rate = max(cls.MIN_LOSS_RATE, min(cls.MAX_LOSS_RATE, loss_rate))
         
         casualties = int(army_size * loss_rate)
         return min(casualties, army_size)
@@ -112,21 +188,83 @@ class CombatSystem:
     def generate_battle_report(cls, attacker: str, defender: str, success: bool, 
                              stolen_resources: Dict, attacker_losses: int, defender_losses: int) -> str:
         """Generate a battle report description"""
-        if success:
-            report = f"{attacker}'s forces successfully raided {defender}'s kingdom! "
-            if stolen_resources:
-                resource_list = []
-                for resource, amount in stolen_resources.items():
-                    resource_list.append(f"{amount} {resource}")
-                report += f"Stolen: {', '.join(resource_list)}. "
-            else:
-                report += "However, no significant resources were captured. "
-        else:
-            report = f"{attacker}'s raid on {defender}'s kingdom was repelled! "
-        
-        report += f"Casualties - Attacker: {attacker_losses}, Defender: {defender_losses}"
-        
-        return report
+        loot = [stolen_resources.get(resource, 0) for resource in cls.LOOT_RESOURCES]
+        return cls.REPORT_TEMPLATES[cls.report_template(success, loot)].format(
+            attacker=attacker,
+            defender=defender,
+            loot=cls.format_loot(loot),
+            attacker_losses=attacker_losses,
+            defender_losses=defender_losses
+        )
+
+    @classmethod
+    def report_template(cls, success: bool, loot: List[int]) -> str:
+        if not success:
+            return "raid_repelled"
+        return "raid_success" if any(loot) else "raid_success_no_loot"
+
+    @classmethod
+    def format_loot(cls, loot: List[int]) -> str:
+        return ", ".join(f"{amount} {resource}" for resource, amount in zip(cls.LOOT_RESOURCES, loot) if amount)
+
+    @classmethod
+    def build_raid_record(cls, attacker_data: Dict, defender_data: Dict, outcome: Dict) -> Dict:
+        """Compact raid record: a report template id plus numeric parameters
+
+        Loot is a list in LOOT_RESOURCES order and losses are lists in
+        BattleEngine.UNIT_TYPES order; the prose is rendered at read time.
+        """
+        loot = [outcome["stolenResources"].get(resource, 0) for resource in cls.LOOT_RESOURCES]
+        return {
+            "attackerId": attacker_data["userId"],
+            "defenderId": defender_data["userId"],
+            "attackerUsername": attacker_data["username"],
+            "defenderUsername": defender_data["username"],
+            "timestamp": datetime.utcnow(),
+            "success": outcome["success"],
+            "template": cls.report_template(outcome["success"], loot),
+            "params": {
+                "loot": loot,
+                "attackerLosses": [outcome["attackerLosses"].get(unit, 0) for unit in BattleEngine.UNIT_TYPES],
+                "defenderLosses": [outcome["defenderLosses"].get(unit, 0) for unit in BattleEngine.UNIT_TYPES]
+            },
+            "seed": outcome["seed"]
+        }
+
+    @classmethod
+    def render_battle_report(cls, record: Dict) -> str:
+        """Render the prose report of a stored raid record"""
+        if "template" not in record:
+            return record.get("battleReport", "")
+        params = record["params"]
+        return cls.REPORT_TEMPLATES[record["template"]].format(
+            attacker=record["attackerUsername"],
+            defender=record["defenderUsername"],
+            loot=cls.format_loot(params["loot"]),
+            attacker_losses=sum(params["attackerLosses"]),
+            defender_losses=sum(params["defenderLosses"])
+        )
+
+    @classmethod
+    def expand_raid_record(cls, record: Dict) -> Dict:
+        """API view of a stored raid record"""
+        if "template" not in record:
+            return record
+        params = record["params"]
+        return {
+            "id": record.get("id", str(record.get("_id", ""))),
+            "attackerUsername": record["attackerUsername"],
+            "defenderUsername": record["defenderUsername"],
+            "timestamp": record["timestamp"],
+            "success": record["success"],
+            "stolenResources": {r: amount for r, amount in zip(cls.LOOT_RESOURCES, params["loot"]) if amount},
+            "attackerLosses": sum(params["attackerLosses"]),
+            "defenderLosses": sum(params["defenderLosses"]),
+            "attackerUnitLosses": dict(zip(BattleEngine.UNIT_TYPES, params["attackerLosses"])),
+            "defenderUnitLosses": dict(zip(BattleEngine.UNIT_TYPES, params["defenderLosses"])),
+            "battleReport": cls.render_battle_report(record),
+            "seed": record.get("seed")
+        }
 
     @classmethod
     def can_raid_target(cls, attacker_data: Dict, defender_data: Dict) -> Tuple[bool, str]:
@@ -140,9 +278,7 @@ class CombatSystem:
         # Check if target has protection (new players, recently raided, etc.)
         last_raid_time = defender_data.get("lastRaidTime")
         if last_raid_time:
-            from datetime import timedelta
-            protection_time = timedelta(hours=1)  # 1 hour protection after being raided
-            if datetime.utcnow() - last_raid_time < protection_time:
+            if datetime.utcnow() - last_raid_time < cls.RAID_PROTECTION:
                 return False, "Target is under protection"
         
         return True, "Raid allowed"
@@ -0,0 +1,153 @@
+from pathlib import Path
+from typing import Dict, List, Sequence
+import csv
+import numpy as np
+
+from game.combat import CombatSystem
+from game.empire_bonuses import EmpireBonuses
+
+EMPIRES = tuple(EmpireBonuses.EMPIRE_DATA)
+RESOURCES = ("gold", "wood", "stone", "food")
+
+METRICS = ("win_probability", "expected_loot", "attacker_loss_rate", "defender_loss_rate")
+
+def _loss_rates(base: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    low, high = CombatSystem.LOSS_RATE_JITTER
+    rates = base + rng.uniform(low, high, size=base.shape)
+    return np.clip(rates, CombatSystem.MIN_LOSS_RATE, CombatSystem.MAX_LOSS_RATE)
+
+def simulate_raid_grid(attacker_powers: Sequence[float], defender_powers: Sequence[float],
+                       attacker_empire: str, defender_empire: str, trials: int,
+                       rng: np.random.Generator, defender_stock: int = 1000,
+                       chunk: int = 500) -> Dict[str, np.ndarray]:
+    """Monte Carlo estimate of CombatSystem.calculate_raid_result over a power grid
+
+    Powers are battle powers as returned by CombatSystem.calculate_battle_power,
+    before empire bonuses. The defender holds `defender_stock` of every
+    resource. Draws follow calculate_raid_result one for one, vectorized over
+    (attacker power, defender power, trial). Returns (attackers, defenders)
+    arrays of win probability, expected loot and expected loss rates.
+    """
+    attacker = np.asarray(attacker_powers, dtype=np.float64)[:, None, None]
+    defender = np.asarray(defender_powers, dtype=np.float64)[None, :, None]
+    attacker = attacker * EmpireBonuses.get_raid_damage_multiplier(attacker_empire)
+    defender = defender * EmpireBonuses.get_defense_bonus(defender_empire)
+
+    total = attacker + defender
+    base_chance = np.divide(attacker, total, out=np.full(total.shape, 0.5), where=total > 0)
+    max_steal = np.minimum(CombatSystem.MAX_STEAL_PERCENTAGE,
+                           attacker / (defender + 1) * CombatSystem.STEAL_POWER_FACTOR)
+
+    shape = (attacker.shape[0], defender.shape[1])
+    sums = {metric: np.zeros(shape) for metric in METRICS}
+    done = 0
+    while done < trials:
+        size = min(chunk, trials - done)
+        draw_shape = shape + (size,)
+        jitter = rng.uniform(-CombatSystem.WIN_CHANCE_JITTER, CombatSystem.WIN_CHANCE_JITTER, size=draw_shape)
+        chance = np.clip(base_chance + jitter, CombatSystem.MIN_WIN_CHANCE, CombatSystem.MAX_WIN_CHANCE)
+        success = rng.random(draw_shape) < chance
+
+        # random.uniform(a, b) is a + (b - a) * random(), even when b < a
+        steal = CombatSystem.MIN_STEAL_PERCENTAGE + (max_steal[..., None] - CombatSystem.MIN_STEAL_PERCENTAGE) \
+            * rng.random(draw_shape + (len(RESOURCES),))
+        stolen = np.trunc(defender_stock * steal).clip(min=0).sum(axis=-1)
+        loot = np.where(success, stolen, 0)
+
+        # calculate_casualties gets the raid's success as battle_won for both sides
+        won_base = np.where(success, CombatSystem.WON_LOSS_RATE, CombatSystem.LOST_LOSS_RATE)
+        attacker_losses = _loss_rates(won_base + CombatSystem.ATTACKER_EXTRA_LOSS_RATE, rng)
+        defender_losses = _loss_rates(won_base, rng)
+
+        sums["win_probability"] += success.sum(axis=-1)
+        sums["expected_loot"] += loot.sum(axis=-1)
+        sums["attacker_loss_rate"] += attacker_losses.sum(axis=-1)
+        sums["defender_loss_rate"] += defender_losses.sum(axis=-1)
+        done += size
+
+    return {metric: total_sum / trials for metric, total_sum in sums.items()}
+
+def simulate_all_pairings(attacker_powers: Sequence[float], defender_powers: Sequence[float],
+                          trials: int, seed: int = 0, defender_stock: int = 1000) -> List[Dict]:
+    """Run the grid for every (attacker empire, defender empire) pairing"""
+    results = []
+    for pairing, (attacker_empire, defender_empire) in enumerate(
+            (a, d) for a in EMPIRES for d in EMPIRES):
+        rng = np.random.default_rng([seed, pairing])
+        grid = simulate_raid_grid(attacker_powers, defender_powers, attacker_empire, defender_empire,
+                                  trials, rng, defender_stock=defender_stock)
+        results.append({"attackerEmpire": attacker_empire, "defenderEmpire": defender_empire, **grid})
+    return results
+
+def write_heatmaps(results: List[Dict], attacker_powers: Sequence[float],
+                   defender_powers: Sequence[float], output_dir: Path):
+    """One CSV per metric: a row per (pairing, attacker power), a column per defender power"""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for metric in METRICS:
+        with open(output_dir / f"{metric}.csv", "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["attacker_empire", "defender_empire", "attacker_power"]
+                            + [f"{power:g}" for power in defender_powers])
+            for result in results:
+                for row, attacker_power in enumerate(attacker_powers):
+                    writer.writerow([result["attackerEmpire"], result["defenderEmpire"], f"{attacker_power:g}"]
+                                    + [f"{value:.4f}" for value in result[metric][row]])
+
+def compare_with_baseline(results: List[Dict], baseline_dir: Path, tolerance: float) -> List[str]:
+    """List cells whose win probability moved more than `tolerance` from a previous run"""
+    by_pairing = {(r["attackerEmpire"], r["defenderEmpire"]): r for r in results}
+    drifts = []
+    with open(baseline_dir / "win_probability.csv", newline="") as f:
+        reader = csv.reader(f)
+        defender_powers = next(reader)[3:]
+        row_index = {}
+        for row in reader:
+            key = (row[0], row[1])
+            index = row_index.get(key, 0)
+            row_index[key] = index + 1
+            current = by_pairing[key]["win_probability"][index]
+            for column, expected in enumerate(row[3:]):
+                if abs(current[column] - float(expected)) > tolerance:
+                    drifts.append(f"{key[0]} vs {key[1]} at {row[2]} vs {defender_powers[column]}: "
+                                  f"{float(expected):.3f} -> {current[column]:.3f}")
+    return drifts
+
+def main(argv=None):
+    """Simulate raids over a power grid and write win-probability and loot heatmaps"""
+    import argparse
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(description="Monte Carlo raid simulator for CombatSystem balancing")
+    parser.add_argument("--min-power", type=float, default=10)
+    parser.add_argument("--max-power", type=float, default=10000)
+    parser.add_argument("--grid", type=int, default=16, help="power steps per axis (log-spaced)")
+    parser.add_argument("--trials", type=int, default=2000, help="raids per grid cell")
+    parser.add_argument("--defender-stock", type=int, default=1000, help="defender holdings per resource")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", type=Path, default=Path("combat_simulation"))
+    parser.add_argument("--baseline", type=Path, default=None,
+                        help="directory of a previous run; exit 1 if win probabilities drifted")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="allowed win-probability drift (default: 5 sigma of two runs' difference)")
+    args = parser.parse_args(argv)
+
+    powers = np.geomspace(args.min_power, args.max_power, args.grid).round()
+    started = time.perf_counter()
+    results = simulate_all_pairings(powers, powers, args.trials, seed=args.seed,
+                                    defender_stock=args.defender_stock)
+    write_heatmaps(results, powers, powers, args.output_dir)
+    raids = len(results) * len(powers) ** 2 * args.trials
+    print(f"Simulated {raids} raids in {time.perf_counter() - started:.1f}s; heatmaps in {args.output_dir}")
+
+    if args.baseline:
+        # Two independent estimates of p differ with variance 2p(1-p)/trials <= 0.5/trials
+        tolerance = args.tolerance if args.tolerance is not None else 5 * np.sqrt(0.5 / args.trials)
+        drifts = compare_with_baseline(results, args.baseline, tolerance)
+        for drift in drifts:
+            print(f"  drift: {drift}")
+        print(f"{len(drifts)} cells drifted more than {tolerance:.3f} from {args.baseline}")
+        sys.exit(1 if drifts else 0)
+
+if __name__ == "__main__":
+    main()
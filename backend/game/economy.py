@@ -0,0 +1,123 @@
+from typing import Dict, List, Tuple
+import numpy as np
+
+from game.buildings import BuildingSystem
+from game.empire_bonuses import EmpireBonuses
+
+class BatchEconomy:
+    """Vectorized building economics for many players at once
+
+    Players are encoded as a (players x building types) level matrix, with
+    columns in BUILDING_TYPES order, plus an empire index vector into EMPIRES.
+    Every result matches the per-player BuildingSystem methods exactly,
+    including their integer truncation.
+    """
+
+    BUILDING_TYPES = tuple(BuildingSystem.BUILDING_DATA)
+    EMPIRES = tuple(EmpireBonuses.EMPIRE_DATA)
+    RESOURCES = ("gold", "wood", "stone", "food")
+    MAX_LEVELS: np.ndarray
+
+    # Catalog arrays built once at import by _build_arrays()
+    _BASE_PRODUCTION: np.ndarray
+    _BASE_COST: np.ndarray
+    _POWER: np.ndarray
+    _RESOURCE_FACTOR: np.ndarray
+    _BASE_TIME: np.ndarray
+    _TIME_FACTOR: np.ndarray
+
+    @classmethod
+    def _build_arrays(cls):
+        data = BuildingSystem.BUILDING_DATA
+        cls._BASE_PRODUCTION = np.array([
+            [data[t]["production"].get(r, 0) for r in cls.RESOURCES] for t in cls.BUILDING_TYPES
+        ], dtype=np.int64)
+        cls._BASE_COST = np.array([
+            [data[t]["base_cost"].get(r, 0) for r in cls.RESOURCES] for t in cls.BUILDING_TYPES
+        ], dtype=np.int64)
+        cls._POWER = np.array([
+            BuildingSystem.BUILDING_POWER.get(t, BuildingSystem.DEFAULT_BUILDING_POWER)
+            for t in cls.BUILDING_TYPES
+        ], dtype=np.int64)
+        # Same float factor EmpireBonuses.apply_resource_bonus multiplies by
+        cls._RESOURCE_FACTOR = np.array([
+            [1 + EmpireBonuses.get_empire_bonuses(e).get(r, 0) / 100 for r in cls.RESOURCES]
+            for e in cls.EMPIRES
+        ], dtype=np.float64)
+        cls._BASE_TIME = np.array([data[t]["base_time"] for t in cls.BUILDING_TYPES], dtype=np.int64)
+        cls._TIME_FACTOR = np.array([
+            [EmpireBonuses.get_construction_time_multiplier(e, t) for t in cls.BUILDING_TYPES]
+            for e in cls.EMPIRES
+        ], dtype=np.float64)
+        cls.MAX_LEVELS = np.array([data[t]["max_level"] for t in cls.BUILDING_TYPES], dtype=np.int64)
+
+    @classmethod
+    def empire_index(cls, empire: str) -> int:
+        """Get the EMPIRES index of an empire; unknown empires get Norman bonuses like EmpireBonuses"""
+        try:
+            return cls.EMPIRES.index(empire)
+        except ValueError:
+            return cls.EMPIRES.index("norman")
+
+    @classmethod
+    def encode_players(cls, players: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+        """Build the level matrix and empire vector for a list of player documents"""
+        levels = np.zeros((len(players), len(cls.BUILDING_TYPES)), dtype=np.int64)
+        empires = np.zeros(len(players), dtype=np.int64)
+        for row, player in enumerate(players):
+            buildings = BuildingSystem.normalize_buildings(player.get("buildings"))
+            for column, building_type in enumerate(cls.BUILDING_TYPES):
+                state = buildings.get(building_type)
+                if state:
+                    levels[row, column] = state["level"]
+            empires[row] = cls.empire_index(player.get("empire"))
+        return levels, empires
+
+    @classmethod
+    def production(cls, levels: np.ndarray, empires: np.ndarray) -> np.ndarray:
+        """Per-second production, shape (players, RESOURCES)"""
+        # (players, buildings, resources): base * level, then the empire factor
+        # and truncation are applied per building as in apply_resource_bonus
+        scaled = levels[:, :, None] * cls._BASE_PRODUCTION[None, :, :]
+        with_bonus = np.trunc(scaled * cls._RESOURCE_FACTOR[empires][:, None, :])
+        return with_bonus.sum(axis=1).astype(np.int64)
+
+    @classmethod
+    def power(cls, levels: np.ndarray) -> np.ndarray:
+        """Building power per player, shape (players,)"""
+        return levels @ cls._POWER
+
+    @classmethod
+    def power_per_level(cls) -> np.ndarray:
+        """Power one level of each building adds, shape (buildings,)"""
+        return cls._POWER.copy()
+
+    @classmethod
+    def production_per_level(cls, empires: np.ndarray) -> np.ndarray:
+        """Production one level of each building adds, before truncation, shape (players, buildings, RESOURCES)"""
+        return cls._BASE_PRODUCTION[None, :, :] * cls._RESOURCE_FACTOR[empires][:, None, :]
+
+    @classmethod
+    def upgrade_costs(cls, levels: np.ndarray) -> np.ndarray:
+        """Cost of each building's next level, shape (players, buildings, RESOURCES)"""
+        multiplier = np.power(1.5, levels.astype(np.float64))
+        return np.trunc(cls._BASE_COST[None, :, :] * multiplier[:, :, None]).astype(np.int64)
+
+    @classmethod
+    def construction_times(cls, levels: np.ndarray, empires: np.ndarray) -> np.ndarray:
+        """Seconds to build each building's next level, shape (players, buildings)"""
+        multiplier = np.power(1.3, levels.astype(np.float64))
+        return np.trunc(cls._BASE_TIME[None, :] * multiplier * cls._TIME_FACTOR[empires]).astype(np.int64)
+
+    @classmethod
+    def evaluate(cls, levels: np.ndarray, empires: np.ndarray) -> Dict[str, np.ndarray]:
+        """Production, building power and next-level upgrade costs in one pass"""
+        levels = np.asarray(levels, dtype=np.int64)
+        empires = np.asarray(empires, dtype=np.int64)
+        return {
+            "production": cls.production(levels, empires),
+            "power": cls.power(levels),
+            "upgradeCost": cls.upgrade_costs(levels)
+        }
+
+BatchEconomy._build_arrays()
@@ -0,0 +1,198 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+import csv
+import numpy as np
+
+from game.economy import BatchEconomy
+from game.empire_bonuses import EmpireBonuses
+
+# Upgrade policies: each scores the (kingdoms, buildings) candidate upgrades
+# and the simulator starts the best affordable one
+POLICIES = ("greedy", "cheapest", "power")
+
+PERCENTILES = (10, 50, 90)
+TIME_TO_LEVEL_PERCENTILES = (50, 90, 99)
+
+def _policy_scores(policy: str, empires: np.ndarray, costs: np.ndarray) -> np.ndarray:
+    """Score every candidate upgrade; higher is better"""
+    total_cost = costs.sum(axis=2).astype(np.float64)
+    if policy == "cheapest":
+        return -total_cost
+    if policy == "power":
+        return BatchEconomy.power_per_level()[None, :] / total_cost
+    # greedy: extra production per second (after empire bonuses) per resource spent
+    return BatchEconomy.production_per_level(empires).sum(axis=2) / total_cost
+
+def simulate_shard(empire: str, policy: str, kingdoms: int, days: float,
+                   step: int = 300, sample_hours: float = 6, seed: int = 0) -> Dict:
+    """Simulate a batch of synthetic kingdoms of one empire in accelerated time
+
+    Every kingdom starts like a freshly registered player and has its own
+    activity level: the chance, per step, that its owner logs in and starts
+    the upgrade the policy prefers among the idle, affordable buildings
+    below max_level. Production, costs and construction times come from
+    BatchEconomy, i.e. the live BuildingSystem and EmpireBonuses formulas.
+    """
+    rng = np.random.default_rng(seed)
+    buildings = len(BatchEconomy.BUILDING_TYPES)
+    empires = np.full(kingdoms, BatchEconomy.empire_index(empire), dtype=np.int64)
+    levels = np.ones((kingdoms, buildings), dtype=np.int64)
+    starting = EmpireBonuses.get_starting_resources(empire)
+    resources = np.tile(
+        np.array([starting.get(r, 0) for r in BatchEconomy.RESOURCES], dtype=np.float64), (kingdoms, 1)
+    )
+    activity = rng.uniform(0.05, 1.0, size=kingdoms)
+    ready_at = np.full((kingdoms, buildings), np.inf)  # completion time of running constructions
+    max_levels = BatchEconomy.MAX_LEVELS
+    reached_at = np.full((kingdoms, buildings, int(max_levels.max()) + 1), np.nan)
+    reached_at[:, :, 1] = 0.0
+
+    total_seconds = int(days * 86400)
+    sample_every = max(1, int(sample_hours * 3600 // step))
+    samples, sample_times = [], []
+    rows = np.arange(kingdoms)
+
+    for tick, now in enumerate(range(0, total_seconds + 1, step)):
+        # Finish constructions that are due
+        done = ready_at <= now
+        if done.any():
+            levels[done] += 1
+            ready_at[done] = np.inf
+            kingdom_index, building_index = np.nonzero(done)
+            reached_at[kingdom_index, building_index, levels[done]] = now
+
+        if tick % sample_every == 0:
+            power = BatchEconomy.power(levels) + resources.sum(axis=1) // 100
+            samples.append(np.column_stack([resources, power]).astype(np.float32))
+            sample_times.append(now / 3600)
+
+        # Owners who log in this step start their preferred upgrade
+        costs = BatchEconomy.upgrade_costs(levels)
+        candidates = (
+            (rng.random(kingdoms) < activity)[:, None]
+            & np.isinf(ready_at)
+            & (levels < max_levels[None, :])
+            & (costs <= resources[:, None, :]).all(axis=2)
+        )
+        acting = candidates.any(axis=1)
+        if acting.any():
+            scores = np.where(candidates, _policy_scores(policy, empires, costs), -np.inf)
+            choice = scores.argmax(axis=1)[acting]
+            who = rows[acting]
+            resources[who] -= costs[who, choice]
+            ready_at[who, choice] = now + BatchEconomy.construction_times(levels, empires)[who, choice]
+
+        resources += BatchEconomy.production(levels, empires) * step
+
+    return {
+        "empire": empire,
+        "policy": policy,
+        "sampleHours": np.array(sample_times),
+        "samples": np.stack(samples, axis=1),  # (kingdoms, samples, resources + power)
+        "reachedAt": reached_at
+    }
+
+def _run_shard(args) -> Dict:
+    return simulate_shard(*args)
+
+def run_simulation(kingdoms: int, days: float, policies: Dict[str, str], step: int = 300,
+                   sample_hours: float = 6, seed: int = 0, workers: Optional[int] = None,
+                   shard_size: int = 1000) -> List[Dict]:
+    """Simulate `kingdoms` kingdoms per empire across a process pool; returns one merged result per empire"""
+    shards = []
+    for empire_number, empire in enumerate(BatchEconomy.EMPIRES):
+        for shard_number, start in enumerate(range(0, kingdoms, shard_size)):
+            size = min(shard_size, kingdoms - start)
+            shard_seed = seed * 1_000_003 + empire_number * 10_007 + shard_number
+            shards.append((empire, policies[empire], size, days, step, sample_hours, shard_seed))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_run_shard, shards))
+
+    merged = []
+    for empire in BatchEconomy.EMPIRES:
+        parts = [r for r in results if r["empire"] == empire]
+        merged.append({
+            "empire": empire,
+            "policy": parts[0]["policy"],
+            "sampleHours": parts[0]["sampleHours"],
+            "samples": np.concatenate([p["samples"] for p in parts]),
+            "reachedAt": np.concatenate([p["reachedAt"] for p in parts])
+        })
+    return merged
+
+def write_trajectories(results: List[Dict], path: Path):
+    """Per empire, sample time and metric: mean and percentiles across kingdoms"""
+    metrics = BatchEconomy.RESOURCES + ("power",)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["empire", "policy", "hour", "metric", "mean"] + [f"p{p}" for p in PERCENTILES])
+        for result in results:
+            samples = result["samples"]
+            percentiles = np.percentile(samples, PERCENTILES, axis=0)
+            means = samples.mean(axis=0)
+            for index, hour in enumerate(result["sampleHours"]):
+                for metric_index, metric in enumerate(metrics):
+                    writer.writerow(
+                        [result["empire"], result["policy"], f"{hour:g}", metric, f"{means[index, metric_index]:.1f}"]
+                        + [f"{percentiles[p, index, metric_index]:.1f}" for p in range(len(PERCENTILES))]
+                    )
+
+def write_time_to_level(results: List[Dict], path: Path):
+    """Per empire, building and level: how many kingdoms got there and how long it took"""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["empire", "policy", "building", "level", "reached", "kingdoms"]
+                        + [f"p{p}_hours" for p in TIME_TO_LEVEL_PERCENTILES])
+        for result in results:
+            reached_at = result["reachedAt"]
+            kingdoms = reached_at.shape[0]
+            for building_index, building_type in enumerate(BatchEconomy.BUILDING_TYPES):
+                for level in range(2, int(BatchEconomy.MAX_LEVELS[building_index]) + 1):
+                    times = reached_at[:, building_index, level]
+                    times = times[~np.isnan(times)] / 3600
+                    if not len(times):
+                        break
+                    writer.writerow(
+                        [result["empire"], result["policy"], building_type, level, len(times), kingdoms]
+                        + [f"{value:.2f}" for value in np.percentile(times, TIME_TO_LEVEL_PERCENTILES)]
+                    )
+
+def main(argv=None):
+    """Simulate the economy offline and write CSV reports"""
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Simulate Medieval Empires kingdoms to balance the economy")
+    parser.add_argument("--kingdoms", type=int, default=1000, help="kingdoms per empire")
+    parser.add_argument("--days", type=float, default=28, help="game days to simulate")
+    parser.add_argument("--step", type=int, default=300, help="simulated seconds per step")
+    parser.add_argument("--sample-hours", type=float, default=6, help="trajectory sampling interval")
+    parser.add_argument("--policy", choices=POLICIES, default="greedy", help="upgrade policy for every empire")
+    parser.add_argument("--empire-policy", action="append", default=[], metavar="EMPIRE=POLICY",
+                        help="override the policy of one empire, e.g. viking=power")
+    parser.add_argument("--workers", type=int, default=None, help="process pool size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", type=Path, default=Path("simulation_output"))
+    args = parser.parse_args(argv)
+
+    policies = {empire: args.policy for empire in BatchEconomy.EMPIRES}
+    for override in args.empire_policy:
+        empire, _, policy = override.partition("=")
+        if empire not in policies or policy not in POLICIES:
+            parser.error(f"invalid --empire-policy {override!r}")
+        policies[empire] = policy
+
+    started = time.perf_counter()
+    results = run_simulation(args.kingdoms, args.days, policies, step=args.step,
+                             sample_hours=args.sample_hours, seed=args.seed, workers=args.workers)
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    write_trajectories(results, args.output_dir / "trajectories.csv")
+    write_time_to_level(results, args.output_dir / "time_to_level.csv")
+    print(f"Simulated {args.kingdoms * len(results)} kingdoms over {args.days:g} days "
+          f"in {time.perf_counter() - started:.1f}s; reports in {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+from typing import Dict
+from datetime import datetime, timedelta
+import math
+import uuid
+
+class MarchSystem:
+    """Raid marches: armies travel to their target and back before and after the battle"""
+
+    # Map tiles covered per minute; a march moves at the pace of its slowest unit
+    UNIT_SPEED = {
+        "soldiers": 1.0,
+        "archers": 1.0,
+        "cavalry": 2.0
+    }
+    MIN_TRAVEL_SECONDS = 30
+
+    @classmethod
+    def travel_seconds(cls, origin: Dict, target: Dict, army: Dict[str, int]) -> int:
+        """Seconds to march `army` from origin to target coordinates"""
+        distance = math.hypot(target.get("x", 0) - origin.get("x", 0), target.get("y", 0) - origin.get("y", 0))
+        speeds = [cls.UNIT_SPEED.get(unit, 1.0) for unit, count in army.items() if count > 0]
+        speed = min(speeds) if speeds else 1.0
+        return cls.MIN_TRAVEL_SECONDS + int(distance / speed * 60)
+
+    @classmethod
+    def validate_army(cls, requested: Dict[str, int], available: Dict[str, int]) -> Dict[str, int]:
+        """Units to send, checked against the player's army; raises ValueError"""
+        army = {}
+        for unit, count in requested.items():
+            if unit not in cls.UNIT_SPEED:
+                raise ValueError(f"Unknown unit type: {unit}")
+            if not isinstance(count, int) or count < 0:
+                raise ValueError(f"Invalid number of {unit}")
+            if count > available.get(unit, 0):
+                raise ValueError(f"Not enough {unit}")
+            if count:
+                army[unit] = count
+        if not army:
+            raise ValueError("No army available for raid")
+        return army
+
+    @classmethod
+    def create_march(cls, attacker: Dict, defender: Dict, army: Dict[str, int]) -> Dict:
+        """Create a march document for an outbound raid"""
+        origin = attacker.get("coordinates", {"x": 0, "y": 0})
+        target = defender.get("coordinates", {"x": 0, "y": 0})
+        travel_seconds = cls.travel_seconds(origin, target, army)
+        departed_at = datetime.utcnow()
+
+        return {
+            "id": str(uuid.uuid4()),
+            "attackerId": attacker["userId"],
+            "attackerUsername": attacker["username"],
+            "defenderUsername": defender["username"],
+            "army": army,
+            "origin": origin,
+            "target": target,
+            "travelSeconds": travel_seconds,
+            "departedAt": departed_at,
+            "arrivesAt": departed_at + timedelta(seconds=travel_seconds),
+            "status": "marching"
+        }
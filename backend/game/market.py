@@ -0,0 +1,189 @@
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+from collections import deque
+import heapq
+import itertools
+import math
+
+class OrderBook:
+    """Limit order book for one resource pair, in price-time priority
+
+    Prices are in `quote` per unit of `base`. Each side keeps a FIFO queue of
+    resting orders per price level and a heap of its price levels (bids
+    negated so the best price is always on top). Matching pops levels off
+    the heap, so placing an order costs O(log n) in the number of levels
+    plus one step per resting order it fills. Cancelled and filled orders
+    are dropped lazily when they reach the front of their queue.
+    """
+
+    def __init__(self, base: str, quote: str):
+        self.base = base
+        self.quote = quote
+        self.levels: Dict[str, Dict[float, Deque[dict]]] = {"buy": {}, "sell": {}}
+        self.volume: Dict[str, Dict[float, int]] = {"buy": {}, "sell": {}}
+        self.prices: Dict[str, List[float]] = {"buy": [], "sell": []}
+
+    @staticmethod
+    def _heap_key(side: str, price: float) -> float:
+        return -price if side == "buy" else price
+
+    def best(self, side: str) -> Optional[float]:
+        """Best resting price on one side, or None if it is empty"""
+        heap = self.prices[side]
+        while heap:
+            price = abs(heap[0])
+            if price in self.levels[side]:
+                return price
+            heapq.heappop(heap)  # level emptied since it was pushed
+        return None
+
+    def add(self, order: dict):
+        """Rest an order on its side of the book"""
+        side, price = order["side"], order["price"]
+        level = self.levels[side].get(price)
+        if level is None:
+            level = self.levels[side][price] = deque()
+            self.volume[side][price] = 0
+            heapq.heappush(self.prices[side], self._heap_key(side, price))
+        level.append(order)
+        self.volume[side][price] += order["remaining"]
+
+    def remove(self, order: dict):
+        """Take a resting order's remaining quantity off the book"""
+        side, price = order["side"], order["price"]
+        if price not in self.volume[side]:
+            return
+        self.volume[side][price] -= order["remaining"]
+        order["remaining"] = 0
+        if self.volume[side][price] <= 0:
+            del self.levels[side][price]
+            del self.volume[side][price]
+
+    def match(self, order: dict) -> List[Tuple[dict, int, float]]:
+        """Fill an incoming order against the opposite side
+
+        Returns (resting order, quantity, price) fills at the resting
+        orders' prices and leaves the incoming order's remaining quantity
+        for the caller to rest or discard.
+        """
+        opposite = "sell" if order["side"] == "buy" else "buy"
+        fills = []
+        while order["remaining"] > 0:
+            price = self.best(opposite)
+            if price is None:
+                break
+            if (order["side"] == "buy" and price > order["price"]) or \
+               (order["side"] == "sell" and price < order["price"]):
+                break
+
+            level = self.levels[opposite][price]
+            resting = level[0]
+            if resting["remaining"] <= 0:
+                level.popleft()
+                if not level:
+                    del self.levels[opposite][price]
+                    del self.volume[opposite][price]
+                continue
+
+            quantity = min(order["remaining"], resting["remaining"])
+            order["remaining"] -= quantity
+            resting["remaining"] -= quantity
+            self.volume[opposite][price] -= quantity
+            fills.append((resting, quantity, price))
+            if resting["remaining"] == 0:
+                level.popleft()
+                if not level:
+                    del self.levels[opposite][price]
+                    del self.volume[opposite][price]
+        return fills
+
+    def depth(self, levels: int = 10) -> Dict[str, List[List]]:
+        """Aggregated [price, quantity] levels on each side, best first"""
+        return {
+            "bids": [[price, self.volume["buy"][price]]
+                     for price in heapq.nlargest(levels, self.volume["buy"])],
+            "asks": [[price, self.volume["sell"][price]]
+                     for price in heapq.nsmallest(levels, self.volume["sell"])]
+        }
+
+class Market:
+    """Order books for every tradeable resource pair
+
+    A pair is written "base/quote" with base before quote in RESOURCES order,
+    so each pair of resources has exactly one book. Buying spends quote to get
+    base; selling gives base for quote.
+    """
+
+    RESOURCES = ("wood", "stone", "food", "gold")
+    PRICE_DECIMALS = 4
+
+    def __init__(self):
+        self.books: Dict[str, OrderBook] = {}
+        for base, quote in itertools.combinations(self.RESOURCES, 2):
+            self.books[f"{base}/{quote}"] = OrderBook(base, quote)
+        self.orders: Dict[str, dict] = {}  # open orders by id
+
+    def book(self, pair: str) -> OrderBook:
+        """Book for a pair; raises ValueError for unknown pairs"""
+        if pair not in self.books:
+            raise ValueError(f"Unknown resource pair {pair}; use one of {', '.join(self.books)}")
+        return self.books[pair]
+
+    @classmethod
+    def quote_amount(cls, quantity: int, price: float) -> int:
+        """Quote resources a fill of `quantity` at `price` pays, rounded down"""
+        return math.floor(round(quantity * price, cls.PRICE_DECIMALS + 2))
+
+    @classmethod
+    def escrow_for(cls, side: str, quantity: int, price: float) -> int:
+        """Resources locked by a new order: base to sell, or quote for the worst-case buy"""
+        if side == "sell":
+            return quantity
+        return math.ceil(round(quantity * price, cls.PRICE_DECIMALS + 2))
+
+    def validate(self, pair: str, side: str, price, quantity) -> Tuple[float, int]:
+        """Normalized (price, quantity) for a new order; raises ValueError"""
+        self.book(pair)
+        if side not in ("buy", "sell"):
+            raise ValueError("Side must be 'buy' or 'sell'")
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity <= 0:
+            raise ValueError("Quantity must be a positive whole number")
+        if not isinstance(price, (int, float)) or isinstance(price, bool):
+            raise ValueError("Price must be a number")
+        price = round(float(price), self.PRICE_DECIMALS)
+        if price <= 0:
+            raise ValueError("Price must be positive")
+        return price, quantity
+
+    def load(self, orders: Iterable[dict]):
+        """Rebuild the books from persisted open orders, oldest first"""
+        for order in sorted(orders, key=lambda o: o["createdAt"]):
+            self.orders[order["id"]] = order
+            self.books[order["pair"]].add(order)
+
+    def place(self, order: dict) -> List[Tuple[dict, int, float]]:
+        """Match a new order and rest whatever is left of it"""
+        book = self.book(order["pair"])
+        fills = book.match(order)
+        for resting, _, _ in fills:
+            if resting["remaining"] == 0:
+                self.orders.pop(resting["id"], None)
+        if order["remaining"] > 0:
+            book.add(order)
+            self.orders[order["id"]] = order
+        return fills
+
+    def cancel(self, order_id: str) -> Optional[dict]:
+        """Pull an open order off its book; returns a copy of it with its unfilled quantity
+
+        The booked order itself is left with nothing remaining, so matching
+        skips it until it is dropped from its queue.
+        """
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None
+        cancelled = dict(order)
+        self.books[order["pair"]].remove(order)
+        return cancelled
+
+    def orders_of(self, username: str) -> List[dict]:
+        return [order for order in self.orders.values() if order["username"] == username]
@@ -0,0 +1,209 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from datetime import datetime, timedelta
+
+from game.market import Market
+
+EPOCH = datetime(1970, 1, 1)
+
+def epoch_seconds(at: datetime) -> int:
+    """Whole seconds since the epoch of a naive UTC datetime"""
+    return int((at - EPOCH).total_seconds())
+
+class PriceWindow:
+    """Rolling statistics over `buckets` fixed-length time buckets
+
+    Buckets live in a ring: bucket number t (seconds since epoch divided by
+    the bucket length) goes to slot t % buckets and is reset when a newer
+    bucket reuses the slot, so memory stays fixed however many trades come in.
+    """
+
+    def __init__(self, bucket_seconds: int, buckets: int):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.ids = [-1] * buckets
+        self.volume = [0] * buckets
+        self.notional = [0.0] * buckets
+        self.trades = [0] * buckets
+        self.low = [0.0] * buckets
+        self.high = [0.0] * buckets
+        self.dirty: set = set()
+
+    def bucket_id(self, at: datetime) -> int:
+        return epoch_seconds(at) // self.bucket_seconds
+
+    def _slot(self, bucket_id: int) -> int:
+        slot = bucket_id % self.buckets
+        if self.ids[slot] != bucket_id:
+            self.ids[slot] = bucket_id
+            self.volume[slot] = 0
+            self.notional[slot] = 0.0
+            self.trades[slot] = 0
+        return slot
+
+    def add(self, at: datetime, price: float, quantity: int):
+        bucket_id = self.bucket_id(at)
+        slot = self._slot(bucket_id)
+        if self.trades[slot] == 0:
+            self.low[slot] = self.high[slot] = price
+        else:
+            self.low[slot] = min(self.low[slot], price)
+            self.high[slot] = max(self.high[slot], price)
+        self.volume[slot] += quantity
+        self.notional[slot] += price * quantity
+        self.trades[slot] += 1
+        self.dirty.add(bucket_id)
+
+    def restore(self, bucket_id: int, volume: int, notional: float, trades: int, low: float, high: float):
+        """Load a checkpointed bucket"""
+        slot = self._slot(bucket_id)
+        self.volume[slot], self.notional[slot], self.trades[slot] = volume, notional, trades
+        self.low[slot], self.high[slot] = low, high
+
+    def bucket(self, bucket_id: int) -> Optional[Dict]:
+        slot = bucket_id % self.buckets
+        if self.ids[slot] != bucket_id or not self.trades[slot]:
+            return None
+        return {"volume": self.volume[slot], "notional": self.notional[slot], "trades": self.trades[slot],
+                "low": self.low[slot], "high": self.high[slot]}
+
+    def summary(self, now: datetime) -> Dict:
+        """VWAP, volume, trade count and price range over the window ending now"""
+        newest = self.bucket_id(now)
+        volume = trades = 0
+        notional = 0.0
+        low = high = None
+        for slot in range(self.buckets):
+            if self.trades[slot] == 0 or not newest - self.buckets < self.ids[slot] <= newest:
+                continue
+            volume += self.volume[slot]
+            notional += self.notional[slot]
+            trades += self.trades[slot]
+            low = self.low[slot] if low is None else min(low, self.low[slot])
+            high = self.high[slot] if high is None else max(high, self.high[slot])
+        return {
+            "vwap": round(notional / volume, Market.PRICE_DECIMALS) if volume else None,
+            "volume": volume,
+            "trades": trades,
+            "min": low,
+            "max": high
+        }
+
+class PriceIndex:
+    """Streaming per-pair market statistics over rolling 1h, 24h and 7d windows
+
+    record() costs one bucket update per window. Summaries are cached per
+    pair and only recomputed on the first read after a trade, so serving the
+    index is O(1). Touched buckets are checkpointed to the `market_prices`
+    collection and reloaded on startup.
+    """
+
+    # window -> (bucket length in seconds, number of buckets)
+    WINDOWS = {
+        "1h": (60, 60),
+        "24h": (900, 96),
+        "7d": (3600, 168)
+    }
+
+    def __init__(self):
+        self.windows: Dict[str, Dict[str, PriceWindow]] = {}
+        self.last: Dict[str, Dict] = {}
+        self._snapshots: Dict[str, Tuple[Dict, int]] = {}
+
+    @staticmethod
+    def trade_pair(offering: Dict[str, int], requesting: Dict[str, int]) -> Optional[Tuple[str, float, int]]:
+        """(pair, price, base quantity) of a one-resource-for-one-resource trade, else None"""
+        if len(offering) != 1 or len(requesting) != 1:
+            return None
+        (given, given_amount), (taken, taken_amount) = next(iter(offering.items())), next(iter(requesting.items()))
+        if given == taken or given not in Market.RESOURCES or taken not in Market.RESOURCES:
+            return None
+        if Market.RESOURCES.index(given) < Market.RESOURCES.index(taken):
+            base, base_amount, quote, quote_amount = given, given_amount, taken, taken_amount
+        else:
+            base, base_amount, quote, quote_amount = taken, taken_amount, given, given_amount
+        if base_amount <= 0:
+            return None
+        return f"{base}/{quote}", round(quote_amount / base_amount, Market.PRICE_DECIMALS), base_amount
+
+    def _pair_windows(self, pair: str) -> Dict[str, PriceWindow]:
+        if pair not in self.windows:
+            self.windows[pair] = {
+                name: PriceWindow(bucket_seconds, buckets)
+                for name, (bucket_seconds, buckets) in self.WINDOWS.items()
+            }
+        return self.windows[pair]
+
+    def record(self, pair: str, price: float, quantity: int, at: Optional[datetime] = None):
+        """Add one settled trade of `quantity` base units at `price`"""
+        at = at or datetime.utcnow()
+        for window in self._pair_windows(pair).values():
+            window.add(at, price, quantity)
+        if pair not in self.last or self.last[pair]["at"] <= at:
+            self.last[pair] = {"price": price, "at": at}
+        self._snapshots.pop(pair, None)
+
+    def snapshot(self, pair: str, now: Optional[datetime] = None) -> Dict:
+        """Last price and per-window statistics of a pair"""
+        now = now or datetime.utcnow()
+        minute = epoch_seconds(now) // 60
+        cached = self._snapshots.get(pair)
+        # Windows slide by the minute, so a cached summary stays valid until then
+        if cached is not None and cached[1] == minute:
+            return cached[0]
+        last = self.last.get(pair)
+        snapshot = {
+            "pair": pair,
+            "last": last["price"] if last else None,
+            "lastTradeAt": last["at"].isoformat() if last else None,
+            "windows": {name: window.summary(now) for name, window in self._pair_windows(pair).items()}
+        }
+        self._snapshots[pair] = (snapshot, minute)
+        return snapshot
+
+    def checkpoint_documents(self) -> List[Dict]:
+        """Buckets touched since the last checkpoint as compact documents, plus last prices
+
+        Bucket documents are keyed by (pair, window, bucketStart); the last
+        price of a pair is one document with window "last".
+        """
+        documents = []
+        for pair, windows in self.windows.items():
+            touched = False
+            for name, window in windows.items():
+                for bucket_id in sorted(window.dirty):
+                    bucket = window.bucket(bucket_id)
+                    if bucket is None:
+                        continue
+                    touched = True
+                    documents.append({
+                        "pair": pair,
+                        "window": name,
+                        "bucketStart": EPOCH + timedelta(seconds=bucket_id * window.bucket_seconds),
+                        "v": bucket["volume"],
+                        "q": bucket["notional"],
+                        "n": bucket["trades"],
+                        "lo": bucket["low"],
+                        "hi": bucket["high"]
+                    })
+                window.dirty.clear()
+            if touched and pair in self.last:
+                documents.append({"pair": pair, "window": "last", "bucketStart": self.last[pair]["at"],
+                                  "price": self.last[pair]["price"]})
+        return documents
+
+    def restore(self, documents: Iterable[Dict]):
+        """Reload checkpoint documents, oldest bucket first"""
+        for document in documents:
+            if document["window"] == "last":
+                self.last[document["pair"]] = {"price": document["price"], "at": document["bucketStart"]}
+                continue
+            window = self._pair_windows(document["pair"]).get(document["window"])
+            if window is None:
+                continue
+            bucket_id = epoch_seconds(document["bucketStart"]) // window.bucket_seconds
+            window.restore(bucket_id, document["v"], document["q"], document["n"], document["lo"], document["hi"])
+
+    @classmethod
+    def retention(cls) -> timedelta:
+        """Longest window; older checkpoints are no longer needed"""
+        return max(timedelta(seconds=seconds * buckets) for seconds, buckets in cls.WINDOWS.values())
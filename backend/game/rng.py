@@ -0,0 +1,60 @@
+from typing import Optional
+import hashlib
+import itertools
+import os
+import random
+import numpy as np
+
+# Seeds are stored with march and raid documents, and BSON integers are signed 64-bit
+SEED_MASK = (1 << 63) - 1
+
+def stable_seed(*labels) -> int:
+    """63-bit seed derived from labels only, identical across processes and restarts"""
+    digest = hashlib.blake2b(repr(labels).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & SEED_MASK
+
+class GameRandom:
+    """Single source of randomness for combat, AI and matchmaking
+
+    Every consumer draws from its own random.Random (or NumPy Generator)
+    seeded from the root seed, a label and a per-process counter. With
+    GAME_RNG_SEED set, a run that serves the same requests in the same order
+    draws the same numbers; the seed handed to each request is stored with
+    its result so a single battle can be replayed on its own.
+    """
+
+    def __init__(self, root_seed: Optional[int] = None):
+        self._root_seed = root_seed
+        self._counter = itertools.count()
+
+    @property
+    def root_seed(self) -> int:
+        # Read lazily: server.py loads .env after importing the modules using this
+        if self._root_seed is None:
+            configured = os.environ.get("GAME_RNG_SEED")
+            self._root_seed = int(configured) if configured else int.from_bytes(os.urandom(8), "big") & SEED_MASK
+        return self._root_seed
+
+    def seed(self, root_seed: int):
+        """Restart the sequence from a fixed root seed"""
+        self._root_seed = root_seed
+        self._counter = itertools.count()
+
+    def derive_seed(self, *labels) -> int:
+        """Seed for a named stream, fixed for a given root seed"""
+        return stable_seed(self.root_seed, *labels)
+
+    def next_seed(self, label: str) -> int:
+        """Fresh seed for one request or job run"""
+        return self.derive_seed(label, next(self._counter))
+
+    @staticmethod
+    def rng(seed: int) -> random.Random:
+        return random.Random(seed)
+
+    @staticmethod
+    def numpy(seed: int) -> np.random.Generator:
+        return np.random.default_rng(seed)
+
+# Global instance
+game_random = GameRandom()
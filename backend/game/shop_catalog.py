@@ -0,0 +1,137 @@
+from typing import Callable, Dict, Optional, Tuple
+from pathlib import Path
+import hashlib
+import json
+import logging
+import os
+import time
+
+from game.market import Market
+
+logger = logging.getLogger(__name__)
+
+# (player field increments, inventory increments) granted by buying `quantity` of an item
+Grant = Tuple[Dict[str, int], Dict[str, int]]
+EffectHandler = Callable[[dict, int], Grant]
+
+class ShopCatalog:
+    """The shop's items, loaded once from a JSON file and indexed by id
+
+    Each item names an effect type; EFFECTS maps the type to a handler that
+    turns a purchase into field increments, so adding an item with an
+    existing effect is a data change only. The public listing is serialized
+    once per load with a strong ETag. Workers check the file's modification
+    time at most every RELOAD_CHECK_INTERVAL seconds and reload it when it
+    changed; a file that fails validation is logged and the previous catalog
+    stays in place.
+    """
+
+    DEFAULT_PATH = Path(__file__).parent / "shop_catalog.json"
+    RELOAD_CHECK_INTERVAL = 5.0
+    MAX_QUANTITY = 100
+
+    # Effect type -> handler, built once at import by _build_effects()
+    EFFECTS: Dict[str, EffectHandler] = {}
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = Path(path or os.environ.get("SHOP_CATALOG_PATH") or self.DEFAULT_PATH)
+        self.items: Dict[str, dict] = {}
+        self.aliases: Dict[str, str] = {}  # legacy item id -> id
+        self.body = b""
+        self.etag = ""
+        self._mtime = None
+        self._checked_at = 0.0
+        self.load()
+
+    # Effects
+    @staticmethod
+    def _inventory_effect(item: dict, quantity: int) -> Grant:
+        return {}, {item["id"]: quantity}
+
+    @staticmethod
+    def _resources_effect(item: dict, quantity: int) -> Grant:
+        return {f"resources.{resource}": amount * quantity
+                for resource, amount in item["effect"]["values"].items()}, {}
+
+    @staticmethod
+    def _army_effect(item: dict, quantity: int) -> Grant:
+        return {f"army.{unit}": amount * quantity
+                for unit, amount in item["effect"]["values"].items()}, {}
+
+    @classmethod
+    def _build_effects(cls):
+        cls.EFFECTS = {
+            "inventory": cls._inventory_effect,
+            "resources": cls._resources_effect,
+            "army": cls._army_effect
+        }
+
+    # Loading
+    @classmethod
+    def _validate(cls, items: list) -> Dict[str, dict]:
+        """Items by id; raises ValueError on anything a purchase could trip over"""
+        by_id = {}
+        for item in items:
+            item_id = item.get("id")
+            if not item_id or item_id in by_id:
+                raise ValueError(f"Missing or duplicate item id {item_id!r}")
+            for resource, amount in item.get("price", {}).items():
+                if resource not in Market.RESOURCES or not isinstance(amount, int) or amount <= 0:
+                    raise ValueError(f"Invalid price of {item_id}: {resource}={amount!r}")
+            effect = item.get("effect", {})
+            if effect.get("type") not in cls.EFFECTS:
+                raise ValueError(f"Unknown effect type of {item_id}: {effect.get('type')!r}")
+            if effect["type"] == "resources" and any(r not in Market.RESOURCES for r in effect.get("values", {})):
+                raise ValueError(f"Invalid resources granted by {item_id}")
+            by_id[item_id] = item
+        return by_id
+
+    def load(self):
+        """(Re)read the catalog file; raises on a missing or invalid file"""
+        mtime = self.path.stat().st_mtime_ns
+        with open(self.path) as f:
+            document = json.load(f)
+        items = self._validate(document.get("items", []))
+
+        self.items = items
+        self.aliases = {alias: item_id for item_id, item in items.items() for alias in item.get("aliases", [])}
+        listing = [
+            {key: value for key, value in item.items() if key != "aliases"}
+            for item in items.values() if item.get("available", True)
+        ]
+        self.body = json.dumps({"success": True, "items": listing}, separators=(",", ":")).encode()
+        self.etag = f'"{hashlib.blake2b(self.body, digest_size=12).hexdigest()}"'
+        self._mtime = mtime
+        self._checked_at = time.monotonic()
+
+    def refresh(self) -> bool:
+        """Reload if the file changed since the last check; True when a new catalog was loaded"""
+        if time.monotonic() - self._checked_at < self.RELOAD_CHECK_INTERVAL:
+            return False
+        self._checked_at = time.monotonic()
+        try:
+            if self.path.stat().st_mtime_ns == self._mtime:
+                return False
+            self.load()
+            logger.info(f"Reloaded shop catalog from {self.path} ({len(self.items)} items)")
+            return True
+        except Exception as e:
+            logger.error(f"Keeping the current shop catalog, reload failed: {e}")
+            return False
+
+    # Purchases
+    def get(self, item_id: str) -> Optional[dict]:
+        """Item by id, also accepting legacy ids"""
+        return self.items.get(item_id) or self.items.get(self.aliases.get(item_id, ""))
+
+    def cost(self, item: dict, quantity: int) -> Dict[str, int]:
+        return {resource: amount * quantity for resource, amount in item["price"].items()}
+
+    def grant(self, item: dict, quantity: int) -> Grant:
+        """Field and inventory increments a purchase of `quantity` items gives"""
+        return self.EFFECTS[item["effect"]["type"]](item, quantity)
+
+ShopCatalog._build_effects()
+
+# Global shop catalog instance
+shop_catalog = ShopCatalog()
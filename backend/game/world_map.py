@@ -0,0 +1,194 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from datetime import datetime
+import heapq
+import math
+
+Slot = Tuple[int, int]
+
+class WorldMap:
+    """Castle placement and proximity search over the world map
+
+    The map is a WORLD_WIDTH x WORLD_HEIGHT plane divided into castle slots
+    SLOT_SPACING tiles apart. New kingdoms take the free slot closest to the
+    centre (slots are handed out along a square spiral; slots freed by deleted
+    players are reused first), so the populated area grows as a compact disc.
+
+    Placed players are mirrored in a uniform grid of CELL_SIZE buckets.
+    nearest() walks rings of cells outward from the player and stops as soon
+    as no unvisited cell can hold anything closer than the k-th match, so a
+    query touches a handful of buckets whatever the world population.
+    """
+
+    WORLD_WIDTH = 1000
+    WORLD_HEIGHT = 800
+    SLOT_SPACING = 4
+    CELL_SIZE = 40
+
+    # Raid targets between half and twice the player's power
+    POWER_BAND = (0.5, 2.0)
+
+    def __init__(self):
+        self.columns = self.WORLD_WIDTH // self.SLOT_SPACING
+        self.rows = self.WORLD_HEIGHT // self.SLOT_SPACING
+        self.capacity = self.columns * self.rows
+
+        self.occupied: set = set()
+        self._spiral = self._spiral_slots()
+        self._allocated_ranks: List[Slot] = []  # spiral order of slots handed out so far
+        self._rank: Dict[Slot, int] = {}
+        self._freed: List[Tuple[int, Slot]] = []  # heap of released slots by spiral rank
+
+        self.cells: Dict[Tuple[int, int], Dict[str, dict]] = {}
+        self.entries: Dict[str, dict] = {}
+
+    # Slot allocation
+    def _spiral_slots(self) -> Iterator[Slot]:
+        """Every slot of the map, from the centre outward along a square spiral"""
+        cx, cy = self.columns // 2, self.rows // 2
+        yield cx, cy
+        for radius in range(1, max(self.columns, self.rows)):
+            ring = [(cx + dx, cy - radius) for dx in range(-radius, radius + 1)]
+            ring += [(cx + radius, cy + dy) for dy in range(-radius + 1, radius + 1)]
+            ring += [(cx + dx, cy + radius) for dx in range(radius - 1, -radius - 1, -1)]
+            ring += [(cx - radius, cy + dy) for dy in range(radius - 1, -radius, -1)]
+            for sx, sy in ring:
+                if 0 <= sx < self.columns and 0 <= sy < self.rows:
+                    yield sx, sy
+
+    def slot_of(self, coordinates: Dict) -> Optional[Slot]:
+        """Slot a castle sits on, or None for coordinates off the slot grid"""
+        x, y = coordinates.get("x", 0), coordinates.get("y", 0)
+        if x % self.SLOT_SPACING or y % self.SLOT_SPACING:
+            return None
+        slot = (int(x) // self.SLOT_SPACING, int(y) // self.SLOT_SPACING)
+        if 0 <= slot[0] < self.columns and 0 <= slot[1] < self.rows:
+            return slot
+        return None
+
+    def coordinates_of(self, slot: Slot) -> Dict[str, int]:
+        return {"x": slot[0] * self.SLOT_SPACING, "y": slot[1] * self.SLOT_SPACING}
+
+    @staticmethod
+    def slot_key(slot: Slot) -> str:
+        """Id of a slot claim in the world_slots collection"""
+        return f"{slot[0]}:{slot[1]}"
+
+    def mark_occupied(self, slot: Slot):
+        self.occupied.add(slot)
+
+    def allocate(self) -> Slot:
+        """Next free slot closest to the centre; raises RuntimeError when the map is full"""
+        while self._freed:
+            _, slot = heapq.heappop(self._freed)
+            if slot not in self.occupied:
+                self.occupied.add(slot)
+                return slot
+        for slot in self._spiral:
+            self._rank[slot] = len(self._allocated_ranks)
+            self._allocated_ranks.append(slot)
+            if slot not in self.occupied:
+                self.occupied.add(slot)
+                return slot
+        raise RuntimeError("The world map is full")
+
+    def release(self, slot: Slot):
+        """Give a slot back; it is the next one handed out if it lies inside the settled area"""
+        self.occupied.discard(slot)
+        if slot in self._rank:
+            heapq.heappush(self._freed, (self._rank[slot], slot))
+
+    # Spatial mirror
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        return int(x) // self.CELL_SIZE, int(y) // self.CELL_SIZE
+
+    def place(self, player: dict):
+        """Add or refresh a player's entry from a player document"""
+        coordinates = player.get("coordinates") or {"x": 0, "y": 0}
+        entry = {
+            "username": player["username"],
+            "x": coordinates.get("x", 0),
+            "y": coordinates.get("y", 0),
+            "power": player.get("power", 0),
+            "lastRaidTime": player.get("lastRaidTime")
+        }
+        previous = self.entries.get(entry["username"])
+        if previous is not None and (previous["x"], previous["y"]) != (entry["x"], entry["y"]):
+            self.remove(entry["username"])
+        self.entries[entry["username"]] = entry
+        self.cells.setdefault(self._cell(entry["x"], entry["y"]), {})[entry["username"]] = entry
+
+    def update(self, username: str, fields: Dict):
+        """Apply the position, power and raid-protection fields of a player write"""
+        entry = self.entries.get(username)
+        if entry is None:
+            return
+        if "coordinates" in fields:
+            self.place({**entry, "coordinates": fields["coordinates"]})
+            entry = self.entries[username]
+        if "power" in fields:
+            entry["power"] = fields["power"]
+        if "lastRaidTime" in fields:
+            entry["lastRaidTime"] = fields["lastRaidTime"]
+
+    def remove(self, username: str):
+        entry = self.entries.pop(username, None)
+        if entry is None:
+            return
+        cell = self._cell(entry["x"], entry["y"])
+        bucket = self.cells.get(cell)
+        if bucket is not None:
+            bucket.pop(username, None)
+            if not bucket:
+                del self.cells[cell]
+
+    def sync(self, players: Iterable[dict]):
+        """Rebuild the mirror from a full read of the players collection"""
+        self.cells = {}
+        self.entries = {}
+        for player in players:
+            self.place(player)
+
+    def nearest(self, username: str, k: int = 10, power_band: Tuple[float, float] = POWER_BAND,
+                protected_since: Optional[datetime] = None) -> List[Tuple[float, str]]:
+        """(distance, username) of the k closest players within the power band
+
+        Players raided after `protected_since` are still under raid protection
+        and skipped.
+        """
+        origin = self.entries.get(username)
+        if origin is None or k <= 0:
+            return []
+        low, high = origin["power"] * power_band[0], origin["power"] * power_band[1]
+        ox, oy = origin["x"], origin["y"]
+        cx, cy = self._cell(ox, oy)
+
+        best: List[Tuple[float, str]] = []  # max-heap of (-distance, username)
+        max_ring = max(self.WORLD_WIDTH, self.WORLD_HEIGHT) // self.CELL_SIZE + 1
+        for ring in range(max_ring + 1):
+            # Anything in this ring is at least (ring - 1) cells away
+            if len(best) == k and (ring - 1) * self.CELL_SIZE > -best[0][0]:
+                break
+            for cell in self._ring_cells(cx, cy, ring):
+                for entry in self.cells.get(cell, {}).values():
+                    if entry["username"] == username or not low <= entry["power"] <= high:
+                        continue
+                    if protected_since and entry["lastRaidTime"] and entry["lastRaidTime"] > protected_since:
+                        continue
+                    distance = math.hypot(entry["x"] - ox, entry["y"] - oy)
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, entry["username"]))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, entry["username"]))
+        return sorted((-distance, name) for distance, name in best)
+
+    @staticmethod
+    def _ring_cells(cx: int, cy: int, ring: int) -> Iterator[Tuple[int, int]]:
+        if ring == 0:
+            yield cx, cy
+            return
+        for dx in range(-ring, ring + 1):
+            yield cx + dx, cy - ring
+            yield cx + dx, cy + ring
+        for dy in range(-ring + 1, ring):
+            yield cx - ring, cy + dy
+            yield cx + ring, cy + dy
@@ -0,0 +1,157 @@
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import json
+import math
+
+from game.rng import game_random, stable_seed
+from game.world_map import WorldMap
+
+Tile = Tuple[int, int]
+
+class WorldTiles:
+    """Per-tile summaries of the world map for viewport queries
+
+    The map is cut into TILE_SIZE x TILE_SIZE tiles. Each tile keeps the
+    kingdoms whose castle stands on it and the alliances they fly the flag
+    of. Registering, moving or changing alliance only touches the tiles
+    involved: their cached summary and ETag are dropped and rebuilt on the
+    next read, so clients holding an unchanged tile's ETag skip it.
+    """
+
+    TILE_SIZE = 100
+
+    # Kingdom fields shown on the map; power is left out on purpose so tiles
+    # do not change every time a resource tick lands
+    KINGDOM_FIELDS = ("username", "kingdomName", "empire")
+
+    FLAG_COLORS = ("red", "blue", "green", "purple", "gold", "silver")
+    FLAG_SYMBOLS = ("crown", "sword", "shield", "dragon", "eagle", "lion")
+    FLAG_PATTERNS = ("solid", "stripes", "cross", "diagonal")
+
+    def __init__(self):
+        self.columns = math.ceil(WorldMap.WORLD_WIDTH / self.TILE_SIZE)
+        self.rows = math.ceil(WorldMap.WORLD_HEIGHT / self.TILE_SIZE)
+
+        self.kingdoms: Dict[str, dict] = {}           # username -> kingdom entry
+        self.tiles: Dict[Tile, Dict[str, dict]] = {}  # tile -> username -> kingdom entry
+        self.memberships: Dict[str, str] = {}         # username -> alliance id
+        self.alliances: Dict[str, dict] = {}          # alliance id -> {name, flag, members}
+        self._summaries: Dict[Tile, Tuple[dict, str]] = {}
+
+    @classmethod
+    def alliance_flag(cls, alliance_id: str) -> Dict[str, str]:
+        """Flag of an alliance, drawn from a seed of its id so it never changes"""
+        rng = game_random.rng(stable_seed("alliance-flag", alliance_id))
+        return {
+            "color": rng.choice(cls.FLAG_COLORS),
+            "symbol": rng.choice(cls.FLAG_SYMBOLS),
+            "pattern": rng.choice(cls.FLAG_PATTERNS)
+        }
+
+    def tile_of(self, x: float, y: float) -> Tile:
+        return (min(max(int(x) // self.TILE_SIZE, 0), self.columns - 1),
+                min(max(int(y) // self.TILE_SIZE, 0), self.rows - 1))
+
+    def _touch(self, tile: Tile):
+        self._summaries.pop(tile, None)
+
+    # Incremental maintenance
+    def place(self, player: dict):
+        """Add a kingdom, or move/refresh it from a player document"""
+        coordinates = player.get("coordinates") or {"x": 0, "y": 0}
+        entry = {field: player.get(field) for field in self.KINGDOM_FIELDS}
+        entry["x"], entry["y"] = coordinates.get("x", 0), coordinates.get("y", 0)
+
+        previous = self.kingdoms.get(entry["username"])
+        if previous is not None:
+            if all(previous.get(field) == value for field, value in entry.items()):
+                return
+            self.remove(entry["username"])
+
+        tile = self.tile_of(entry["x"], entry["y"])
+        self.kingdoms[entry["username"]] = entry
+        self.tiles.setdefault(tile, {})[entry["username"]] = entry
+        self._touch(tile)
+
+    def update(self, username: str, fields: Dict):
+        """Apply the map-visible fields of a player write"""
+        kingdom = self.kingdoms.get(username)
+        if kingdom is None or not any(field in fields for field in self.KINGDOM_FIELDS + ("coordinates",)):
+            return
+        player = {field: fields.get(field, kingdom[field]) for field in self.KINGDOM_FIELDS}
+        player["coordinates"] = fields.get("coordinates", {"x": kingdom["x"], "y": kingdom["y"]})
+        self.place(player)
+
+    def remove(self, username: str):
+        kingdom = self.kingdoms.pop(username, None)
+        if kingdom is None:
+            return
+        tile = self.tile_of(kingdom["x"], kingdom["y"])
+        bucket = self.tiles.get(tile)
+        if bucket is not None:
+            bucket.pop(username, None)
+            if not bucket:
+                del self.tiles[tile]
+        self._touch(tile)
+
+    def add_alliance(self, alliance_id: str, name: str, members: Optional[List[str]] = None):
+        self.alliances[alliance_id] = {"name": name, "flag": self.alliance_flag(alliance_id), "members": set()}
+        for username in members or []:
+            self.set_alliance(username, alliance_id)
+
+    def remove_alliance(self, alliance_id: str):
+        alliance = self.alliances.get(alliance_id)
+        if alliance is None:
+            return
+        for username in list(alliance["members"]):
+            self.set_alliance(username, None)
+        del self.alliances[alliance_id]
+
+    def set_alliance(self, username: str, alliance_id: Optional[str]):
+        """Record that a player joined (or, with None, left) an alliance"""
+        previous = self.memberships.pop(username, None)
+        if previous is not None and previous in self.alliances:
+            self.alliances[previous]["members"].discard(username)
+        if alliance_id is not None and alliance_id in self.alliances:
+            self.memberships[username] = alliance_id
+            self.alliances[alliance_id]["members"].add(username)
+        kingdom = self.kingdoms.get(username)
+        if kingdom is not None and previous != alliance_id:
+            self._touch(self.tile_of(kingdom["x"], kingdom["y"]))
+
+    # Reads
+    def summary(self, tile: Tile) -> Tuple[dict, str]:
+        """Summary of one tile and its strong ETag, built on first read after a change"""
+        cached = self._summaries.get(tile)
+        if cached is not None:
+            return cached
+
+        kingdoms = []
+        flags: Dict[str, int] = {}
+        for username in sorted(self.tiles.get(tile, {})):
+            kingdom = dict(self.tiles[tile][username])
+            kingdom["allianceId"] = self.memberships.get(username)
+            if kingdom["allianceId"] is not None:
+                flags[kingdom["allianceId"]] = flags.get(kingdom["allianceId"], 0) + 1
+            kingdoms.append(kingdom)
+
+        summary = {
+            "id": f"{tile[0]}:{tile[1]}",
+            "x": tile[0] * self.TILE_SIZE,
+            "y": tile[1] * self.TILE_SIZE,
+            "kingdoms": kingdoms,
+            "alliances": [
+                {"id": alliance_id, "name": self.alliances[alliance_id]["name"],
+                 "flag": self.alliances[alliance_id]["flag"], "kingdoms": count}
+                for alliance_id, count in sorted(flags.items())
+            ]
+        }
+        digest = hashlib.blake2b(json.dumps(summary, sort_keys=True).encode(), digest_size=12).hexdigest()
+        self._summaries[tile] = (summary, f'"{digest}"')
+        return self._summaries[tile]
+
+    def viewport(self, x: int, y: int, width: int, height: int) -> List[Tile]:
+        """Tiles overlapping a map rectangle, clipped to the map"""
+        x_min, y_min = self.tile_of(x, y)
+        x_max, y_max = self.tile_of(x + max(width, 1) - 1, y + max(height, 1) - 1)
+        return [(tx, ty) for ty in range(y_min, y_max + 1) for tx in range(x_min, x_max + 1)]
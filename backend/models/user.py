@@ -36,8 +36,14 @@ class Resources(BaseModel):
     stone: int = 600
     food: int = 400
 
+class BuildingState(BaseModel):
+    # Stored per building type; static data is joined from BuildingSystem.BUILDING_DATA
+    level: int = 1
+    constructing: bool = False
+
 class Building(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    # API representation; the building type doubles as its id
+    id: str
     type: str
     level: int = 1
     constructing: bool = False
@@ -67,7 +73,7 @@ class PlayerProfile(BaseModel):
     location: Optional[str] = ""
     motto: Optional[str] = ""
     resources: Resources = Field(default_factory=Resources)
-    buildings: List[Building] = []
+    buildings: Dict[str, BuildingState] = {}
     army: Army = Field(default_factory=Army)
     power: int = 0
     coordinates: Dict[str, int] = {"x": 0, "y": 0}
@@ -5,6 +5,7 @@ import logging
 
 from routes.auth import get_current_user
 from database.mongodb import db
+from database.migrations import migrate_alliance_aggregates
 from models.user import PlayerModification, AdminAction
 
 logger = logging.getLogger(__name__)
@@ -145,6 +146,7 @@ async def delete_player(
         from bson import ObjectId
         await db.db.players.delete_one({"username": username})
         await db.db.users.delete_one({"_id": ObjectId(user["id"])})
+        await db.release_world_slot(player)
         
         # Clean up related data
         await db.db.construction_queue.delete_many({"playerId": player["id"]})
@@ -460,6 +462,8 @@ async def reset_game_data(
             })
             await db.db.construction_queue.delete_many({})
             await db.db.raids.delete_many({})
+            # Every member's power changed at once
+            await migrate_alliance_aggregates(db.db)
             
         elif reset_type == "chat":
             await db.db.chat_messages.delete_many({})
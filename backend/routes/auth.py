@@ -55,7 +55,9 @@ async def register_user(user_data: UserCreate):
             "buildings": default_buildings,
             "army": {"soldiers": 25, "archers": 0, "cavalry": 0},
             "power": BuildingSystem.calculate_power_from_buildings(default_buildings) + 250,  # Base army power
-            "coordinates": {"x": 0, "y": 0},
+            "coordinates": await db.claim_world_slot(user_data.username),
+            "allianceId": None,
+            "version": 0,
             "createdAt": datetime.utcnow(),
             "lastActive": datetime.utcnow()
         }
@@ -199,7 +201,10 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
                 "empire": current_user["player"]["empire"],
                 "isAdmin": current_user["isAdmin"]
             },
-            "player": current_user["player"]
+            "player": {
+                **current_user["player"],
+                "buildings": BuildingSystem.expand_buildings(current_user["player"]["buildings"])
+            }
         }
     except Exception as e:
         logger.error(f"Failed to get user info: {e}")
@@ -1,5 +1,6 @@
 from fastapi import APIRouter, HTTPException, Depends, status
-from typing import List
+from typing import List, Optional
+from datetime import datetime
 import logging
 
 from routes.auth import get_current_user
@@ -61,6 +62,65 @@ async def get_global_messages(limit: int = 100):
         logger.error(f"Failed to get global messages: {e}")
         raise HTTPException(status_code=500, detail="Failed to get messages")
 
+def alliance_channel(player: dict) -> str:
+    """Alliance channel a player may read and post in"""
+    alliance_id = player.get("allianceId")
+    if not alliance_id:
+        raise HTTPException(status_code=400, detail="Not in an alliance")
+    # The player document is authoritative: another server process may have handled the join
+    if not db.alliance_chat.can_access(player["username"], alliance_id):
+        db.alliance_chat.join(player["username"], alliance_id)
+    return alliance_id
+
+@router.post("/alliance", response_model=dict)
+async def send_alliance_message(
+    message_data: dict,
+    current_user: dict = Depends(get_current_user)
+):
+    """Send a message to the player's alliance channel"""
+    player = current_user["player"]
+    alliance_id = alliance_channel(player)
+    content = message_data.get("content", "").strip()
+    
+    if not content:
+        raise HTTPException(status_code=400, detail="Message content is required")
+    
+    if len(content) > 500:
+        raise HTTPException(status_code=400, detail="Message too long")
+    
+    # Buffered for readers right away; written by the next batched insert
+    message = db.alliance_chat.post(alliance_id, player["username"], content, player.get("empire"))
+    
+    return {
+        "success": True,
+        "message_id": str(message["_id"]),
+        "content": content,
+        "allianceId": alliance_id
+    }
+
+@router.get("/alliance", response_model=dict)
+async def get_alliance_messages(
+    current_user: dict = Depends(get_current_user),
+    limit: int = 50,
+    since: Optional[datetime] = None
+):
+    """Recent messages of the player's alliance channel; only newer ones with `since`"""
+    try:
+        alliance_id = alliance_channel(current_user["player"])
+        messages = await db.get_alliance_messages(alliance_id, limit, since)
+        return {
+            "allianceId": alliance_id,
+            "messages": [
+                {**{k: v for k, v in message.items() if k != "_id"}, "id": str(message["_id"])}
+                for message in messages
+            ]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to get alliance messages: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get alliance messages")
+
 @router.post("/private", response_model=dict)
 async def send_private_message(
     message_data: dict,
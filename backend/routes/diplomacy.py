@@ -1,10 +1,20 @@
-from fastapi import APIRouter, HTTPException, Depends, status
-from typing import List
+from fastapi import APIRouter, HTTPException, Depends, Header, Response, status
+from bson import ObjectId
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from typing import Dict, List, Optional
 from datetime import datetime, timedelta
 import logging
+import uuid
 
 from routes.auth import get_current_user
+from routes.game import parse_if_none_match
 from database.mongodb import db
+from game.alliance_rankings import AllianceRankings
+from game.market import Market
+from game.price_index import PriceIndex
+from game.world_map import WorldMap
+from game.world_tiles import WorldTiles
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/diplomacy", tags=["diplomacy"])
@@ -26,10 +36,13 @@ async def create_trade_offer(
         if not offering or not requesting:
             raise HTTPException(status_code=400, detail="Must specify both offering and requesting resources")
         
-        # Check if player has enough resources to offer
-        for resource, amount in offering.items():
-            if player["resources"].get(resource, 0) < amount:
-                raise HTTPException(status_code=400, detail=f"Insufficient {resource}")
+        for resource, amount in list(offering.items()) + list(requesting.items()):
+            if resource not in Market.RESOURCES or not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+                raise HTTPException(status_code=400, detail=f"Invalid amount of {resource}")
+        
+        # Escrow: the offered resources leave the creator's stock until the offer is taken or expires
+        if not await db.debit_resources(player["username"], offering):
+            raise HTTPException(status_code=400, detail="Insufficient resources for this offer")
         
         # Create trade offer
         trade_offer = {
@@ -42,12 +55,17 @@ async def create_trade_offer(
             "createdAt": datetime.utcnow(),
             "expiresAt": datetime.utcnow() + timedelta(seconds=duration),
             "active": True,
+            "escrowed": True,
             "acceptorId": None,
             "acceptorUsername": None
         }
         
         # Store in database
-        result = await db.db.trade_offers.insert_one(trade_offer)
+        try:
+            await db.db.trade_offers.insert_one(trade_offer)
+        except Exception:
+            await db.credit_resources(player["username"], offering)
+            raise
         
         # Prepare serializable response
         response_trade_offer = {
@@ -136,59 +154,51 @@ async def accept_trade_offer(
         from bson import ObjectId
         player = current_user["player"]
         
-        # Get trade offer
-        trade_offer = await db.db.trade_offers.find_one({
-            "_id": ObjectId(offer_id),
-            "active": True,
-            "expiresAt": {"$gt": datetime.utcnow()}
-        })
-        
-        if not trade_offer:
-            raise HTTPException(status_code=404, detail="Trade offer not found or expired")
-        
-        if trade_offer["creatorUsername"] == player["username"]:
-            raise HTTPException(status_code=400, detail="Cannot accept your own trade offer")
-        
-        # Check if acceptor has required resources
-        for resource, amount in trade_offer["requesting"].items():
-            if player["resources"].get(resource, 0) < amount:
-                raise HTTPException(status_code=400, detail=f"Insufficient {resource}")
-        
-        # Get creator player
-        creator = await db.get_player_by_username(trade_offer["creatorUsername"])
-        if not creator:
-            raise HTTPException(status_code=404, detail="Trade creator not found")
-        
-        # Execute trade
-        # Update acceptor resources
-        acceptor_resources = player["resources"].copy()
-        for resource, amount in trade_offer["requesting"].items():
-            acceptor_resources[resource] -= amount
-        for resource, amount in trade_offer["offering"].items():
-            acceptor_resources[resource] += amount
-        
-        # Update creator resources
-        creator_resources = creator["resources"].copy()
-        for resource, amount in trade_offer["offering"].items():
-            creator_resources[resource] -= amount
-        for resource, amount in trade_offer["requesting"].items():
-            creator_resources[resource] += amount
-        
-        # Update database
-        await db.update_player(player["username"], {"resources": acceptor_resources})
-        await db.update_player(creator["username"], {"resources": creator_resources})
-        
-        # Mark trade as completed
-        await db.db.trade_offers.update_one(
-            {"_id": ObjectId(offer_id)},
+        # Claim the offer; only one acceptor can win this write
+        now = datetime.utcnow()
+        trade_offer = await db.db.trade_offers.find_one_and_update(
+            {
+                "_id": ObjectId(offer_id),
+                "active": True,
+                "escrowed": True,
+                "expiresAt": {"$gt": now},
+                "creatorUsername": {"$ne": player["username"]}
+            },
             {"$set": {
                 "active": False,
                 "acceptorId": player["userId"],
                 "acceptorUsername": player["username"],
-                "completedAt": datetime.utcnow()
+                "completedAt": now,
+                "settled": False
             }}
         )
         
+        if not trade_offer:
+            own_offer = await db.db.trade_offers.find_one(
+                {"_id": ObjectId(offer_id), "creatorUsername": player["username"]}, {"_id": 1}
+            )
+            if own_offer:
+                raise HTTPException(status_code=400, detail="Cannot accept your own trade offer")
+            raise HTTPException(status_code=404, detail="Trade offer not found or expired")
+        
+        # Acceptor pays and receives the escrowed resources in one guarded write
+        if not await db.debit_resources(player["username"], trade_offer["requesting"],
+                                        credits=trade_offer["offering"], ledger=f"{trade_offer['_id']}:paid"):
+            # Put the offer back on the market
+            await db.db.trade_offers.update_one(
+                {"_id": trade_offer["_id"], "acceptorUsername": player["username"]},
+                {"$set": {"active": True, "acceptorId": None, "acceptorUsername": None},
+                 "$unset": {"completedAt": "", "settled": ""}}
+            )
+            raise HTTPException(status_code=400, detail="Insufficient resources to accept this offer")
+        
+        # An unsettled offer is finished by the trade expiry sweep if this fails
+        await db.settle_trade_offer(trade_offer)
+        
+        priced = PriceIndex.trade_pair(trade_offer["offering"], trade_offer["requesting"])
+        if priced:
+            db.record_trade(*priced)
+        
         return {
             "success": True,
             "message": "Trade completed successfully"
@@ -200,7 +210,193 @@ async def accept_trade_offer(
         logger.error(f"Failed to accept trade offer: {e}")
         raise HTTPException(status_code=500, detail="Failed to accept trade offer")
 
+# Market (order books)
+def serialize_order(order: dict) -> dict:
+    return {
+        "id": order["id"],
+        "pair": order["pair"],
+        "side": order["side"],
+        "price": order["price"],
+        "quantity": order["quantity"],
+        "remaining": order["remaining"],
+        "status": order["status"],
+        "createdAt": order["createdAt"].isoformat()
+    }
+
+@router.post("/market/orders")
+async def place_market_order(
+    order_data: dict,
+    current_user: dict = Depends(get_current_user)
+):
+    """Place a limit order; it fills against resting orders at their price, the rest waits on the book"""
+    try:
+        player = current_user["player"]
+        pair = order_data.get("pair", "")
+        side = order_data.get("side", "")
+        try:
+            price, quantity = db.market.validate(pair, side, order_data.get("price"), order_data.get("quantity"))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        book = db.market.book(pair)
+        escrow_resource = book.base if side == "sell" else book.quote
+        escrow = Market.escrow_for(side, quantity, price)
+        if not await db.debit_resources(player["username"], {escrow_resource: escrow}):
+            raise HTTPException(status_code=400, detail=f"Insufficient {escrow_resource}")
+        
+        order = {
+            "id": str(uuid.uuid4()),
+            "pair": pair,
+            "side": side,
+            "price": price,
+            "quantity": quantity,
+            "remaining": quantity,
+            "escrow": escrow,
+            "userId": player["userId"],
+            "username": player["username"],
+            "status": "open",
+            "createdAt": datetime.utcnow()
+        }
+        
+        inserted = False
+        try:
+            # Matching holds the books across workers, so no request sees a half-matched book
+            async with db.market_transaction() as market:
+                await db.db.market_orders.insert_one(order)
+                inserted = True
+                order.pop("_id", None)
+                fills = market.place(order)
+                
+                credits: Dict[str, Dict[str, int]] = {}
+                def credit(username: str, resource: str, amount: int):
+                    credits.setdefault(username, {}).setdefault(resource, 0)
+                    credits[username][resource] += amount
+                
+                for resting, fill_quantity, fill_price in fills:
+                    buyer, seller = (order, resting) if side == "buy" else (resting, order)
+                    paid = Market.quote_amount(fill_quantity, fill_price)
+                    buyer["escrow"] -= paid
+                    seller["escrow"] -= fill_quantity
+                    credit(buyer["username"], book.base, fill_quantity)
+                    credit(seller["username"], book.quote, paid)
+                    db.record_trade(pair, fill_price, fill_quantity)
+                
+                # Completed orders hand back what their escrow did not spend (buys at better prices)
+                touched = [resting for resting, _, _ in fills] + [order]
+                for touched_order in touched:
+                    if touched_order["remaining"] == 0:
+                        touched_order["status"] = "filled"
+                        if touched_order["escrow"]:
+                            credit(touched_order["username"],
+                                   book.quote if touched_order["side"] == "buy" else book.base, touched_order["escrow"])
+                            touched_order["escrow"] = 0
+                
+                # Fills and credits land together, or are finished by the next reload of the books
+                await db.settle_market(touched, credits)
+        except Exception:
+            # An order that never reached the collection gives its escrow back;
+            # one that did rests with it, and its owner can cancel it
+            if not inserted:
+                await db.credit_resources(player["username"], {escrow_resource: escrow})
+            raise
+        
+        return {
+            "success": True,
+            "order": serialize_order(order),
+            "fills": [{"price": fill_price, "quantity": fill_quantity} for _, fill_quantity, fill_price in fills]
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to place market order: {e}")
+        raise HTTPException(status_code=500, detail="Failed to place market order")
+
+@router.delete("/market/orders/{order_id}")
+async def cancel_market_order(order_id: str, current_user: dict = Depends(get_current_user)):
+    """Cancel an open order and refund its escrow"""
+    try:
+        player = current_user["player"]
+        order = None
+        async with db.market_transaction() as market:
+            resting = market.orders.get(order_id)
+            if resting and resting["username"] == player["username"]:
+                order = market.cancel(order_id)
+                book = market.book(order["pair"])
+                refund = {book.quote if order["side"] == "buy" else book.base: order["escrow"]}
+                order["status"] = "cancelled"
+                order["escrow"] = 0
+                await db.settle_market([order], {player["username"]: refund})
+        if order is None:
+            raise HTTPException(status_code=404, detail="Order not found")
+        
+        return {"success": True, "order": serialize_order(order)}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to cancel market order: {e}")
+        raise HTTPException(status_code=500, detail="Failed to cancel market order")
+
+@router.get("/market/orders")
+async def get_my_market_orders(current_user: dict = Depends(get_current_user)):
+    """Player's open orders"""
+    await db.sync_market()
+    orders = db.market.orders_of(current_user["player"]["username"])
+    return {"orders": [serialize_order(order) for order in sorted(orders, key=lambda o: o["createdAt"])]}
+
+@router.get("/market/prices")
+async def get_market_prices():
+    """Price index of every pair: last price and 1h/24h/7d VWAP, volume and range"""
+    return {"prices": [db.price_index.snapshot(pair) for pair in db.market.books]}
+
+@router.get("/market/{base}/{quote}/stats")
+async def get_market_stats(base: str, quote: str):
+    """Price index of one pair"""
+    pair = f"{base}/{quote}"
+    if pair not in db.market.books:
+        raise HTTPException(status_code=404, detail=f"Unknown resource pair {pair}")
+    return db.price_index.snapshot(pair)
+
+@router.get("/market/{base}/{quote}")
+async def get_market_quote(base: str, quote: str, depth: int = 10):
+    """Best bid/ask and aggregated depth of one pair's order book"""
+    try:
+        db.market.book(f"{base}/{quote}")
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    await db.sync_market()
+    book = db.market.book(f"{base}/{quote}")
+    best_bid, best_ask = book.best("buy"), book.best("sell")
+    return {
+        "pair": f"{base}/{quote}",
+        "bestBid": best_bid,
+        "bestAsk": best_ask,
+        "spread": round(best_ask - best_bid, Market.PRICE_DECIMALS) if best_bid and best_ask else None,
+        **book.depth(max(1, min(depth, 50)))
+    }
+
 # Alliance System
+# Alliances with at least this many members fly a flag on the alliance map
+ALLIANCE_FLAG_MEMBERS = 10
+
+# Invitations expire (and are then removed by the TTL index) after a week
+ALLIANCE_INVITE_TTL = timedelta(days=7)
+
+def serialize_alliance(alliance: dict) -> dict:
+    """Alliance document with its aggregates, ready for JSON"""
+    alliance = dict(alliance)
+    alliance["id"] = str(alliance.pop("_id"))
+    member_count = alliance.get("memberCount", 0)
+    alliance["memberCount"] = member_count
+    alliance["totalPower"] = alliance.get("totalPower", 0)
+    alliance["averagePower"] = round(alliance["totalPower"] / member_count) if member_count else 0
+    alliance["empires"] = {empire: count for empire, count in alliance.get("empires", {}).items() if count > 0}
+    alliance["hasFlag"] = member_count >= ALLIANCE_FLAG_MEMBERS
+    if alliance.get("createdAt"):
+        alliance["createdAt"] = alliance["createdAt"].isoformat()
+    return alliance
+
 @router.post("/alliance/create")
 async def create_alliance(
     alliance_data: dict,
@@ -221,26 +417,36 @@ async def create_alliance(
         if existing:
             raise HTTPException(status_code=400, detail="Alliance name already exists")
         
-        # Check if player is already in an alliance
-        player_alliance = await db.db.alliances.find_one({"members": player["username"]})
-        if player_alliance:
+        # Claim the player first: this fails if they are already in an alliance
+        alliance_id = ObjectId()
+        if not await db.set_player_alliance(player["username"], str(alliance_id)):
             raise HTTPException(status_code=400, detail="Already in an alliance")
         
         # Create alliance
         alliance = {
+            "_id": alliance_id,
             "id": str(__import__('uuid').uuid4()),
             "name": name,
             "description": description,
             "leaderId": player["userId"],
             "leaderUsername": player["username"],
             "members": [player["username"]],
+            "memberCount": 1,
+            "totalPower": player.get("power", 0),
+            "empires": {player.get("empire") or "unknown": 1},
             "createdAt": datetime.utcnow(),
             "maxMembers": 20,
             "level": 1,
             "experience": 0
         }
         
-        result = await db.db.alliances.insert_one(alliance)
+        try:
+            await db.db.alliances.insert_one(alliance)
+        except Exception:
+            await db.set_player_alliance(player["username"], None, expected=str(alliance_id))
+            raise
+        db.world_tiles.add_alliance(str(alliance_id), name, [player["username"]])
+        db.alliance_chat.add_channel(str(alliance_id), [player["username"]])
         
         # Prepare serializable response
         response_alliance = {
@@ -249,6 +455,8 @@ async def create_alliance(
             "description": alliance["description"],
             "leaderUsername": alliance["leaderUsername"],
             "members": alliance["members"],
+            "memberCount": alliance["memberCount"],
+            "totalPower": alliance["totalPower"],
             "createdAt": alliance["createdAt"].isoformat(),
             "maxMembers": alliance["maxMembers"],
             "level": alliance["level"],
@@ -268,21 +476,13 @@ async def create_alliance(
 
 @router.get("/alliance/list")
 async def get_alliances():
-    """Get list of all alliances"""
+    """Get list of all alliances with their member aggregates"""
     try:
-        cursor = db.db.alliances.find({}).sort("createdAt", -1).limit(50)
+        # Aggregates replace the member lists, which can be long
+        cursor = db.db.alliances.find({}, {"members": 0}).sort("createdAt", -1).limit(50)
         alliances = await cursor.to_list(length=50)
         
-        for alliance in alliances:
-            alliance["id"] = str(alliance["_id"])
-            del alliance["_id"]
-            alliance["memberCount"] = len(alliance.get("members", []))
-            alliance["hasFlag"] = alliance["memberCount"] >= 10  # Flag if 10+ members
-            # Convert datetime objects to ISO format strings
-            if "createdAt" in alliance and alliance["createdAt"]:
-                alliance["createdAt"] = alliance["createdAt"].isoformat()
-        
-        return {"alliances": alliances}
+        return {"alliances": [serialize_alliance(alliance) for alliance in alliances]}
         
     except Exception as e:
         logger.error(f"Failed to get alliances: {e}")
@@ -294,13 +494,12 @@ async def get_my_alliance(current_user: dict = Depends(get_current_user)):
     try:
         player = current_user["player"]
         
-        alliance = await db.db.alliances.find_one({"members": player["username"]})
+        alliance = None
+        if player.get("allianceId"):
+            alliance = await db.db.alliances.find_one({"_id": ObjectId(player["allianceId"])})
         
         if alliance:
-            alliance["id"] = str(alliance["_id"])
-            del alliance["_id"]
-            alliance["memberCount"] = len(alliance.get("members", []))
-            alliance["hasFlag"] = alliance["memberCount"] >= 10
+            alliance = serialize_alliance(alliance)
         
         return {"alliance": alliance}
         
@@ -332,15 +531,21 @@ async def invite_to_alliance(
             raise HTTPException(status_code=404, detail="Player not found")
         
         # Check if target is already in an alliance
-        target_alliance = await db.db.alliances.find_one({"members": target_username})
-        if target_alliance:
+        if target_player.get("allianceId"):
             raise HTTPException(status_code=400, detail="Player already in an alliance")
         
         # Check alliance capacity
         if len(alliance.get("members", [])) >= alliance.get("maxMembers", 20):
             raise HTTPException(status_code=400, detail="Alliance is full")
         
-        # Create invitation
+        # Create invitation; an expired one the TTL monitor has not removed yet no longer counts
+        now = datetime.utcnow()
+        await db.db.alliance_invites.delete_many({
+            "allianceId": str(alliance["_id"]),
+            "toUsername": target_username,
+            "status": "pending",
+            "expiresAt": {"$lte": now}
+        })
         invitation = {
             "id": str(__import__('uuid').uuid4()),
             "allianceId": str(alliance["_id"]),
@@ -350,11 +555,14 @@ async def invite_to_alliance(
             "toUserId": target_player["userId"],
             "toUsername": target_username,
             "status": "pending",
-            "createdAt": datetime.utcnow(),
-            "expiresAt": datetime.utcnow() + timedelta(days=7)
+            "createdAt": now,
+            "expiresAt": now + ALLIANCE_INVITE_TTL
         }
         
-        await db.db.alliance_invites.insert_one(invitation)
+        try:
+            await db.db.alliance_invites.insert_one(invitation)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=400, detail="Player already has a pending invitation")
         
         return {
             "success": True,
@@ -391,6 +599,37 @@ async def get_alliance_invites(current_user: dict = Depends(get_current_user)):
         logger.error(f"Failed to get alliance invites: {e}")
         raise HTTPException(status_code=500, detail="Failed to get alliance invites")
 
+@router.post("/alliance/invites/decline")
+async def decline_alliance_invites(
+    decline_data: dict,
+    current_user: dict = Depends(get_current_user)
+):
+    """Decline the listed pending invitations, or all of them when no ids are given"""
+    try:
+        player = current_user["player"]
+        query = {"toUsername": player["username"], "status": "pending"}
+        
+        invite_ids = decline_data.get("inviteIds")
+        if invite_ids:
+            if not isinstance(invite_ids, list) or not all(ObjectId.is_valid(i) for i in invite_ids):
+                raise HTTPException(status_code=400, detail="inviteIds must be a list of invitation ids")
+            query["_id"] = {"$in": [ObjectId(i) for i in invite_ids]}
+        
+        result = await db.db.alliance_invites.update_many(
+            query, {"$set": {"status": "declined", "declinedAt": datetime.utcnow()}}
+        )
+        
+        return {
+            "success": True,
+            "declined": result.modified_count
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to decline alliance invites: {e}")
+        raise HTTPException(status_code=500, detail="Failed to decline alliance invites")
+
 @router.post("/alliance/accept/{invite_id}")
 async def accept_alliance_invite(
     invite_id: str,
@@ -398,7 +637,6 @@ async def accept_alliance_invite(
 ):
     """Accept alliance invitation"""
     try:
-        from bson import ObjectId
         player = current_user["player"]
         
         # Get invitation
@@ -412,31 +650,35 @@ async def accept_alliance_invite(
         if not invite:
             raise HTTPException(status_code=404, detail="Invitation not found or expired")
         
-        # Check if player is already in an alliance
-        existing_alliance = await db.db.alliances.find_one({"members": player["username"]})
-        if existing_alliance:
-            raise HTTPException(status_code=400, detail="Already in an alliance")
-        
         # Get alliance
-        alliance = await db.db.alliances.find_one({"_id": ObjectId(invite["allianceId"])})
+        alliance = await db.db.alliances.find_one({"_id": ObjectId(invite["allianceId"])}, {"name": 1, "maxMembers": 1})
         if not alliance:
             raise HTTPException(status_code=404, detail="Alliance not found")
         
-        # Check capacity
-        if len(alliance.get("members", [])) >= alliance.get("maxMembers", 20):
-            raise HTTPException(status_code=400, detail="Alliance is full")
-        
-        # Add player to alliance
-        await db.db.alliances.update_one(
-            {"_id": ObjectId(invite["allianceId"])},
-            {"$push": {"members": player["username"]}}
-        )
+        # Claim the player, then take a seat if one is still free; undo the claim otherwise
+        if not await db.set_player_alliance(player["username"], invite["allianceId"]):
+            raise HTTPException(status_code=400, detail="Already in an alliance")
         
-        # Mark invitation as accepted
-        await db.db.alliance_invites.update_one(
-            {"_id": ObjectId(invite_id)},
-            {"$set": {"status": "accepted", "acceptedAt": datetime.utcnow()}}
+        max_members = alliance.get("maxMembers", 20)
+        result = await db.db.alliances.update_one(
+            {"_id": alliance["_id"], f"members.{max_members - 1}": {"$exists": False}},
+            {"$push": {"members": player["username"]}, "$inc": db.alliance_member_inc(player)}
         )
+        if result.modified_count == 0:
+            await db.set_player_alliance(player["username"], None, expected=invite["allianceId"])
+            raise HTTPException(status_code=400, detail="Alliance is full")
+        db.world_tiles.set_alliance(player["username"], invite["allianceId"])
+        db.alliance_chat.join(player["username"], invite["allianceId"])
+        
+        # Accept this invitation and decline every other pending one in a single round trip
+        now = datetime.utcnow()
+        await db.db.alliance_invites.bulk_write([
+            UpdateOne({"_id": invite["_id"]}, {"$set": {"status": "accepted", "acceptedAt": now}}),
+            UpdateMany(
+                {"toUsername": player["username"], "status": "pending", "_id": {"$ne": invite["_id"]}},
+                {"$set": {"status": "declined", "declinedAt": now}}
+            )
+        ], ordered=True)
         
         return {
             "success": True,
@@ -453,84 +695,132 @@ async def accept_alliance_invite(
 async def get_alliance_map():
     """Get alliance map with flags for alliances with 10+ members"""
     try:
-        # Get all alliances with their member counts
-        cursor = db.db.alliances.find({})
+        # Only flag-flying alliances are shown; an indexed range on memberCount
+        cursor = db.db.alliances.find(
+            {"memberCount": {"$gte": ALLIANCE_FLAG_MEMBERS}},
+            {"name": 1, "memberCount": 1, "totalPower": 1, "level": 1, "leaderUsername": 1, "description": 1}
+        ).sort("memberCount", -1)
         alliances = await cursor.to_list(length=None)
         
         alliance_map = []
         
         for alliance in alliances:
-            member_count = len(alliance.get("members", []))
+            alliance_id = str(alliance["_id"])
+            member_count = alliance["memberCount"]
             
-            # Only show alliances with 10+ members on the map
-            if member_count >= 10:
-                # Generate random coordinates for the map
-                import random
-                
-                alliance_data = {
-                    "id": str(alliance["_id"]),
-                    "name": alliance["name"],
-                    "memberCount": member_count,
-                    "level": alliance.get("level", 1),
-                    "leaderUsername": alliance["leaderUsername"],
-                    "coordinates": {
-                        "x": random.randint(100, 900),
-                        "y": random.randint(100, 700)
-                    },
-                    "flag": {
-                        "color": random.choice(["red", "blue", "green", "purple", "gold", "silver"]),
-                        "symbol": random.choice(["crown", "sword", "shield", "dragon", "eagle", "lion"]),
-                        "pattern": random.choice(["solid", "stripes", "cross", "diagonal"])
-                    },
-                    "influence": min(100, member_count * 3),  # Influence radius on map
-                    "description": alliance.get("description", "")
-                }
-                
-                alliance_map.append(alliance_data)
+            # Alliances sit at the centre of their members' castles
+            members = db.world_tiles.alliances.get(alliance_id, {}).get("members", ())
+            castles = [db.world_map.entries[m] for m in members if m in db.world_map.entries]
+            if not castles:
+                continue
+            
+            alliance_data = {
+                "id": alliance_id,
+                "name": alliance["name"],
+                "memberCount": member_count,
+                "totalPower": alliance.get("totalPower", 0),
+                "level": alliance.get("level", 1),
+                "leaderUsername": alliance["leaderUsername"],
+                "coordinates": {
+                    "x": sum(castle["x"] for castle in castles) / len(castles),
+                    "y": sum(castle["y"] for castle in castles) / len(castles)
+                },
+                "flag": WorldTiles.alliance_flag(alliance_id),
+                "influence": min(100, member_count * 3),  # Influence radius on map
+                "description": alliance.get("description", "")
+            }
+            
+            alliance_map.append(alliance_data)
         
         return {
             "alliances": alliance_map,
-            "mapSize": {"width": 1000, "height": 800},
+            "mapSize": {"width": WorldMap.WORLD_WIDTH, "height": WorldMap.WORLD_HEIGHT},
             "totalAlliances": len(alliance_map)
         }
         
     except Exception as e:
         logger.error(f"Failed to get alliance map: {e}")
         raise HTTPException(status_code=500, detail="Failed to get alliance map")
+
+@router.get("/alliance/rankings")
+async def get_alliance_rankings(
+    page: int = 1,
+    size: int = AllianceRankings.PAGE_SIZE,
+    if_none_match: Optional[str] = Header(default=None)
+):
+    """One page of the alliance leaderboard, by total member power
+
+    Pages come from the last scheduled rebuild; their ETag carries the
+    ranking version, so an unchanged page revalidates with a 304.
+    """
+    body, etag = db.alliance_rankings.page(page, size)
+    if etag in parse_if_none_match(if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json",
+                    headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+@router.get("/alliance/rankings/my")
+async def get_my_alliance_rank(current_user: dict = Depends(get_current_user)):
+    """Rank of the player's alliance in the current leaderboard"""
+    alliance_id = current_user["player"].get("allianceId")
+    if not alliance_id:
+        raise HTTPException(status_code=400, detail="Not in an alliance")
+    return {
+        "version": db.alliance_rankings.version,
+        "total": len(db.alliance_rankings.entries),
+        # None until the next rebuild picks up a new alliance
+        "alliance": db.alliance_rankings.rank_of(alliance_id)
+    }
+
+@router.post("/alliance/leave")
 async def leave_alliance(current_user: dict = Depends(get_current_user)):
     """Leave current alliance"""
     try:
         player = current_user["player"]
         
-        alliance = await db.db.alliances.find_one({"members": player["username"]})
+        alliance = None
+        if player.get("allianceId"):
+            alliance = await db.db.alliances.find_one({"_id": ObjectId(player["allianceId"])})
         if not alliance:
             raise HTTPException(status_code=400, detail="Not in an alliance")
         
-        # If leader, transfer leadership or disband
-        if alliance["leaderUsername"] == player["username"]:
-            remaining_members = [m for m in alliance["members"] if m != player["username"]]
-            if remaining_members:
-                # Transfer leadership to first remaining member
-                new_leader = remaining_members[0]
-                new_leader_data = await db.get_player_by_username(new_leader)
-                
-                await db.db.alliances.update_one(
-                    {"_id": alliance["_id"]},
-                    {"$set": {
-                        "leaderUsername": new_leader,
+        # Release the player first so concurrent leaves update the alliance once
+        alliance_id = str(alliance["_id"])
+        if not await db.set_player_alliance(player["username"], None, expected=alliance_id):
+            raise HTTPException(status_code=400, detail="Not in an alliance")
+        
+        member = {"_id": alliance["_id"], "members": player["username"]}
+        leave = {"$pull": {"members": player["username"]}, "$inc": db.alliance_member_inc(player, -1)}
+        disband = False
+        try:
+            # If leader, transfer leadership to the first remaining member who still plays, or disband
+            if alliance["leaderUsername"] == player["username"]:
+                new_leader_data = None
+                for username in alliance["members"]:
+                    if username != player["username"]:
+                        new_leader_data = await db.get_player_by_username(username)
+                        if new_leader_data:
+                            break
+                if new_leader_data:
+                    leave["$set"] = {
+                        "leaderUsername": new_leader_data["username"],
                         "leaderId": new_leader_data["userId"]
-                    },
-                    "$pull": {"members": player["username"]}}
-                )
+                    }
+                else:
+                    disband = True
+            if disband:
+                await db.db.alliances.delete_one(member)
             else:
-                # Disband alliance if no members left
-                await db.db.alliances.delete_one({"_id": alliance["_id"]})
-        else:
-            # Just remove from members
-            await db.db.alliances.update_one(
-                {"_id": alliance["_id"]},
-                {"$pull": {"members": player["username"]}}
-            )
+                await db.db.alliances.update_one(member, leave)
+        except Exception:
+            await db.set_player_alliance(player["username"], alliance_id)
+            raise
+        if disband:
+            db.world_tiles.remove_alliance(alliance_id)
+            db.alliance_chat.remove_channel(alliance_id)
+            await db.db.alliance_messages.delete_many({"allianceId": alliance_id})
+        db.world_tiles.set_alliance(player["username"], None)
+        db.alliance_chat.join(player["username"], None)
         
         return {
             "success": True,
@@ -1,13 +1,18 @@
-from fastapi import APIRouter, HTTPException, Depends, status
-from typing import List, Dict
+from fastapi import APIRouter, HTTPException, Depends, Header, Response, status
+from bson import ObjectId
+from typing import List, Dict, Optional
 from datetime import datetime, timedelta
+import json
 import logging
 
 from routes.auth import get_current_user
-from database.mongodb import db
+from database.mongodb import db, VersionConflictError
 from game.buildings import BuildingSystem
 from game.empire_bonuses import EmpireBonuses
-from game.combat import CombatSystem
+from game.marches import MarchSystem
+from game.rng import game_random
+from game.world_map import WorldMap
+from tasks.march_events import schedule_march
 from models.user import PlayerModification
 
 logger = logging.getLogger(__name__)
@@ -33,7 +38,7 @@ async def get_player_buildings(current_user: dict = Depends(get_current_user)):
     try:
         player = current_user["player"]
         return {
-            "buildings": player["buildings"],
+            "buildings": BuildingSystem.expand_buildings(player["buildings"]),
             "resource_generation": BuildingSystem.calculate_resource_generation(
                 player["buildings"], player["empire"]
             )
@@ -50,31 +55,36 @@ async def upgrade_building(
     """Start building upgrade"""
     try:
         player = current_user["player"]
-        building_id = building_data.get("buildingId")
+        # Buildings are keyed by type, which doubles as the building id
+        building_type = building_data.get("buildingId") or building_data.get("buildingType")
+        upgrade = {}
         
-        # Find the building
-        building = None
-        for b in player["buildings"]:
-            if b["id"] == building_id:
-                building = b
-                break
-        
-        if not building:
-            raise HTTPException(status_code=404, detail="Building not found")
-        
-        if building["constructing"]:
-            raise HTTPException(status_code=400, detail="Building is already being upgraded")
-        
-        target_level = building["level"] + 1
-        building_type = building["type"]
-        
-        # Check if can afford
-        cost = BuildingSystem.get_building_cost(building_type, target_level)
-        if not BuildingSystem.can_afford_building(player["resources"], building_type, target_level):
-            raise HTTPException(status_code=400, detail="Insufficient resources")
+        def start_upgrade(player: dict) -> dict:
+            # Find the building
+            building = BuildingSystem.normalize_buildings(player["buildings"]).get(building_type)
+            
+            if not building:
+                raise HTTPException(status_code=404, detail="Building not found")
+            
+            if building["constructing"]:
+                raise HTTPException(status_code=400, detail="Building is already being upgraded")
+            
+            target_level = building["level"] + 1
+            upgrade["targetLevel"] = target_level
+            
+            # Check if can afford
+            if not BuildingSystem.can_afford_building(player["resources"], building_type, target_level):
+                raise HTTPException(status_code=400, detail="Insufficient resources")
+            
+            # Deduct resources
+            return {
+                "resources": BuildingSystem.deduct_building_cost(player["resources"], building_type, target_level),
+                f"buildings.{building_type}.constructing": True
+            }
         
-        # Deduct resources
-        new_resources = BuildingSystem.deduct_building_cost(player["resources"], building_type, target_level)
+        # Update database; re-validated against fresh state on version conflicts
+        applied = await db.modify_player(player, start_upgrade)
+        new_resources = applied["resources"]
         
         # Create construction queue item
         # Use userId field from player data, fallback to id
@@ -83,18 +93,9 @@ async def upgrade_building(
             player_id = str(player_id)  # Ensure it's a string
         
         queue_item = BuildingSystem.create_construction_queue_item(
-            player_id, building_id, building_type, target_level, player["empire"]
+            player_id, building_type, building_type, upgrade["targetLevel"], player["empire"]
         )
-        
-        # Update database
         await db.add_construction_queue_item(queue_item)
-        await db.update_player(player["username"], {
-            "resources": new_resources,
-            "buildings": [
-                {**b, "constructing": True} if b["id"] == building_id else b
-                for b in player["buildings"]
-            ]
-        })
         
         return {
             "success": True,
@@ -111,6 +112,8 @@ async def upgrade_building(
         
     except HTTPException:
         raise
+    except VersionConflictError:
+        raise HTTPException(status_code=409, detail="Your kingdom changed while processing the request, please retry")
     except Exception as e:
         logger.error(f"Failed to upgrade building: {e}")
         raise HTTPException(status_code=500, detail="Failed to upgrade building")
@@ -169,33 +172,38 @@ async def recruit_soldiers(
         
         total_cost = {resource: amount * quantity for resource, amount in unit_costs[unit_type].items()}
         
-        # Check if can afford
-        for resource, cost in total_cost.items():
-            if player["resources"].get(resource, 0) < cost:
-                raise HTTPException(status_code=400, detail=f"Insufficient {resource}")
-        
-        # Deduct resources and add units
-        new_resources = player["resources"].copy()
-        for resource, cost in total_cost.items():
-            new_resources[resource] -= cost
-        
-        new_army = player["army"].copy()
-        new_army[unit_type] = new_army.get(unit_type, 0) + quantity
+        def recruit(player: dict) -> dict:
+            # Check if can afford
+            for resource, cost in total_cost.items():
+                if player["resources"].get(resource, 0) < cost:
+                    raise HTTPException(status_code=400, detail=f"Insufficient {resource}")
+            
+            # Deduct resources and add units
+            new_resources = player["resources"].copy()
+            for resource, cost in total_cost.items():
+                new_resources[resource] -= cost
+            
+            new_army = player["army"].copy()
+            new_army[unit_type] = new_army.get(unit_type, 0) + quantity
+            
+            return {
+                "resources": new_resources,
+                "army": new_army
+            }
         
         # Update database
-        await db.update_player(player["username"], {
-            "resources": new_resources,
-            "army": new_army
-        })
+        applied = await db.modify_player(player, recruit)
         
         return {
             "success": True,
-            "new_resources": new_resources,
-            "new_army": new_army
+            "new_resources": applied["resources"],
+            "new_army": applied["army"]
         }
         
     except HTTPException:
         raise
+    except VersionConflictError:
+        raise HTTPException(status_code=409, detail="Your kingdom changed while processing the request, please retry")
     except Exception as e:
         logger.error(f"Failed to recruit soldiers: {e}")
         raise HTTPException(status_code=500, detail="Failed to recruit soldiers")
@@ -222,59 +230,70 @@ async def train_army(
         
         cost = training_costs[training_type]
         
-        # Check if player can afford
-        for resource, amount in cost.items():
-            if player["resources"].get(resource, 0) < amount:
-                raise HTTPException(status_code=400, detail=f"Insufficient {resource}")
-        
-        # Check if player has army to train
-        army_size = sum(player["army"].values())
-        if army_size == 0:
-            raise HTTPException(status_code=400, detail="No army to train")
-        
-        # Deduct resources
-        new_resources = player["resources"].copy()
-        for resource, amount in cost.items():
-            new_resources[resource] -= amount
-        
-        # Add training experience/level to player (stored in a new field)
-        current_training = player.get("armyTraining", {"level": 1, "experience": 0})
-        
         # Add experience based on training type
         exp_gain = {"basic": 10, "advanced": 25, "elite": 50}[training_type]
-        current_training["experience"] += exp_gain
         
-        # Level up if enough experience
-        exp_needed = current_training["level"] * 100
-        while current_training["experience"] >= exp_needed:
-            current_training["experience"] -= exp_needed
-            current_training["level"] += 1
+        def train(player: dict) -> dict:
+            # Check if player can afford
+            for resource, amount in cost.items():
+                if player["resources"].get(resource, 0) < amount:
+                    raise HTTPException(status_code=400, detail=f"Insufficient {resource}")
+            
+            # Check if player has army to train
+            army_size = sum(player["army"].values())
+            if army_size == 0:
+                raise HTTPException(status_code=400, detail="No army to train")
+            
+            # Deduct resources
+            new_resources = player["resources"].copy()
+            for resource, amount in cost.items():
+                new_resources[resource] -= amount
+            
+            # Add training experience/level to player (stored in a new field)
+            current_training = dict(player.get("armyTraining", {"level": 1, "experience": 0}))
+            current_training["experience"] += exp_gain
+            
+            # Level up if enough experience
             exp_needed = current_training["level"] * 100
+            while current_training["experience"] >= exp_needed:
+                current_training["experience"] -= exp_needed
+                current_training["level"] += 1
+                exp_needed = current_training["level"] * 100
+            
+            return {
+                "resources": new_resources,
+                "armyTraining": current_training
+            }
         
         # Update database
-        await db.update_player(player["username"], {
-            "resources": new_resources,
-            "armyTraining": current_training
-        })
+        applied = await db.modify_player(player, train)
         
         return {
             "success": True,
             "message": f"Army trained with {training_type} training",
-            "new_resources": new_resources,
-            "army_training": current_training,
+            "new_resources": applied["resources"],
+            "army_training": applied["armyTraining"],
             "experience_gained": exp_gain
         }
         
     except HTTPException:
         raise
+    except VersionConflictError:
+        raise HTTPException(status_code=409, detail="Your kingdom changed while processing the request, please retry")
     except Exception as e:
         logger.error(f"Failed to train army: {e}")
         raise HTTPException(status_code=500, detail="Failed to train army")
+
+@router.post("/combat/raid")
 async def launch_raid(
     raid_data: dict,
     current_user: dict = Depends(get_current_user)
 ):
-    """Launch a raid against another player"""
+    """Send an army to raid another player
+
+    The troops are reserved now; the battle is fought when the march
+    arrives and survivors bring the loot home, both from the event queue.
+    """
     try:
         attacker = current_user["player"]
         target_username = raid_data.get("targetUsername")
@@ -282,90 +301,82 @@ async def launch_raid(
         if not target_username:
             raise HTTPException(status_code=400, detail="Target username is required")
         
-        # Get target player
-        defender = await db.get_player_by_username(target_username)
-        if not defender:
-            raise HTTPException(status_code=404, detail="Target player not found")
-        
-        # Check if attacker has army
-        attacker_army_size = sum(attacker["army"].values()) if attacker.get("army") else 0
-        if attacker_army_size == 0:
-            raise HTTPException(status_code=400, detail="No army available for raid")
-        
         # Check if not attacking self
         if attacker["username"] == target_username:
             raise HTTPException(status_code=400, detail="Cannot raid yourself")
         
-        # Simple raid calculation
-        defender_army_size = sum(defender["army"].values()) if defender.get("army") else 0
-        
-        # Calculate success chance (attacker advantage)
-        success_chance = min(0.8, max(0.2, attacker_army_size / (attacker_army_size + defender_army_size + 1)))
-        success = __import__('random').random() < success_chance
-        
-        # Calculate casualties
-        attacker_losses = max(1, int(attacker_army_size * 0.1))
-        defender_losses = max(1, int(defender_army_size * 0.15)) if success else max(1, int(defender_army_size * 0.05))
-        
-        # Calculate stolen resources
-        stolen_resources = {}
-        if success:
-            for resource in ["gold", "wood", "stone", "food"]:
-                defender_amount = defender["resources"].get(resource, 0)
-                steal_amount = int(defender_amount * __import__('random').uniform(0.05, 0.15))
-                if steal_amount > 0:
-                    stolen_resources[resource] = steal_amount
-        
-        # Update attacker
-        new_attacker_resources = attacker["resources"].copy()
-        for resource, amount in stolen_resources.items():
-            new_attacker_resources[resource] += amount
-        
-        new_attacker_army = attacker["army"].copy()
-        new_attacker_army["soldiers"] = max(0, new_attacker_army.get("soldiers", 0) - attacker_losses)
+        # Get target player
+        defender = await db.get_player_by_username(target_username)
+        if not defender:
+            raise HTTPException(status_code=404, detail="Target player not found")
         
-        # Update defender  
-        new_defender_resources = defender["resources"].copy()
-        for resource, amount in stolen_resources.items():
-            new_defender_resources[resource] = max(0, new_defender_resources[resource] - amount)
+        # Reserve the marching troops (the whole army unless told otherwise)
+        sent_army = {}
         
-        new_defender_army = defender["army"].copy()
-        new_defender_army["soldiers"] = max(0, new_defender_army.get("soldiers", 0) - defender_losses)
+        def reserve_troops(attacker: dict) -> dict:
+            army = attacker.get("army") or {}
+            try:
+                sent_army.clear()
+                sent_army.update(MarchSystem.validate_army(raid_data.get("army") or army, army))
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            
+            return {"army": {unit: count - sent_army.get(unit, 0) for unit, count in army.items()}}
         
-        # Update database
-        await db.update_player(attacker["username"], {
-            "resources": new_attacker_resources,
-            "army": new_attacker_army
-        })
-        await db.update_player(defender["username"], {
-            "resources": new_defender_resources,
-            "army": new_defender_army
-        })
+        await db.modify_player(attacker, reserve_troops)
         
-        # Create battle report
-        battle_report = f"{'Successful' if success else 'Failed'} raid on {target_username}. "
-        if success and stolen_resources:
-            resource_list = [f"{amount} {resource}" for resource, amount in stolen_resources.items()]
-            battle_report += f"Stolen: {', '.join(resource_list)}. "
-        battle_report += f"Casualties - Attacker: {attacker_losses}, Defender: {defender_losses}"
+        march = MarchSystem.create_march(attacker, defender, dict(sent_army))
+        march["seed"] = game_random.next_seed("raid")
+        try:
+            await db.db.marches.insert_one(march)
+            await schedule_march(march)
+        except Exception:
+            # The army never left: drop the march (its events then find nothing) and send the troops home
+            await db.db.marches.delete_one({"id": march["id"]})
+            await db.increment_player(attacker["username"], {f"army.{unit}": count for unit, count in march["army"].items()})
+            raise
         
         return {
             "success": True,
-            "raid_result": {
-                "success": success,
-                "stolenResources": stolen_resources,
-                "attackerLosses": attacker_losses,
-                "defenderLosses": defender_losses,
-                "battleReport": battle_report
-            }
+            "message": f"Your army marches on {target_username}",
+            "march": serialize_march(march)
         }
         
     except HTTPException:
         raise
+    except VersionConflictError:
+        raise HTTPException(status_code=409, detail="Your kingdom changed while processing the request, please retry")
     except Exception as e:
         logger.error(f"Failed to launch raid: {e}")
         raise HTTPException(status_code=500, detail="Failed to launch raid")
 
+@router.get("/combat/marches")
+async def get_marches(current_user: dict = Depends(get_current_user)):
+    """Get the player's armies that are still away"""
+    try:
+        player = current_user["player"]
+        cursor = db.db.marches.find({
+            "attackerUsername": player["username"],
+            "status": {"$in": ["marching", "returning"]}
+        })
+        marches = await cursor.to_list(length=100)
+        return {"marches": [serialize_march(march) for march in sorted(marches, key=lambda m: m["arrivesAt"])]}
+    except Exception as e:
+        logger.error(f"Failed to get marches: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get marches")
+
+def serialize_march(march: dict) -> dict:
+    return {
+        "id": march["id"],
+        "defenderUsername": march["defenderUsername"],
+        "army": march["army"],
+        "status": march["status"],
+        "departedAt": march["departedAt"],
+        "arrivesAt": march["arrivesAt"],
+        "returnsAt": march["arrivesAt"] + (march["arrivesAt"] - march["departedAt"]),
+        "travelSeconds": march["travelSeconds"]
+    }
+
 @router.get("/combat/history")
 async def get_combat_history(current_user: dict = Depends(get_current_user)):
     """Get player's combat history"""
@@ -399,6 +410,51 @@ async def get_nearby_players(current_user: dict = Depends(get_current_user)):
         logger.error(f"Failed to get nearby players: {e}")
         raise HTTPException(status_code=500, detail="Failed to get nearby players")
 
+# World Map
+def parse_if_none_match(header: Optional[str]) -> set:
+    """ETags listed in an If-None-Match header"""
+    if not header:
+        return set()
+    return {tag.strip().removeprefix("W/") for tag in header.split(",") if tag.strip()}
+
+@router.get("/map/viewport")
+async def get_map_viewport(
+    x: int = 0,
+    y: int = 0,
+    width: int = 1000,
+    height: int = 800,
+    if_none_match: Optional[str] = Header(default=None)
+):
+    """Tiles of the world map overlapping a viewport
+
+    Tiles whose ETag the client lists in If-None-Match come back as
+    {id, etag, notModified} without their content.
+    """
+    known = parse_if_none_match(if_none_match)
+    tiles = []
+    for tile in db.world_tiles.viewport(x, y, width, height):
+        summary, etag = db.world_tiles.summary(tile)
+        if etag in known:
+            tiles.append({"id": summary["id"], "etag": etag, "notModified": True})
+        else:
+            tiles.append({**summary, "etag": etag})
+    return {
+        "tileSize": db.world_tiles.TILE_SIZE,
+        "mapSize": {"width": WorldMap.WORLD_WIDTH, "height": WorldMap.WORLD_HEIGHT},
+        "tiles": tiles
+    }
+
+@router.get("/map/tiles/{tile_x}/{tile_y}")
+async def get_map_tile(tile_x: int, tile_y: int, if_none_match: Optional[str] = Header(default=None)):
+    """One world map tile, with ETag revalidation"""
+    if not (0 <= tile_x < db.world_tiles.columns and 0 <= tile_y < db.world_tiles.rows):
+        raise HTTPException(status_code=404, detail="Tile not found")
+    summary, etag = db.world_tiles.summary((tile_x, tile_y))
+    if etag in parse_if_none_match(if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=json.dumps(summary), media_type="application/json",
+                    headers={"ETag": etag, "Cache-Control": "no-cache"})
+
 # Player Profile
 @router.get("/player/profile")
 async def get_player_profile(current_user: dict = Depends(get_current_user)):
@@ -412,7 +468,7 @@ async def get_player_profile(current_user: dict = Depends(get_current_user)):
         total_resources = sum(player["resources"].values())
         
         return {
-            "profile": player,
+            "profile": {**player, "buildings": BuildingSystem.expand_buildings(player["buildings"])},
             "stats": {
                 "totalArmy": total_army,
                 "buildingPower": building_power,
@@ -432,158 +488,59 @@ async def update_player_profile(
     """Update player profile"""
     try:
         player = current_user["player"]
-        update_data = {}
-        
-        if profile_data.kingdomName:
-            update_data["kingdomName"] = profile_data.kingdomName
-        if profile_data.bio is not None:
-            update_data["bio"] = profile_data.bio
-        if profile_data.location is not None:
-            update_data["location"] = profile_data.location
-        if profile_data.motto is not None:
-            update_data["motto"] = profile_data.motto
-        
-        # Empire change requires special items (race change scroll)
-        if profile_data.empire and profile_data.empire != player.get("empire"):
-            # Check if player has race change scroll in inventory
-            player_inventory = player.get("inventory", {})
-            race_change_scrolls = player_inventory.get("raceChangeScroll", 0)
+        empire_change = {}
+        
+        # Empire change requires special items (race change scroll), taken
+        # from the inventory before the profile write and given back if it fails
+        changes_empire = bool(profile_data.empire and profile_data.empire != player.get("empire"))
+        if changes_empire and not await db.consume_inventory(player["userId"], "race_change_scroll"):
+            raise HTTPException(
+                status_code=400, 
+                detail="Race change requires a Race Change Scroll from the shop"
+            )
+        
+        def build_profile_update(player: dict) -> dict:
+            update_data = {}
             
-            if race_change_scrolls <= 0:
-                raise HTTPException(
-                    status_code=400, 
-                    detail="Race change requires a Race Change Scroll from the shop"
-                )
+            if profile_data.kingdomName:
+                update_data["kingdomName"] = profile_data.kingdomName
+            if profile_data.bio is not None:
+                update_data["bio"] = profile_data.bio
+            if profile_data.location is not None:
+                update_data["location"] = profile_data.location
+            if profile_data.motto is not None:
+                update_data["motto"] = profile_data.motto
             
-            # Consume the scroll
-            new_inventory = player_inventory.copy()
-            new_inventory["raceChangeScroll"] = race_change_scrolls - 1
-            update_data["inventory"] = new_inventory
-            update_data["empire"] = profile_data.empire
-        
-        if not update_data:
-            raise HTTPException(status_code=400, detail="No valid updates provided")
+            if changes_empire:
+                update_data["empire"] = profile_data.empire
+                empire_change.update(alliance=player.get("allianceId"), previous=player.get("empire") or "unknown")
+            
+            if not update_data:
+                raise HTTPException(status_code=400, detail="No valid updates provided")
+            
+            return update_data
         
         # Update database
-        await db.update_player(player["username"], update_data)
+        try:
+            await db.modify_player(player, build_profile_update)
+        except Exception:
+            if changes_empire:
+                await db.grant_inventory(player["userId"], {"race_change_scroll": 1})
+            raise
+        
+        # Keep the alliance's empire mix in step with its member's new empire
+        if empire_change.get("alliance"):
+            await db.db.alliances.update_one(
+                {"_id": ObjectId(empire_change["alliance"])},
+                {"$inc": {f"empires.{empire_change['previous']}": -1, f"empires.{profile_data.empire}": 1}}
+            )
         
         return {"success": True, "message": "Profile updated successfully"}
         
     except HTTPException:
         raise
+    except VersionConflictError:
+        raise HTTPException(status_code=409, detail="Your kingdom changed while processing the request, please retry")
     except Exception as e:
         logger.error(f"Failed to update profile: {e}")
         raise HTTPException(status_code=500, detail="Failed to update profile")
-
-# Shop System
-@router.get("/shop/items")
-async def get_shop_items():
-    """Get available shop items"""
-    shop_items = [
-        {
-            "id": "raceChangeScroll",
-            "name": "Race Change Scroll",
-            "description": "Allows you to change your empire/race once",
-            "price": {"gold": 5000},
-            "category": "special",
-            "icon": "scroll"
-        },
-        {
-            "id": "resourcePack",
-            "name": "Resource Pack",
-            "description": "Contains 1000 of each resource",
-            "price": {"gold": 2000},
-            "category": "resources",
-            "icon": "chest"
-        },
-        {
-            "id": "armyBoost",
-            "name": "Army Recruitment Boost",
-            "description": "Instantly recruit 100 soldiers",
-            "price": {"gold": 1500},
-            "category": "military",
-            "icon": "sword"
-        },
-        {
-            "id": "buildingBoost",
-            "name": "Construction Speed Boost",
-            "description": "Complete current construction instantly",
-            "price": {"gold": 1000},
-            "category": "construction",
-            "icon": "hammer"
-        }
-    ]
-    
-    return {"items": shop_items}
-
-@router.post("/shop/buy/{item_id}")
-async def buy_shop_item(
-    item_id: str,
-    purchase_data: dict,
-    current_user: dict = Depends(get_current_user)
-):
-    """Buy an item from the shop"""
-    try:
-        player = current_user["player"]
-        quantity = purchase_data.get("quantity", 1)
-        
-        # Get shop items
-        shop_response = await get_shop_items()
-        shop_items = {item["id"]: item for item in shop_response["items"]}
-        
-        if item_id not in shop_items:
-            raise HTTPException(status_code=404, detail="Item not found")
-        
-        item = shop_items[item_id]
-        total_cost = {}
-        
-        # Calculate total cost
-        for resource, cost in item["price"].items():
-            total_cost[resource] = cost * quantity
-        
-        # Check if player can afford
-        for resource, cost in total_cost.items():
-            if player["resources"].get(resource, 0) < cost:
-                raise HTTPException(status_code=400, detail=f"Insufficient {resource}")
-        
-        # Deduct cost
-        new_resources = player["resources"].copy()
-        for resource, cost in total_cost.items():
-            new_resources[resource] -= cost
-        
-        # Add item to inventory
-        inventory = player.get("inventory", {})
-        inventory[item_id] = inventory.get(item_id, 0) + quantity
-        
-        # Apply item effects immediately for some items
-        if item_id == "resourcePack":
-            new_resources["gold"] += 1000 * quantity
-            new_resources["wood"] += 1000 * quantity
-            new_resources["stone"] += 1000 * quantity
-            new_resources["food"] += 1000 * quantity
-            # Don't add to inventory for consumables
-            inventory[item_id] = inventory.get(item_id, 0)
-        elif item_id == "armyBoost":
-            new_army = player["army"].copy()
-            new_army["soldiers"] = new_army.get("soldiers", 0) + 100 * quantity
-            await db.update_player(player["username"], {"army": new_army})
-            inventory[item_id] = inventory.get(item_id, 0)
-        
-        # Update database
-        await db.update_player(player["username"], {
-            "resources": new_resources,
-            "inventory": inventory
-        })
-        
-        return {
-            "success": True,
-            "message": f"Purchased {quantity}x {item['name']}",
-            "new_resources": new_resources,
-            "inventory": inventory
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Failed to buy shop item: {e}")
-        raise HTTPException(status_code=500, detail="Failed to buy shop item")
\ No newline at end of file
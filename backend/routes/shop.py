@@ -1,143 +1,86 @@
-from fastapi import APIRouter, HTTPException, Depends, status
-from typing import List
+from fastapi import APIRouter, HTTPException, Depends, Header, Response, status
+from typing import Optional
 import logging
-import uuid
-from datetime import datetime
 
 from routes.auth import get_current_user
+from routes.game import parse_if_none_match
 from database.mongodb import db
-from models.shop import ShopItem, PurchaseRequest
+from game.shop_catalog import ShopCatalog, shop_catalog
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/game/shop", tags=["shop"])
 
-# Shop items configuration
-SHOP_ITEMS = [
-    {
-        "id": "race_change_scroll",
-        "name": "Race Change Scroll",
-        "description": "Allows you to change your empire race once. Use wisely!",
-        "category": "Special",
-        "rarity": "legendary",
-        "price": {"gold": 1000},
-        "available": True
-    },
-    {
-        "id": "resource_pack",
-        "name": "Resource Pack",
-        "description": "Contains 500 of each basic resource (Gold, Wood, Stone, Food)",
-        "category": "Resources",
-        "rarity": "common",
-        "price": {"gold": 2000},
-        "available": True
-    },
-    {
-        "id": "army_boost",
-        "name": "Army Training Boost",
-        "description": "Instantly train 50 soldiers, 25 archers, and 10 cavalry",
-        "category": "Military",
-        "rarity": "rare",
-        "price": {"gold": 1500, "food": 500},
-        "available": True
-    },
-    {
-        "id": "construction_boost",
-        "name": "Construction Speed Boost",
-        "description": "Complete one building upgrade instantly",
-        "category": "Buildings",
-        "rarity": "uncommon",
-        "price": {"gold": 800, "wood": 200, "stone": 200},
-        "available": True
-    }
-]
+# Longest accepted Idempotency-Key header
+MAX_IDEMPOTENCY_KEY_LENGTH = 128
 
 @router.get("/items")
-async def get_shop_items():
-    """Get all available shop items"""
-    try:
-        return {
-            "success": True,
-            "items": SHOP_ITEMS
-        }
-    except Exception as e:
-        logger.error(f"Failed to get shop items: {e}")
-        raise HTTPException(status_code=500, detail="Failed to get shop items")
+async def get_shop_items(if_none_match: Optional[str] = Header(default=None)):
+    """Get all available shop items; the pre-serialized catalog with a strong ETag"""
+    shop_catalog.refresh()
+    if shop_catalog.etag in parse_if_none_match(if_none_match):
+        return Response(status_code=304, headers={"ETag": shop_catalog.etag})
+    return Response(content=shop_catalog.body, media_type="application/json",
+                    headers={"ETag": shop_catalog.etag, "Cache-Control": "public, max-age=60"})
 
 @router.post("/buy/{item_id}")
 async def buy_shop_item(
     item_id: str,
     purchase_data: dict,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(default=None)
 ):
-    """Purchase an item from the shop"""
+    """Purchase an item from the shop
+    
+    The cost and any field effects land in one guarded $inc on the player
+    and items go to the inventory collection. With an Idempotency-Key
+    header, retries of the same purchase replay the first response instead
+    of buying again, and finish a purchase whose worker died mid-way.
+    """
     try:
         player = current_user["player"]
         
-        # Find the item
-        item = next((item for item in SHOP_ITEMS if item["id"] == item_id), None)
+        shop_catalog.refresh()
+        item = shop_catalog.get(item_id)
         if not item:
             raise HTTPException(status_code=404, detail="Item not found")
         
-        if not item["available"]:
-            raise HTTPException(status_code=400, detail="Item not available")
-        
         quantity = purchase_data.get("quantity", 1)
-        
-        # Calculate total cost
-        total_cost = {}
-        for resource, cost in item["price"].items():
-            total_cost[resource] = cost * quantity
-        
-        # Check if player can afford it
-        for resource, cost in total_cost.items():
-            if resource == "gems":
-                player_amount = player.get("gems", 0)
-            else:
-                player_amount = player["resources"].get(resource, 0)
-            
-            if player_amount < cost:
-                raise HTTPException(status_code=400, detail=f"Insufficient {resource}")
-        
-        # Deduct costs
-        for resource, cost in total_cost.items():
-            if resource == "gems":
-                # Handle gems if implemented
-                pass
-            else:
-                player["resources"][resource] -= cost
-        
-        # Apply item effects
-        await apply_item_effects(player, item_id, quantity)
-        
-        # Update player in database
-        await db.update_player(player["userId"], {
-            "resources": player["resources"],
-            "army": player.get("army", {}),
-            "raceChangeScrolls": player.get("raceChangeScrolls", 0)
-        })
-        
-        # Record purchase
-        purchase = {
-            "id": str(uuid.uuid4()),
-            "playerId": player["userId"],
-            "playerUsername": player["username"],
-            "itemId": item_id,
-            "itemName": item["name"],
-            "quantity": quantity,
-            "totalCost": total_cost,
-            "purchaseDate": datetime.utcnow()
-        }
-        
-        await db.db.shop_purchases.insert_one(purchase)
-        
-        return {
-            "success": True,
-            "message": f"Successfully purchased {item['name']}",
-            "item": item,
-            "quantity": quantity,
-            "totalCost": total_cost,
-            "player": player
-        }
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or not 1 <= quantity <= ShopCatalog.MAX_QUANTITY:
+            raise HTTPException(status_code=400, detail=f"Quantity must be between 1 and {ShopCatalog.MAX_QUANTITY}")
+        
+        if idempotency_key is not None and not 1 <= len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+        
+        order = None
+        if idempotency_key:
+            request = {"itemId": item["id"], "quantity": quantity}
+            claimed, order = await db.claim_shop_order(player["userId"], idempotency_key, request)
+            if not claimed:
+                if order["request"] != request:
+                    raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different purchase")
+                if order["status"] != "completed":
+                    raise HTTPException(status_code=409, detail="A purchase with this Idempotency-Key is in progress")
+                return {**order["response"], "player": player, "replayed": True}
+        
+        try:
+            response = await complete_purchase(player, item, quantity, idempotency_key,
+                                               str(order["_id"]) if order else None)
+        except HTTPException:
+            if order:
+                await db.release_shop_order(order)
+            raise
+        except Exception:
+            if order:
+                await db.release_shop_order(order, charged=True)
+            raise
+        
+        if order:
+            try:
+                await db.complete_shop_order(order, {key: value for key, value in response.items() if key != "player"})
+            except Exception as e:
+                # The purchase went through; a retry takes the stale order over and finds it charged
+                logger.error(f"Failed to record completed shop order {order['_id']}: {e}")
+        return response
         
     except HTTPException:
         raise
@@ -145,50 +88,61 @@ async def buy_shop_item(
         logger.error(f"Failed to purchase item: {e}")
         raise HTTPException(status_code=500, detail="Failed to purchase item")
 
-async def apply_item_effects(player, item_id, quantity):
-    """Apply the effects of purchased items"""
+async def complete_purchase(player: dict, item: dict, quantity: int, idempotency_key: Optional[str],
+                            order_id: Optional[str] = None) -> dict:
+    """Charge the player, hand out the item and queue the audit record
+
+    With a shop `order_id` the charge and the grant each apply once per
+    order, so a retried order resumes where an earlier attempt stopped.
+    """
+    if not item.get("available", True):
+        raise HTTPException(status_code=400, detail="Item not available")
+    
+    total_cost = shop_catalog.cost(item, quantity)
+    increments, inventory = shop_catalog.grant(item, quantity)
+    
+    updated = await db.charge_player(player["username"], total_cost, increments, order=order_id)
+    if updated is None and order_id:
+        charged = await db.get_player_by_username(player["username"])
+        if charged and order_id in charged.get("shopOrders", []):
+            updated = charged
+    if updated is None:
+        short = next((resource for resource, cost in total_cost.items()
+                      if player["resources"].get(resource, 0) < cost), None)
+        raise HTTPException(status_code=400, detail=f"Insufficient {short}" if short else "Insufficient resources")
+    
     try:
-        if item_id == "race_change_scroll":
-            # Add race change scrolls to player inventory
-            current_scrolls = player.get("raceChangeScrolls", 0)
-            player["raceChangeScrolls"] = current_scrolls + quantity
-            
-        elif item_id == "resource_pack":
-            # Add 500 of each resource per pack
-            resources_to_add = {
-                "gold": 500 * quantity,
-                "wood": 500 * quantity,
-                "stone": 500 * quantity,
-                "food": 500 * quantity
-            }
-            
-            for resource, amount in resources_to_add.items():
-                player["resources"][resource] = player["resources"].get(resource, 0) + amount
-                
-        elif item_id == "army_boost":
-            # Add army units
-            army_to_add = {
-                "soldiers": 50 * quantity,
-                "archers": 25 * quantity,
-                "cavalry": 10 * quantity
-            }
-            
-            if "army" not in player:
-                player["army"] = {"soldiers": 0, "archers": 0, "cavalry": 0}
-            
-            for unit_type, amount in army_to_add.items():
-                player["army"][unit_type] = player["army"].get(unit_type, 0) + amount
-                
-        elif item_id == "construction_boost":
-            # This would need to be implemented with the construction queue system
-            # For now, just add some resources as compensation
-            player["resources"]["gold"] = player["resources"].get("gold", 0) + 200
-            player["resources"]["wood"] = player["resources"].get("wood", 0) + 100
-            player["resources"]["stone"] = player["resources"].get("stone", 0) + 100
-            
-    except Exception as e:
-        logger.error(f"Failed to apply item effects: {e}")
+        await db.grant_inventory(player["userId"], inventory, order=order_id)
+    except Exception:
+        # An order keeps its charge for the retry to finish; otherwise undo it
+        # so a failed purchase costs nothing
+        if not order_id:
+            refund = {f"resources.{resource}": cost for resource, cost in total_cost.items()}
+            for path, amount in increments.items():
+                refund[path] = refund.get(path, 0) - amount
+            if not await db.increment_player(player["username"], refund):
+                logger.error(f"Could not undo the charge of {player['username']}'s failed {item['id']} purchase")
         raise
+    
+    purchase_id = db.queue_shop_purchase({
+        "playerId": player["userId"],
+        "playerUsername": player["username"],
+        "itemId": item["id"],
+        "itemName": item["name"],
+        "quantity": quantity,
+        "totalCost": total_cost,
+        "idempotencyKey": idempotency_key
+    })
+    
+    return {
+        "success": True,
+        "message": f"Successfully purchased {item['name']}",
+        "purchaseId": purchase_id,
+        "item": {key: value for key, value in item.items() if key != "aliases"},
+        "quantity": quantity,
+        "totalCost": total_cost,
+        "player": updated
+    }
 
 @router.get("/purchases")
 async def get_purchase_history(current_user: dict = Depends(get_current_user)):
@@ -196,15 +150,11 @@ async def get_purchase_history(current_user: dict = Depends(get_current_user)):
     try:
         player = current_user["player"]
         
-        cursor = db.db.shop_purchases.find({
-            "playerId": player["userId"]
-        }).sort("purchaseDate", -1).limit(50)
-        
-        purchases = await cursor.to_list(length=50)
+        purchases = await db.get_shop_purchases(player["userId"], limit=50)
         
         # Convert ObjectId and datetime
+        purchases = [{**purchase, "id": str(purchase["_id"])} for purchase in purchases]
         for purchase in purchases:
-            purchase["id"] = str(purchase["_id"])
             del purchase["_id"]
             if "purchaseDate" in purchase and purchase["purchaseDate"]:
                 purchase["purchaseDate"] = purchase["purchaseDate"].isoformat()
@@ -224,10 +174,7 @@ async def get_player_inventory(current_user: dict = Depends(get_current_user)):
     try:
         player = current_user["player"]
         
-        inventory = {
-            "raceChangeScrolls": player.get("raceChangeScrolls", 0),
-            # Add other inventory items as needed
-        }
+        inventory = await db.get_inventory(player["userId"])
         
         return {
             "success": True,
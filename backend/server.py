@@ -122,6 +122,7 @@ async def server_status():
         "status": "running",
         "database": db_status,
         "background_tasks": background_tasks.running,
+        "concurrency": db.get_concurrency_stats(),
         "stats": stats
     }
 
@@ -175,7 +176,7 @@ async def create_admin_user():
         
         default_buildings = BuildingSystem.get_default_buildings()
         # Upgrade admin buildings
-        for building in default_buildings:
+        for building in default_buildings.values():
             building["level"] = 5
         
         admin_player_data = {
@@ -190,7 +191,9 @@ async def create_admin_user():
             "buildings": default_buildings,
             "army": {"soldiers": 1000, "archers": 500, "cavalry": 250},
             "power": 50000,
-            "coordinates": {"x": 0, "y": 0},
+            "coordinates": await db.claim_world_slot("admin"),
+            "allianceId": None,
+            "version": 0,
             "createdAt": datetime.utcnow(),
             "lastActive": datetime.utcnow()
         }
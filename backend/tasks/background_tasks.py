@@ -2,11 +2,28 @@ import asyncio
 import logging
 import random
 from datetime import datetime, timedelta
+from typing import Optional
+from pymongo import UpdateOne
 from database.mongodb import db
 from game.buildings import BuildingSystem
+from game.economy import BatchEconomy
+from game.price_index import PriceIndex
+from game.rng import game_random
+from tasks.event_queue import event_queue
+import tasks.march_events  # registers the march event handlers
 
 logger = logging.getLogger(__name__)
 
+# Ticks over at least this many players use the vectorized BatchEconomy path
+BATCH_EVALUATION_THRESHOLD = 200
+BULK_WRITE_BATCH_SIZE = 1000
+
+# Expired offers a player remembers having been refunded, so a retried refund never pays twice
+REFUND_LEDGER_SIZE = 50
+
+# An accepted offer still unsettled after this long was abandoned mid-trade and is finished by the sweep
+TRADE_SETTLE_TIMEOUT = timedelta(minutes=1)
+
 class BackgroundTasks:
     """Background tasks for game maintenance"""
     
@@ -27,7 +44,14 @@ class BackgroundTasks:
             asyncio.create_task(self.resource_generation_task()),
             asyncio.create_task(self.construction_completion_task()),
             asyncio.create_task(self.cleanup_expired_data_task()),
-            asyncio.create_task(self.update_player_power_task())
+            asyncio.create_task(self.update_player_power_task()),
+            asyncio.create_task(self.raid_log_flush_task()),
+            asyncio.create_task(self.alliance_chat_flush_task()),
+            asyncio.create_task(self.shop_purchase_flush_task()),
+            asyncio.create_task(self.scheduled_events_task()),
+            asyncio.create_task(self.trade_expiry_task()),
+            asyncio.create_task(self.price_checkpoint_task()),
+            asyncio.create_task(self.alliance_rankings_task())
         ]
         
         logger.info("Background tasks started")
@@ -90,6 +114,90 @@ class BackgroundTasks:
                 logger.error(f"Power update task error: {e}")
                 await asyncio.sleep(60)
 
+    async def scheduled_events_task(self):
+        """Run due scheduled events (march arrivals and returns) every second"""
+        while self.running:
+            try:
+                await event_queue.drain()
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Scheduled events task error: {e}")
+                await asyncio.sleep(5)
+
+    async def trade_expiry_task(self):
+        """Refund the escrow of expired trade offers and settle interrupted trades every minute, and catch up with other workers' order books"""
+        while self.running:
+            try:
+                await self.refund_expired_trade_offers()
+                await self.settle_accepted_trade_offers()
+                await db.sync_market()
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Trade expiry task error: {e}")
+                await asyncio.sleep(60)
+
+    async def alliance_rankings_task(self):
+        """Rebuild the alliance leaderboard every minute"""
+        while self.running:
+            try:
+                await asyncio.sleep(60)
+                await db.refresh_alliance_rankings()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Alliance rankings task error: {e}")
+
+    async def price_checkpoint_task(self):
+        """Checkpoint the market price index every minute"""
+        while self.running:
+            try:
+                await asyncio.sleep(60)
+                await db.checkpoint_price_index()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Price checkpoint task error: {e}")
+
+    async def raid_log_flush_task(self):
+        """Write buffered raid records every 2 seconds"""
+        while self.running:
+            try:
+                await db.flush_raid_results()
+                await asyncio.sleep(2)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Raid log flush task error: {e}")
+                await asyncio.sleep(10)
+
+    async def alliance_chat_flush_task(self):
+        """Write queued alliance chat messages every 2 seconds"""
+        while self.running:
+            try:
+                await db.flush_alliance_messages()
+                await asyncio.sleep(2)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Alliance chat flush task error: {e}")
+                await asyncio.sleep(10)
+
+    async def shop_purchase_flush_task(self):
+        """Write buffered shop purchase records every 2 seconds"""
+        while self.running:
+            try:
+                await db.flush_shop_purchases()
+                await asyncio.sleep(2)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Shop purchase flush task error: {e}")
+                await asyncio.sleep(10)
+
     async def generate_resources_for_all_players(self):
         """Generate resources for all active players"""
         try:
@@ -102,26 +210,29 @@ class BackgroundTasks:
             
             active_players = await cursor.to_list(length=None)
             
-            for player in active_players:
-                try:
-                    # Calculate resource generation
-                    generation = BuildingSystem.calculate_resource_generation(
-                        player["buildings"], player["empire"]
-                    )
-                    
-                    # Apply generation (10 seconds worth)
-                    new_resources = player["resources"].copy()
-                    for resource, rate in generation.items():
-                        new_resources[resource] += int(rate * 10)  # 10 seconds
-                    
-                    # Update player resources
-                    await db.db.players.update_one(
-                        {"_id": player["_id"]},
-                        {"$set": {"resources": new_resources}}
-                    )
-                    
-                except Exception as e:
-                    logger.error(f"Error generating resources for {player['username']}: {e}")
+            if len(active_players) >= BATCH_EVALUATION_THRESHOLD:
+                # Large tick: evaluate every player's production in one vectorized pass
+                levels, empires = BatchEconomy.encode_players(active_players)
+                rates = BatchEconomy.production(levels, empires).tolist()
+                generations = [dict(zip(BatchEconomy.RESOURCES, row)) for row in rates]
+            else:
+                generations = [
+                    BuildingSystem.calculate_resource_generation(player["buildings"], player["empire"])
+                    for player in active_players
+                ]
+            
+            updates = []
+            for player, generation in zip(active_players, generations):
+                # Apply generation (10 seconds worth) as increments, so the tick
+                # never overwrites a concurrent request's resource changes;
+                # bumping version invalidates in-flight versioned writes
+                increments = {
+                    f"resources.{resource}": int(rate * 10)  # 10 seconds
+                    for resource, rate in generation.items()
+                }
+                updates.append(UpdateOne({"_id": player["_id"]}, {"$inc": {**increments, "version": 1}}))
+            
+            await self.bulk_update_players(updates)
             
             logger.debug(f"Generated resources for {len(active_players)} active players")
             
@@ -165,18 +276,14 @@ class BackgroundTasks:
                         logger.warning(f"Player not found for construction item: {player_id}")
                         continue
                     
-                    # Update building level
-                    updated_buildings = []
-                    for building in player["buildings"]:
-                        if building["id"] == item["buildingId"]:
-                            building["level"] = item["targetLevel"]
-                            building["constructing"] = False
-                        updated_buildings.append(building)
-                    
-                    # Update player
+                    # Update building level in place, keyed by building type
+                    building_type = item["buildingType"]
                     await db.db.players.update_one(
                         {"_id": player["_id"]},
-                        {"$set": {"buildings": updated_buildings}}
+                        {"$set": {
+                            f"buildings.{building_type}.level": item["targetLevel"],
+                            f"buildings.{building_type}.constructing": False
+                        }, "$inc": {"version": 1}}
                     )
                     
                     # Mark construction as completed
@@ -230,6 +337,14 @@ class BackgroundTasks:
             if result.deleted_count > 0:
                 logger.info(f"Cleaned up {result.deleted_count} old raid records")
             
+            # Price buckets older than the longest rolling window
+            result = await db.db.market_prices.delete_many({
+                "bucketStart": {"$lt": datetime.utcnow() - PriceIndex.retention()},
+                "window": {"$ne": "last"}
+            })
+            if result.deleted_count > 0:
+                logger.info(f"Cleaned up {result.deleted_count} old market price buckets")
+            
         except Exception as e:
             logger.error(f"Cleanup error: {e}")
 
@@ -239,37 +354,146 @@ class BackgroundTasks:
             cursor = db.db.players.find({})
             players = await cursor.to_list(length=None)
             
-            for player in players:
-                try:
-                    # Calculate building power
-                    building_power = BuildingSystem.calculate_power_from_buildings(player["buildings"])
-                    
-                    # Calculate army power
-                    army_power = sum(player["army"].values()) * 50
-                    
-                    # Calculate resource power (1 power per 100 resources)
-                    resource_power = sum(player["resources"].values()) // 100
-                    
-                    # Total power
-                    total_power = building_power + army_power + resource_power
-                    
-                    # Update player power
-                    await db.db.players.update_one(
-                        {"_id": player["_id"]},
-                        {"$set": {"power": total_power}}
-                    )
-                    
-                except Exception as e:
-                    logger.error(f"Error updating power for {player['username']}: {e}")
+            if len(players) >= BATCH_EVALUATION_THRESHOLD:
+                levels, _ = BatchEconomy.encode_players(players)
+                building_powers = BatchEconomy.power(levels).tolist()
+            else:
+                building_powers = [
+                    BuildingSystem.calculate_power_from_buildings(player["buildings"])
+                    for player in players
+                ]
+            
+            updates = []
+            for player, building_power in zip(players, building_powers):
+                # Calculate army power
+                army_power = sum(player["army"].values()) * 50
+                
+                # Calculate resource power (1 power per 100 resources)
+                resource_power = sum(player["resources"].values()) // 100
+                
+                # Total power
+                total_power = building_power + army_power + resource_power
+                
+                if player.get("power") != total_power:
+                    updates.append(UpdateOne({"_id": player["_id"]}, {"$set": {"power": total_power}}))
+                    player["power"] = total_power
+                
+                # Keeps the proximity index in step with writes from other server processes
+                db.world_map.place(player)
+                db.world_tiles.place(player)
+            
+            await self.bulk_update_players(updates)
+            await db.sync_alliance_power()
             
             logger.debug(f"Updated power for {len(players)} players")
             
         except Exception as e:
             logger.error(f"Power update error: {e}")
 
-    async def simulate_ai_activity(self):
+    async def refund_expired_trade_offers(self, batch_size: int = 500) -> int:
+        """Close expired offers, then give back the escrow of every closed offer not refunded yet
+
+        Closing marks an offer `refunded: False`; it is only set to True once
+        its creator has been credited, so a failed or interrupted refund is
+        retried by the next sweep. Creators remember the offers refunded to
+        them, which keeps a retry from crediting twice. Refund errors
+        propagate to the caller.
+        """
+        now = datetime.utcnow()
+        while True:
+            cursor = db.db.trade_offers.find(
+                {"active": True, "expiresAt": {"$lte": now}}, {"_id": 1}
+            ).limit(batch_size)
+            offer_ids = [offer["_id"] for offer in await cursor.to_list(length=batch_size)]
+            if not offer_ids:
+                break
+            # Offers accepted in the meantime are no longer active and stay out of the claim
+            await db.db.trade_offers.update_many(
+                {"_id": {"$in": offer_ids}, "active": True},
+                {"$set": {"active": False, "expired": True, "refunded": False}}
+            )
+            if len(offer_ids) < batch_size:
+                break
+        
+        refunded = 0
+        while True:
+            offers = await db.db.trade_offers.find({"refunded": False}).limit(batch_size).to_list(length=batch_size)
+            if not offers:
+                break
+            credits = [
+                UpdateOne({"username": offer["creatorUsername"], "refundedOffers": {"$ne": str(offer["_id"])}}, {
+                    "$inc": {
+                        **{f"resources.{resource}": amount for resource, amount in offer["offering"].items()},
+                        "version": 1
+                    },
+                    "$push": {"refundedOffers": {"$each": [str(offer["_id"])], "$slice": -REFUND_LEDGER_SIZE}}
+                })
+                for offer in offers if offer.get("escrowed")
+            ]
+            for start in range(0, len(credits), BULK_WRITE_BATCH_SIZE):
+                await db.db.players.bulk_write(credits[start:start + BULK_WRITE_BATCH_SIZE], ordered=False)
+            await db.db.trade_offers.update_many(
+                {"_id": {"$in": [offer["_id"] for offer in offers]}}, {"$set": {"refunded": True}}
+            )
+            refunded += len(offers)
+            if len(offers) < batch_size:
+                break
+        
+        if refunded:
+            logger.info(f"Refunded {refunded} expired trade offers")
+        return refunded
+
+    async def settle_accepted_trade_offers(self, batch_size: int = 500) -> int:
+        """Finish accepted offers whose settlement was interrupted
+
+        An accepted offer stays `settled: False` until its creator is paid.
+        Once TRADE_SETTLE_TIMEOUT has passed, the creator of an offer whose
+        acceptor has paid is credited through the trade ledger, and an offer
+        whose acceptor never paid goes back on the market. Errors propagate
+        to the caller.
+        """
+        stale = datetime.utcnow() - TRADE_SETTLE_TIMEOUT
+        settled = reopened = 0
+        while True:
+            offers = await db.db.trade_offers.find(
+                {"settled": False, "completedAt": {"$lte": stale}}
+            ).limit(batch_size).to_list(length=batch_size)
+            if not offers:
+                break
+            for offer in offers:
+                paid = await db.db.players.find_one(
+                    {"username": offer["acceptorUsername"], "tradeLedger": f"{offer['_id']}:paid"}, {"_id": 1}
+                )
+                if paid:
+                    await db.settle_trade_offer(offer)
+                    settled += 1
+                    continue
+                await db.db.trade_offers.update_one(
+                    {"_id": offer["_id"], "settled": False, "acceptorUsername": offer["acceptorUsername"]},
+                    {"$set": {"active": True, "acceptorId": None, "acceptorUsername": None},
+                     "$unset": {"completedAt": "", "settled": ""}}
+                )
+                reopened += 1
+            if len(offers) < batch_size:
+                break
+        
+        if settled or reopened:
+            logger.info(f"Settled {settled} interrupted trades, reopened {reopened} unpaid ones")
+        return settled
+
+    async def bulk_update_players(self, updates):
+        """Send player updates to the database in unordered bulk batches"""
+        for start in range(0, len(updates), BULK_WRITE_BATCH_SIZE):
+            try:
+                await db.db.players.bulk_write(updates[start:start + BULK_WRITE_BATCH_SIZE], ordered=False)
+            except Exception as e:
+                logger.error(f"Bulk player update error: {e}")
+
+    async def simulate_ai_activity(self, rng: Optional[random.Random] = None):
         """Simulate AI player activity"""
         try:
+            rng = rng or game_random.rng(game_random.next_seed("ai-activity"))
+            
             # Get AI players (those with specific usernames)
             ai_usernames = ['KingArthur', 'VikingRagnar', 'SaxonEdward', 'CelticBoudica', 'FrankishCharles', 'QueenEleanor', 'VikingErik', 'SaxonAlfred']
             
@@ -279,26 +503,24 @@ class BackgroundTasks:
             for player in ai_players:
                 try:
                     # Randomly upgrade buildings
-                    if len(player["buildings"]) > 0 and random.random() < 0.1:  # 10% chance
-                        import random
-                        building = random.choice(player["buildings"])
+                    buildings = BuildingSystem.normalize_buildings(player["buildings"])
+                    if len(buildings) > 0 and rng.random() < 0.1:  # 10% chance
+                        building_type = rng.choice(sorted(buildings))
+                        building = buildings[building_type]
                         if not building["constructing"] and building["level"] < 10:
-                            building["level"] += 1
-                            
                             await db.db.players.update_one(
                                 {"_id": player["_id"]},
-                                {"$set": {"buildings": player["buildings"]}}
+                                {"$set": {f"buildings.{building_type}.level": building["level"] + 1},
+                                 "$inc": {"version": 1}}
                             )
                     
                     # Randomly recruit army
-                    if random.random() < 0.05:  # 5% chance
+                    if rng.random() < 0.05:  # 5% chance
                         current_army = sum(player["army"].values())
                         if current_army < 200:
-                            player["army"]["soldiers"] += random.randint(5, 15)
-                            
                             await db.db.players.update_one(
                                 {"_id": player["_id"]},
-                                {"$set": {"army": player["army"]}}
+                                {"$inc": {"army.soldiers": rng.randint(5, 15), "version": 1}}
                             )
                     
                     # Update last active to keep them "online"
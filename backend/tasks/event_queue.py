@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+import logging
+import uuid
+
+from pymongo.errors import DuplicateKeyError
+
+from database.mongodb import db
+
+logger = logging.getLogger(__name__)
+
+EventHandler = Callable[[dict], Awaitable[None]]
+
+class EventQueue:
+    """Durable, time-indexed queue of scheduled game events
+
+    Events live in the `scheduled_events` collection as
+    {type, dueAt, payload, status}. Each wake-up claims up to `batch_size`
+    due events with one indexed query and one update_many, then hands them
+    to the handler registered for their type. Claims that a crashed worker never
+    finished are released after CLAIM_TIMEOUT, so every event eventually
+    runs; handlers must therefore be idempotent.
+    """
+
+    CLAIM_TIMEOUT = timedelta(minutes=5)
+    MAX_ATTEMPTS = 5
+    RETRY_DELAY = timedelta(seconds=30)
+
+    def __init__(self):
+        self.handlers: Dict[str, EventHandler] = {}
+
+    def register(self, event_type: str, handler: EventHandler):
+        self.handlers[event_type] = handler
+
+    async def schedule(self, event_type: str, due_at: datetime, payload: dict,
+                       event_id: Optional[str] = None) -> str:
+        """Persist an event to run at `due_at`; a fixed event_id makes scheduling idempotent"""
+        event = {
+            "id": event_id or str(uuid.uuid4()),
+            "type": event_type,
+            "dueAt": due_at,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "createdAt": datetime.utcnow()
+        }
+        try:
+            await db.db.scheduled_events.insert_one(event)
+        except DuplicateKeyError:
+            pass
+        return event["id"]
+
+    async def claim_due(self, now: datetime, limit: int) -> List[dict]:
+        """Claim up to `limit` due events for this worker"""
+        cursor = db.db.scheduled_events.find(
+            {"status": "pending", "dueAt": {"$lte": now}},
+            {"_id": 1}
+        ).sort("dueAt", 1).limit(limit)
+        event_ids = [event["_id"] for event in await cursor.to_list(length=limit)]
+        if not event_ids:
+            return []
+
+        # Only events still pending are ours; another worker may have raced us
+        token = str(uuid.uuid4())
+        await db.db.scheduled_events.update_many(
+            {"_id": {"$in": event_ids}, "status": "pending"},
+            {"$set": {"status": "processing", "claimToken": token, "claimedAt": now}, "$inc": {"attempts": 1}}
+        )
+        cursor = db.db.scheduled_events.find({"claimToken": token, "status": "processing"}).sort("dueAt", 1)
+        return await cursor.to_list(length=limit)
+
+    async def release_stale_claims(self, now: datetime):
+        """Put events claimed by a worker that died back in the queue"""
+        await db.db.scheduled_events.update_many(
+            {"status": "processing", "claimedAt": {"$lt": now - self.CLAIM_TIMEOUT}},
+            {"$set": {"status": "pending"}}
+        )
+
+    async def drain(self, now: Optional[datetime] = None, batch_size: int = 500) -> int:
+        """Run every due event, one claimed batch at a time; returns the number handled"""
+        now = now or datetime.utcnow()
+        await self.release_stale_claims(now)
+
+        handled = 0
+        while True:
+            events = await self.claim_due(now, batch_size)
+            done = []
+            for event in events:
+                handler = self.handlers.get(event["type"])
+                try:
+                    if handler is None:
+                        raise LookupError(f"No handler for event type {event['type']}")
+                    await handler(event)
+                    done.append(event["_id"])
+                except Exception as e:
+                    logger.error(f"Event {event['type']} {event['id']} failed: {e}")
+                    failed = event["attempts"] >= self.MAX_ATTEMPTS
+                    await db.db.scheduled_events.update_one(
+                        {"_id": event["_id"]},
+                        {"$set": {
+                            "status": "failed" if failed else "pending",
+                            "dueAt": now + self.RETRY_DELAY * event["attempts"],
+                            "lastError": str(e)
+                        }}
+                    )
+            if done:
+                await db.db.scheduled_events.delete_many({"_id": {"$in": done}})
+                handled += len(done)
+            if len(events) < batch_size:
+                return handled
+
+# Global event queue instance
+event_queue = EventQueue()
@@ -0,0 +1,148 @@
+from datetime import datetime
+import logging
+
+from database.mongodb import db
+from game.combat import CombatSystem
+from tasks.event_queue import event_queue
+
+logger = logging.getLogger(__name__)
+
+# March steps a player remembers having applied, so a retried event never applies one twice
+MARCH_LEDGER_SIZE = 20
+
+async def schedule_march(march: dict):
+    """Queue the arrival and the return of a new march
+
+    Both events are known at launch: the army heads home as soon as the
+    battle is fought, over the same distance. Fixed event ids keep a retried
+    launch from scheduling twice.
+    """
+    returns_at = march["arrivesAt"] + (march["arrivesAt"] - march["departedAt"])
+    await event_queue.schedule("march_arrival", march["arrivesAt"], {"marchId": march["id"]},
+                               event_id=f"{march['id']}:arrival")
+    await event_queue.schedule("march_return", returns_at, {"marchId": march["id"]},
+                               event_id=f"{march['id']}:return")
+
+def applied_step(player: dict, step: str):
+    """The ledger entry of a march step already applied to a player, or None"""
+    return next((entry for entry in player.get("marchLedger") or [] if entry["step"] == step), None)
+
+def record_step(player: dict, entry: dict) -> list:
+    """The player's ledger with one more applied step, keeping the last MARCH_LEDGER_SIZE"""
+    return ((player.get("marchLedger") or []) + [entry])[-MARCH_LEDGER_SIZE:]
+
+async def handle_march_arrival(event: dict):
+    """Fight the raid when the army reaches its target
+
+    Each step can be rerun: the outcome is stored on the march before
+    anyone is touched, the defender's losses are recorded in their march
+    ledger in the same versioned write, and the march turns home last.
+    """
+    march = await db.db.marches.find_one({"id": event["payload"]["marchId"]})
+    if not march or march["status"] != "marching":
+        return  # Already resolved by an earlier attempt
+
+    attacker = await db.get_player_by_username(march["attackerUsername"])
+    defender = await db.get_player_by_username(march["defenderUsername"])
+    if not defender:
+        # Target is gone: the army turns around with nothing to show for it
+        await db.db.marches.update_one(
+            {"_id": march["_id"], "status": "marching"},
+            {"$set": {"status": "returning", "survivors": march["army"], "loot": {}}}
+        )
+        return
+
+    # Fight once: a retry reuses the stored outcome instead of fighting the weakened defender again
+    outcome = march.get("outcome")
+    if outcome is None:
+        outcome = CombatSystem.resolve_army_raid(
+            march["army"], defender.get("army") or {},
+            (attacker or {}).get("empire", "norman"), defender.get("empire", "norman"),
+            defender["resources"], seed=march["seed"]
+        )
+        await db.db.marches.update_one(
+            {"_id": march["_id"], "status": "marching", "outcome": {"$exists": False}},
+            {"$set": {"outcome": outcome}}
+        )
+        outcome = (await db.db.marches.find_one({"_id": march["_id"]}))["outcome"]
+
+    step = f"{march['id']}:arrival"
+
+    def apply_defender_losses(defender: dict) -> dict:
+        if applied_step(defender, step):
+            return {}
+        # Loot is capped by what the defender holds when the write lands
+        loot = {}
+        new_defender_resources = defender["resources"].copy()
+        for resource, amount in outcome["stolenResources"].items():
+            loot[resource] = min(amount, new_defender_resources.get(resource, 0))
+            new_defender_resources[resource] = new_defender_resources.get(resource, 0) - loot[resource]
+
+        new_defender_army = defender["army"].copy()
+        for unit, lost in outcome["defenderLosses"].items():
+            new_defender_army[unit] = max(0, new_defender_army.get(unit, 0) - lost)
+
+        return {
+            "resources": new_defender_resources,
+            "army": new_defender_army,
+            "lastRaidTime": datetime.utcnow(),
+            "marchLedger": record_step(defender, {"step": step, "loot": loot})
+        }
+
+    if not applied_step(defender, step):
+        await db.modify_player(defender, apply_defender_losses)
+        defender = await db.get_player_by_username(march["defenderUsername"])
+    stolen_resources = applied_step(defender, step)["loot"]
+    outcome = {**outcome, "stolenResources": stolen_resources}
+
+    survivors = {
+        unit: count - outcome["attackerLosses"].get(unit, 0) for unit, count in march["army"].items()
+    }
+    result = await db.db.marches.update_one(
+        {"_id": march["_id"], "status": "marching"},
+        {"$set": {"status": "returning", "survivors": survivors, "loot": stolen_resources,
+                  "success": outcome["success"]}}
+    )
+    if result.modified_count == 0:
+        return
+
+    attacker = attacker or {"userId": march["attackerId"], "username": march["attackerUsername"]}
+    raid_record = CombatSystem.build_raid_record(attacker, defender, outcome)
+    raid_record["marchId"] = march["id"]
+    db.queue_raid_result(raid_record)
+    logger.info(f"Raid {march['attackerUsername']} -> {march['defenderUsername']} resolved: "
+                f"{'success' if outcome['success'] else 'repelled'}")
+
+async def handle_march_return(event: dict):
+    """Bring the survivors and their loot home, then close the march"""
+    march = await db.db.marches.find_one({"id": event["payload"]["marchId"]})
+    if not march or march["status"] == "returned":
+        return
+    if march["status"] != "returning":
+        # Arrival has not been processed yet (it is being retried); try again later
+        raise RuntimeError(f"March {march['id']} has not fought yet")
+
+    step = f"{march['id']}:return"
+    attacker = await db.get_player_by_username(march["attackerUsername"])
+
+    def apply_return(attacker: dict) -> dict:
+        if applied_step(attacker, step):
+            return {}
+        new_army = attacker["army"].copy()
+        for unit, count in march.get("survivors", {}).items():
+            new_army[unit] = new_army.get(unit, 0) + count
+        new_resources = attacker["resources"].copy()
+        for resource, amount in march.get("loot", {}).items():
+            new_resources[resource] = new_resources.get(resource, 0) + amount
+        return {"army": new_army, "resources": new_resources, "marchLedger": record_step(attacker, {"step": step})}
+
+    if attacker and not applied_step(attacker, step):
+        await db.modify_player(attacker, apply_return)
+
+    await db.db.marches.update_one(
+        {"_id": march["_id"], "status": "returning"},
+        {"$set": {"status": "returned", "returnedAt": datetime.utcnow()}}
+    )
+
+event_queue.register("march_arrival", handle_march_arrival)
+event_queue.register("march_return", handle_march_return)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Building lookup micro-benchmark
+Checks that the precomputed BuildingSystem tables agree with the previous
+per-call formulas (reproduced below), then times both paths over every
+(building type, level, empire), and times the vectorized BatchEconomy pass
+against per-player evaluation.
+"""
+
+import sys
+import timeit
+sys.path.append('/app/backend')
+
+from game.buildings import BuildingSystem
+from game.economy import BatchEconomy
+from game.empire_bonuses import EmpireBonuses
+
+REPEAT = 5
+NUMBER = 20
+
+def formula_cost(building_type: str, level: int):
+    base_cost = BuildingSystem.BUILDING_DATA[building_type]["base_cost"]
+    multiplier = 1.5 ** (level - 1)
+    cost = {}
+    for resource, amount in base_cost.items():
+        cost[resource] = int(amount * multiplier)
+    return cost
+
+def formula_time(building_type: str, level: int, empire: str):
+    from game.empire_bonuses import EmpireBonuses
+    base_time = BuildingSystem.BUILDING_DATA[building_type]["base_time"]
+    multiplier = 1.3 ** (level - 1)
+    return int(base_time * multiplier * EmpireBonuses.get_construction_time_multiplier(empire, building_type))
+
+def formula_generation(buildings, empire: str):
+    from game.empire_bonuses import EmpireBonuses
+    generation = {"gold": 0, "wood": 0, "stone": 0, "food": 0}
+    for building_type, state in BuildingSystem.normalize_buildings(buildings).items():
+        base_production = BuildingSystem.BUILDING_DATA.get(building_type, {}).get("production")
+        if base_production:
+            for resource, base_amount in base_production.items():
+                production = base_amount * state["level"]
+                generation[resource] += EmpireBonuses.apply_resource_bonus(empire, resource, production)
+    return generation
+
+def formula_power(buildings):
+    total_power = 0
+    for building_type, state in BuildingSystem.normalize_buildings(buildings).items():
+        base_power = {
+            "castle": 150,
+            "barracks": 120,
+            "blacksmith": 100,
+            "mine": 80,
+            "farm": 60,
+            "lumbermill": 60
+        }
+        total_power += base_power.get(building_type, 50) * state["level"]
+    return total_power
+
+def cases():
+    for building_type, data in BuildingSystem.BUILDING_DATA.items():
+        for level in range(1, data["max_level"] + 2):  # one past max exercises the fallback
+            for empire in EmpireBonuses.EMPIRE_DATA:
+                yield building_type, level, empire
+
+def kingdoms():
+    for level in range(1, 16):
+        buildings = {building_type: {"level": level, "constructing": False}
+                     for building_type in BuildingSystem.BUILDING_DATA}
+        for empire in EmpireBonuses.EMPIRE_DATA:
+            yield buildings, empire
+
+def check_equivalence() -> bool:
+    mismatches = 0
+    # Spot values from the original formulas, so a shared bug cannot hide
+    expected = {
+        ("castle", 1): {"gold": 100, "wood": 80, "stone": 120},
+        ("castle", 3): {"gold": 225, "wood": 180, "stone": 270},
+    }
+    for (building_type, level), cost in expected.items():
+        if BuildingSystem.get_building_cost(building_type, level) != cost:
+            mismatches += 1
+    shared = BuildingSystem.get_building_cost("castle", 1)
+    shared["gold"] = 0
+    if BuildingSystem.get_building_cost("castle", 1)["gold"] != 100:
+        mismatches += 1
+    for building_type, level, empire in cases():
+        if BuildingSystem.get_building_cost(building_type, level) != formula_cost(building_type, level):
+            mismatches += 1
+        if BuildingSystem.get_building_time(building_type, level, empire) != formula_time(building_type, level, empire):
+            mismatches += 1
+    for buildings, empire in kingdoms():
+        if BuildingSystem.calculate_resource_generation(buildings, empire) != formula_generation(buildings, empire):
+            mismatches += 1
+        if BuildingSystem.calculate_power_from_buildings(buildings) != formula_power(buildings):
+            mismatches += 1
+    status = "✅ PASS" if not mismatches else "❌ FAIL"
+    print(f"{status} Tables match formulas ({mismatches} mismatches)")
+    return not mismatches
+
+def bench(name: str, table_fn, formula_fn) -> float:
+    table = min(timeit.repeat(table_fn, repeat=REPEAT, number=NUMBER))
+    formula = min(timeit.repeat(formula_fn, repeat=REPEAT, number=NUMBER))
+    speedup = formula / table if table else float("inf")
+    print(f"{name:<12} tables {table * 1000:8.2f} ms   formulas {formula * 1000:8.2f} ms   speedup x{speedup:.2f}")
+    return speedup
+
+def main():
+    print("🏰 Building lookup micro-benchmark")
+    ok = check_equivalence()
+
+    all_cases = list(cases())
+    all_kingdoms = list(kingdoms())
+    speedups = [
+        bench("cost",
+              lambda: [BuildingSystem.get_building_cost(t, l) for t, l, _ in all_cases],
+              lambda: [formula_cost(t, l) for t, l, _ in all_cases]),
+        bench("time",
+              lambda: [BuildingSystem.get_building_time(t, l, e) for t, l, e in all_cases],
+              lambda: [formula_time(t, l, e) for t, l, e in all_cases]),
+        bench("generation",
+              lambda: [BuildingSystem.calculate_resource_generation(b, e) for b, e in all_kingdoms],
+              lambda: [formula_generation(b, e) for b, e in all_kingdoms]),
+        bench("power",
+              lambda: [BuildingSystem.calculate_power_from_buildings(b) for b, _ in all_kingdoms],
+              lambda: [formula_power(b) for b, _ in all_kingdoms]),
+    ]
+
+    batch_players = [{"buildings": buildings, "empire": empire} for buildings, empire in all_kingdoms] * 100
+    levels, empires = BatchEconomy.encode_players(batch_players)
+    speedups.append(bench(
+        "batch",
+        lambda: BatchEconomy.evaluate(levels, empires),
+        lambda: [(BuildingSystem.calculate_resource_generation(p["buildings"], p["empire"]),
+                  BuildingSystem.calculate_power_from_buildings(p["buildings"])) for p in batch_players]
+    ))
+
+    faster = all(speedup > 1 for speedup in speedups)
+    print(f"{'✅ PASS' if faster else '❌ FAIL'} Table lookups faster than formulas")
+    sys.exit(0 if ok and faster else 1)
+
+if __name__ == "__main__":
+    main()
@@ -125,11 +125,10 @@ const MultiplayerDashboard = ({ player, onLogout }) => {
     try {
       const result = await launchRaid(targetPlayer.username);
       if (result.success) {
-        const raidResult = result.raid_result;
+        const minutes = Math.ceil(result.march.travelSeconds / 60);
         toast({
-          title: raidResult.success ? "Raid Successful!" : "Raid Failed",
-          description: raidResult.battleReport,
-          variant: raidResult.success ? "default" : "destructive"
+          title: "Army on the march",
+          description: `Your army will reach ${targetPlayer.username} in about ${minutes} min.`
         });
       }
     } catch (error) {
@@ -761,12 +760,12 @@ const MultiplayerDashboard = ({ player, onLogout }) => {
                                   <h5 className="font-medium text-blue-400">{alliance.name}</h5>
                                   <p className="text-sm text-slate-400">{alliance.description}</p>
                                   <div className="text-xs text-slate-500">
-                                    Leader: {alliance.leader} | {alliance.members?.length || 0} members
+                                    Leader: {alliance.leaderUsername} | {alliance.memberCount || 0} members
                                   </div>
                                 </div>
                                 <div className="flex flex-col items-end space-y-1">
-                                  <Badge variant="outline">{alliance.members?.length || 0} members</Badge>
-                                  {alliance.members?.length >= 10 && (
+                                  <Badge variant="outline">{alliance.memberCount || 0} members</Badge>
+                                  {alliance.hasFlag && (
                                     <Badge variant="default" className="bg-purple-600">
                                       Elite Alliance
                                     </Badge>
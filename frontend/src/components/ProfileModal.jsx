@@ -21,8 +21,17 @@ const ProfileModal = ({ isOpen, onClose, player, onUpdate }) => {
     motto: player?.motto || '',
     empire: player?.empire || 'norman'
   });
+  const [inventory, setInventory] = useState({});
   const { toast } = useToast();
 
+  useEffect(() => {
+    if (isOpen) {
+      apiService.getInventory()
+        .then((result) => setInventory(result.inventory || {}))
+        .catch(() => setInventory({}));
+    }
+  }, [isOpen]);
+
   useEffect(() => {
     if (player) {
       setProfileData({
@@ -40,7 +49,7 @@ const ProfileModal = ({ isOpen, onClose, player, onUpdate }) => {
     try {
       // Check if race change is attempted and if player has scrolls
       if (profileData.empire !== player.empire) {
-        const raceChangeScrolls = player.raceChangeScrolls || 0;
+        const raceChangeScrolls = inventory.race_change_scroll || 0;
         if (raceChangeScrolls <= 0) {
           toast({
             title: "Race Change Restricted",
@@ -60,6 +69,9 @@ const ProfileModal = ({ isOpen, onClose, player, onUpdate }) => {
       }
 
       await apiService.updatePlayerProfile(profileData);
+      if (profileData.empire !== player.empire) {
+        setInventory((current) => ({ ...current, race_change_scroll: (current.race_change_scroll || 1) - 1 }));
+      }
       toast({
         title: "Profile Updated",
         description: "Your profile has been updated successfully!",
@@ -211,7 +223,7 @@ const ProfileModal = ({ isOpen, onClose, player, onUpdate }) => {
                       </Select>
                       {profileData.empire !== player.empire && (
                         <p className="text-xs text-amber-400">
-                          ⚠️ Changing empire requires a Race Change Scroll (You have: {player.raceChangeScrolls || 0})
+                          ⚠️ Changing empire requires a Race Change Scroll (You have: {inventory.race_change_scroll || 0})
                         </p>
                       )}
                     </div>
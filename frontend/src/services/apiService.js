@@ -533,9 +533,12 @@ class ApiService {
     }
   }
 
-  async buyShopItem(itemId, quantity = 1) {
+  // One key per purchase: retrying with the same key never buys twice
+  async buyShopItem(itemId, quantity = 1, idempotencyKey = crypto.randomUUID()) {
     try {
-      const response = await api.post(`/game/shop/buy/${itemId}`, { quantity });
+      const response = await api.post(`/game/shop/buy/${itemId}`, { quantity }, {
+        headers: { 'Idempotency-Key': idempotencyKey }
+      });
       return response.data;
     } catch (error) {
       throw new Error(error.response?.data?.detail || 'Failed to buy item');
@@ -545,6 +548,15 @@ class ApiService {
   async purchaseShopItem(itemId, quantity = 1) {
     return this.buyShopItem(itemId, quantity);
   }
+
+  async getInventory() {
+    try {
+      const response = await api.get('/game/shop/inventory');
+      return response.data;
+    } catch (error) {
+      throw new Error('Failed to get inventory');
+    }
+  }
   async getServerStatus() {
     try {
       const response = await api.get('/status');
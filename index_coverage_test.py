@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Index coverage test
+Runs explain() on every query shape the backend issues and checks that the
+winning plan is served by an index: no COLLSCAN and no in-memory SORT stage.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+sys.path.append('/app/backend')
+
+from dotenv import load_dotenv
+load_dotenv('/app/backend/.env')
+
+from database.mongodb import db
+
+NOW = datetime.utcnow()
+
+# (collection, filter, sort) for every query the routes, tasks and repository run.
+# Intentional full scans (power reconciliation, stats counts) are not listed.
+QUERY_SHAPES = [
+    # users / players point lookups
+    ("users", {"username": "admin"}, None),
+    ("players", {"username": "admin"}, None),
+    ("players", {"userId": "688c8758d22d26cb02c9de26"}, None),
+    ("players", {}, [("power", -1)]),
+    ("players", {"empire": "norman"}, [("power", -1)]),
+    ("players", {"username": {"$ne": "admin"}}, None),
+    ("players", {"lastActive": {"$gte": NOW - timedelta(hours=24)}}, None),
+    ("players", {"coordinates": {"$geoWithin": {"$box": [[0, 0], [100, 100]]}}}, None),
+    ("players", {"username": {"$in": ["player1", "player2"]}}, None),
+    # chat
+    ("chat_messages", {}, [("timestamp", -1)]),
+    ("chat_messages", {"username": "admin"}, None),
+    ("private_messages", {"$or": [{"sender": "admin"}, {"receiver": "admin"}]}, [("timestamp", 1)]),
+    ("private_messages", {"timestamp": {"$lt": NOW - timedelta(days=30)}}, None),
+    # construction
+    ("construction_queue", {"playerId": "p1", "completed": False}, [("startTime", 1)]),
+    ("construction_queue", {"completed": False, "completionTime": {"$lte": NOW}}, None),
+    ("construction_queue", {"completed": True, "completionTime": {"$lt": NOW - timedelta(days=7)}}, None),
+    # raids
+    ("raids", {"$or": [{"attackerUsername": "admin"}, {"defenderUsername": "admin"}]}, [("timestamp", -1)]),
+    ("raids", {"timestamp": {"$lt": NOW - timedelta(days=30)}}, None),
+    # marches and scheduled events
+    ("marches", {"id": "m1"}, None),
+    ("marches", {"attackerUsername": "admin", "status": {"$in": ["marching", "returning"]}}, None),
+    ("scheduled_events", {"status": "pending", "dueAt": {"$lte": NOW}}, [("dueAt", 1)]),
+    ("scheduled_events", {"status": "processing", "claimedAt": {"$lt": NOW}}, None),
+    ("scheduled_events", {"claimToken": "t1", "status": "processing"}, [("dueAt", 1)]),
+    # trade offers
+    ("trade_offers", {"active": True, "expiresAt": {"$gt": NOW}, "creatorUsername": {"$ne": "admin"}}, [("createdAt", -1)]),
+    ("trade_offers", {"creatorUsername": "admin"}, [("createdAt", -1)]),
+    ("trade_offers", {"active": True, "expiresAt": {"$lte": NOW}}, None),
+    ("trade_offers", {"refunded": False}, None),
+    ("trade_offers", {"settled": False, "completedAt": {"$lte": NOW}}, None),
+    # market orders
+    ("market_orders", {"id": "o1"}, None),
+    ("market_orders", {"status": "open"}, [("createdAt", 1)]),
+    ("market_prices", {"pair": {"$in": ["wood/gold", "stone/gold"]}, "window": "last"}, None),
+    ("market_prices", {"bucketStart": {"$gte": NOW - timedelta(days=7)}}, [("bucketStart", 1)]),
+    ("market_prices", {"bucketStart": {"$lt": NOW - timedelta(days=7)}, "window": {"$ne": "last"}}, None),
+    # alliances
+    ("alliances", {"name": "Test Alliance"}, None),
+    ("alliances", {"members": "admin"}, None),
+    ("players", {"allianceId": "688c8758d22d26cb02c9de26"}, None),
+    ("players", {"allianceId": {"$ne": None}}, None),
+    ("alliances", {"memberCount": {"$gte": 10}}, [("memberCount", -1)]),
+    ("alliance_messages", {"allianceId": "688c8758d22d26cb02c9de26"}, [("timestamp", -1)]),
+    ("alliance_messages", {"allianceId": "688c8758d22d26cb02c9de26"}, None),
+    ("alliances", {"leaderUsername": "admin"}, None),
+    ("alliances", {}, [("createdAt", -1)]),
+    ("alliance_invites", {"toUsername": "admin", "status": "pending", "expiresAt": {"$gt": NOW}}, [("createdAt", -1)]),
+    ("alliance_invites", {"toUsername": "admin", "status": "pending"}, None),
+    ("alliance_invites", {"allianceId": "688c8758d22d26cb02c9de26", "toUsername": "admin", "status": "pending",
+                          "expiresAt": {"$lte": NOW}}, None),
+    # shop
+    ("shop_purchases", {"playerId": "688c8758d22d26cb02c9de26"}, [("purchaseDate", -1)]),
+    ("shop_orders", {"playerId": "688c8758d22d26cb02c9de26", "idempotencyKey": "3f2a"}, None),
+    ("inventory", {"playerId": "688c8758d22d26cb02c9de26", "quantity": {"$gt": 0}}, None),
+    ("inventory", {"playerId": "688c8758d22d26cb02c9de26", "itemId": "race_change_scroll",
+                   "quantity": {"$gte": 1}}, None),
+]
+
+def plan_stages(plan):
+    """Collect every stage name in an explain() plan tree"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for key in ("inputStage", "queryPlan", "winningPlan"):
+            if key in plan:
+                stages.extend(plan_stages(plan[key]))
+        for child in plan.get("inputStages", []):
+            stages.extend(plan_stages(child))
+    return stages
+
+async def seed_documents():
+    """Insert a few documents so the planner has something to choose between"""
+    await db.db.players.insert_many([
+        {"userId": f"user{i}", "username": f"player{i}", "empire": "norman",
+         "power": i * 10, "lastActive": NOW, "coordinates": {"x": i * 4, "y": i * 4}}
+        for i in range(20)
+    ])
+    await db.db.trade_offers.insert_many([
+        {"creatorUsername": f"player{i}", "active": i % 2 == 0, "createdAt": NOW,
+         "expiresAt": NOW + timedelta(hours=1)}
+        for i in range(20)
+    ])
+    await db.db.alliances.insert_one({"name": "Test Alliance", "leaderUsername": "player0",
+                                      "members": ["player0", "player1"], "createdAt": NOW})
+
+async def test_index_coverage():
+    """Explain every query shape against a scratch database"""
+    print("🔍 Index Coverage Test")
+
+    os.environ['DB_NAME'] = os.environ.get('DB_NAME', 'medieval_empires') + "_index_test"
+    await db.connect_to_mongo()
+    await db.client.drop_database(db.db.name)
+    await db.create_indexes()
+    await seed_documents()
+
+    failures = []
+    try:
+        for collection, query, sort in QUERY_SHAPES:
+            cursor = db.db[collection].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            explain = await cursor.explain()
+            stages = plan_stages(explain["queryPlanner"]["winningPlan"])
+
+            bad = [stage for stage in stages if stage in ("COLLSCAN", "SORT")]
+            label = f"{collection} {query} sort={sort}"
+            if bad:
+                failures.append(label)
+                print(f"❌ {label}: {stages}")
+            else:
+                print(f"✅ {label}")
+    finally:
+        await db.client.drop_database(db.db.name)
+        await db.close_mongo_connection()
+
+    print(f"\n{len(QUERY_SHAPES) - len(failures)}/{len(QUERY_SHAPES)} query shapes index-covered")
+    return not failures
+
+def test_ttl_index_signature():
+    """A TTL index expiring at the stored date differs from a plain index on the same key"""
+    from pymongo import ASCENDING, IndexModel
+    from database.indexes import index_signature
+
+    plain = IndexModel([("expiresAt", ASCENDING)]).document
+    ttl = IndexModel([("expiresAt", ASCENDING)], expireAfterSeconds=0).document
+    different = index_signature(plain) != index_signature(ttl)
+    print(f"{'✅' if different else '❌'} TTL and plain expiresAt indexes have different signatures")
+    return different
+
+if __name__ == "__main__":
+    ok = test_ttl_index_signature()
+    sys.exit(0 if asyncio.run(test_index_coverage()) and ok else 1)